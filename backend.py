@@ -0,0 +1,141 @@
+import threading
+
+import numpy as np
+
+# Shared array backend for the effect engines. CuPy is used when it is
+# installed and a device is usable, otherwise everything runs on NumPy.
+# Importing CuPy and creating a CUDA context takes seconds, so it happens on
+# first use rather than at import; the editor warms it up in the background.
+cp = None
+cupyx = None
+HAS_CUPY = False
+_probed = False
+_probe_lock = threading.Lock()
+
+# Device memory. Freed device and pinned host blocks go back to CuPy's pools
+# and are handed out again, so a dialog ticking over the same image size
+# stops allocating after its first preview. The device pool can be capped
+# (0 means no cap). Transfers are staged through pinned host buffers on a
+# copy stream, which keeps the DMA at full speed and lets uploads run
+# while the host moves on.
+_device_limit = 0
+_copy_stream = None
+_in_flight = []
+_transfer_lock = threading.Lock()
+
+
+def probe():
+    global cp, HAS_CUPY, _probed
+    with _probe_lock:
+        if not _probed:
+            try:
+                import cupy
+                cupy.cuda.runtime.getDeviceCount()
+                cp = cupy
+                _configure()
+                HAS_CUPY = True
+            except Exception:
+                cp = None
+            _probed = True
+    return HAS_CUPY
+
+
+def _configure():
+    global cupyx, _copy_stream
+    import cupyx as _cupyx
+    cupyx = _cupyx
+    cp.cuda.set_pinned_memory_allocator(cp.cuda.PinnedMemoryPool().malloc)
+    cp.get_default_memory_pool().set_limit(size=_device_limit)
+    # A blocking stream: it still waits for kernels queued on the default
+    # stream, and they wait for it
+    _copy_stream = cp.cuda.Stream()
+
+
+def set_device_limit(nbytes):
+    global _device_limit
+    _device_limit = max(0, int(nbytes))
+    if HAS_CUPY:
+        cp.get_default_memory_pool().set_limit(size=_device_limit)
+
+
+def device_limit():
+    return _device_limit
+
+
+def device_memory():
+    # (bytes in use, bytes held by the pool) on the device
+    if not HAS_CUPY:
+        return 0, 0
+    pool = cp.get_default_memory_pool()
+    return pool.used_bytes(), pool.total_bytes()
+
+
+def free_device_memory():
+    # Returns cached blocks to the driver, for when the cap is hit
+    if HAS_CUPY:
+        cp.get_default_memory_pool().free_all_blocks()
+        cp.get_pinned_memory_pool().free_all_blocks()
+
+
+def warm_up():
+    # Imports CuPy and touches the device so the context and memory pool
+    # exist before the first effect runs
+    if probe():
+        cp.zeros(1, dtype=cp.float32).sum()
+    return HAS_CUPY
+
+
+def get_xp(prefer_gpu=True):
+    if prefer_gpu and probe():
+        return cp
+    return np
+
+
+def xp_of(arr):
+    if HAS_CUPY and isinstance(arr, cp.ndarray):
+        return cp
+    return np
+
+
+def to_device(arr, xp):
+    # Upload through a pinned staging buffer. The copy is left running; the
+    # staging buffer is kept until it has finished, and kernels queued on
+    # the default stream after this wait for it.
+    if xp is np:
+        return to_host(arr)
+    if isinstance(arr, cp.ndarray):
+        return arr
+    host = np.asarray(arr)
+    staging = cupyx.empty_pinned(host.shape, host.dtype)
+    staging[...] = host
+    out = cp.empty(host.shape, host.dtype)
+    with _transfer_lock:
+        out.set(staging, stream=_copy_stream)
+        done = cp.cuda.Event()
+        done.record(_copy_stream)
+        _in_flight[:] = [(e, s) for e, s in _in_flight if not e.done]
+        _in_flight.append((done, staging))
+    return out
+
+
+def to_host(arr):
+    # Download into a pinned staging buffer, then into ordinary memory so
+    # long-lived host arrays don't keep pages locked
+    if HAS_CUPY and isinstance(arr, cp.ndarray):
+        arr = cp.ascontiguousarray(arr)
+        staging = cupyx.empty_pinned(arr.shape, arr.dtype)
+        arr.get(stream=_copy_stream, out=staging)
+        _copy_stream.synchronize()
+        return staging.copy()
+    return np.asarray(arr)
+
+
+def hash32(x):
+    # lowbias32 integer hash of a uint32 array, on either backend. Used where
+    # random-looking values must be a pure function of position.
+    x = x ^ (x >> 16)
+    x *= np.uint32(0x7feb352d)
+    x ^= x >> 15
+    x *= np.uint32(0x846ca68b)
+    x ^= x >> 16
+    return x
@@ -0,0 +1,57 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Row-band execution for the NumPy paths. An image is cut into bands of
+# rows small enough for one band's float32 working copy to stay in cache,
+# and the bands run on a shared thread pool; NumPy drops the GIL inside its
+# loops, so they run on all cores. Each band writes its rows of an output
+# allocated up front, so no full-frame temporaries are made.
+
+# float32 bytes per band, about one core's share of L2
+BAND_BYTES = 1 << 20
+
+_workers = os.cpu_count() or 1
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def set_workers(n):
+    # Worker processes that already run one per core set this to 1
+    global _workers
+    _workers = max(1, int(n))
+
+
+def band_rows(width, channels=4, itemsize=4, band_bytes=BAND_BYTES):
+    return max(1, band_bytes // max(1, width * channels * itemsize))
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix="band")
+        return _pool
+
+
+def run_bands(fn, height, rows):
+    # Calls fn(y0, y1) for every band of rows, in parallel when there is
+    # more than one band. Bands started from a band thread run inline so
+    # nested calls can't wait on their own pool.
+    spans = [(y0, min(y0 + rows, height)) for y0 in range(0, height, rows)]
+    if len(spans) <= 1 or _workers == 1 or getattr(_local, "inside", False):
+        for y0, y1 in spans:
+            fn(y0, y1)
+        return
+
+    def task(y0, y1):
+        _local.inside = True
+        try:
+            fn(y0, y1)
+        finally:
+            _local.inside = False
+
+    futures = [_get_pool().submit(task, y0, y1) for y0, y1 in spans]
+    for future in futures:
+        future.result()
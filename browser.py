@@ -0,0 +1,331 @@
+import os
+import bisect
+import ctypes
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QListView, QFileDialog
+)
+from PyQt5.QtGui import QPixmap, QColor, QIcon
+from PyQt5.QtCore import (
+    Qt, QSize, QTimer, QObject, QAbstractListModel, QModelIndex, QFileSystemWatcher, pyqtSignal
+)
+
+from thumbcache import build_thumbnail
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+ICON_SIZE = 128
+MAX_LOADED_ICONS = 512
+
+DWMWA_CAPTION_COLOR = 35
+
+
+def list_images(folder):
+    entries = {}
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    st = entry.stat()
+                    entries[entry.path] = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        pass
+    return entries
+
+
+def _written(future):
+    if future.cancelled() or future.exception() is not None:
+        return 0
+    return future.result()
+
+
+class FolderIndexer(QObject):
+    # Builds thumbnails in a process pool. Only a few jobs are in flight at a
+    # time and paths the view asks for jump the queue, so whatever is on
+    # screen is decoded first. Paths already in the disk cache are never
+    # queued.
+    thumbnail_ready = pyqtSignal(str)
+    # Emitted from pool callback threads, delivered on the GUI thread
+    _finished = pyqtSignal(str, int, int)
+
+    def __init__(self, thumb_cache, parent=None):
+        super().__init__(parent)
+        self.thumb_cache = thumb_cache
+        self.workers = max(1, (os.cpu_count() or 2) - 1)
+        self.max_in_flight = self.workers * 2
+        self._pool = None
+        # Queued paths in the order they go out; both are OrderedDicts used
+        # as ordered sets, so moving a path to the front is O(1)
+        self._urgent = OrderedDict()
+        self._pending = OrderedDict()
+        self._in_flight = set()
+        self._done = {}
+        self._generation = 0
+        self._finished.connect(self._on_finished)
+
+    def indexed_count(self):
+        return len(self._done)
+
+    def reset(self):
+        self._generation += 1
+        self._urgent.clear()
+        self._pending.clear()
+        self._done.clear()
+
+    def forget(self, path):
+        self._done.pop(path, None)
+
+    def is_done(self, path, stamp):
+        return self._done.get(path) == stamp
+
+    def enqueue(self, path, stamp, urgent=False):
+        if self.is_done(path, stamp) or path in self._in_flight:
+            return
+        queued = path in self._urgent or path in self._pending
+        if queued and not urgent:
+            return
+        if not queued and self.thumb_cache.has_thumbnail(path):
+            self._done[path] = stamp
+            return
+        self._pending.pop(path, None)
+        if urgent:
+            # Latest request first
+            self._urgent[path] = None
+            self._urgent.move_to_end(path, last=False)
+        else:
+            self._pending[path] = None
+        self._pump()
+
+    def _pump(self):
+        if self._pool is None:
+            # Spawned workers never inherit the GUI process' Qt state
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        while (self._urgent or self._pending) and len(self._in_flight) < self.max_in_flight:
+            path, _ = (self._urgent or self._pending).popitem(last=False)
+            self._in_flight.add(path)
+            future = self._pool.submit(build_thumbnail, self.thumb_cache.cache_dir, path)
+            generation = self._generation
+            future.add_done_callback(lambda f, p=path, g=generation: self._finished.emit(p, g, _written(f)))
+
+    def _on_finished(self, path, generation, written):
+        self._in_flight.discard(path)
+        # Workers write straight to disk, so the cache only learns about the
+        # new files here; this is what keeps a big folder within its bound
+        if written:
+            self.thumb_cache.added(written)
+        if generation == self._generation:
+            try:
+                st = os.stat(path)
+                self._done[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+            self.thumbnail_ready.emit(path)
+        self._pump()
+
+    def shutdown(self):
+        self.reset()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        self._in_flight.clear()
+
+
+class FolderModel(QAbstractListModel):
+    # One row per image file. Thumbnails are only read when the view asks
+    # for a row's icon, which a uniform-size QListView only does for rows
+    # that are on screen.
+    def __init__(self, thumb_cache, indexer, parent=None):
+        super().__init__(parent)
+        self.thumb_cache = thumb_cache
+        self.indexer = indexer
+        self.paths = []
+        self.stamps = {}
+        self.icons = OrderedDict()
+        placeholder = QPixmap(ICON_SIZE, ICON_SIZE)
+        placeholder.fill(QColor(19, 19, 19))
+        self.placeholder = QIcon(placeholder)
+        indexer.thumbnail_ready.connect(self.on_thumbnail_ready)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.paths[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.ToolTipRole:
+            return path
+        if role == Qt.UserRole:
+            return path
+        if role == Qt.DecorationRole:
+            return self.icon(path)
+        return None
+
+    def icon(self, path):
+        cached = self.icons.get(path)
+        if cached is not None:
+            self.icons.move_to_end(path)
+            return cached
+        image = self.thumb_cache.thumbnail(path)
+        if image is None:
+            self.indexer.enqueue(path, self.stamps.get(path), urgent=True)
+            return self.placeholder
+        icon = QIcon(QPixmap.fromImage(image))
+        self.icons[path] = icon
+        while len(self.icons) > MAX_LOADED_ICONS:
+            self.icons.popitem(last=False)
+        return icon
+
+    def on_thumbnail_ready(self, path):
+        i = bisect.bisect_left(self.paths, path)
+        if i < len(self.paths) and self.paths[i] == path:
+            self.icons.pop(path, None)
+            index = self.index(i)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def update_entries(self, entries):
+        # Applies a folder scan incrementally so the view keeps its scroll
+        # position: rows for deleted files are removed, new files inserted,
+        # and changed files get their thumbnail rebuilt.
+        if not self.paths:
+            self.beginResetModel()
+            self.paths = sorted(entries)
+            self.stamps = dict(entries)
+            self.endResetModel()
+            for path in self.paths:
+                self.indexer.enqueue(path, self.stamps[path])
+            return
+
+        for i in range(len(self.paths) - 1, -1, -1):
+            if self.paths[i] not in entries:
+                self.beginRemoveRows(QModelIndex(), i, i)
+                path = self.paths.pop(i)
+                self.stamps.pop(path, None)
+                self.icons.pop(path, None)
+                self.indexer.forget(path)
+                self.endRemoveRows()
+
+        for path in sorted(entries):
+            stamp = entries[path]
+            if path not in self.stamps:
+                i = bisect.bisect_left(self.paths, path)
+                self.beginInsertRows(QModelIndex(), i, i)
+                self.paths.insert(i, path)
+                self.stamps[path] = stamp
+                self.endInsertRows()
+            elif self.stamps[path] != stamp:
+                self.stamps[path] = stamp
+                self.icons.pop(path, None)
+                self.on_thumbnail_ready(path)
+            self.indexer.enqueue(path, stamp)
+
+    def clear(self):
+        self.beginResetModel()
+        self.paths = []
+        self.stamps = {}
+        self.icons.clear()
+        self.endResetModel()
+
+
+class FolderBrowserDialog(QDialog):
+    def __init__(self, parent, thumb_cache, open_callback, folder=None):
+        super().__init__(parent)
+        self.setWindowTitle("Browse Folder")
+        self.resize(820, 600)
+        self.set_titlebar_color(0x010101)
+
+        self.thumb_cache = thumb_cache
+        self.open_callback = open_callback
+        self.folder = None
+
+        self.indexer = FolderIndexer(thumb_cache, self)
+        self.indexer.thumbnail_ready.connect(lambda _: self.update_status())
+        self.model = FolderModel(thumb_cache, self.indexer, self)
+
+        layout = QVBoxLayout()
+        top = QHBoxLayout()
+        self.folder_label = QLabel("no folder")
+        choose_btn = QPushButton("> choose folder")
+        choose_btn.clicked.connect(self.choose_folder)
+        top.addWidget(choose_btn)
+        top.addWidget(self.folder_label, 1)
+        layout.addLayout(top)
+
+        self.view = QListView()
+        self.view.setViewMode(QListView.IconMode)
+        self.view.setResizeMode(QListView.Adjust)
+        self.view.setMovement(QListView.Static)
+        self.view.setUniformItemSizes(True)
+        self.view.setLayoutMode(QListView.Batched)
+        self.view.setBatchSize(256)
+        self.view.setIconSize(QSize(ICON_SIZE, ICON_SIZE))
+        self.view.setGridSize(QSize(ICON_SIZE + 24, ICON_SIZE + 40))
+        self.view.setWordWrap(True)
+        self.view.setModel(self.model)
+        self.view.doubleClicked.connect(self.on_double_clicked)
+        layout.addWidget(self.view)
+
+        self.status_label = QLabel("")
+        layout.addWidget(self.status_label)
+        self.setLayout(layout)
+
+        # Rescan when the folder changes on disk, batched with a short delay
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(lambda _: self.rescan_timer.start(500))
+        self.rescan_timer = QTimer(self)
+        self.rescan_timer.setSingleShot(True)
+        self.rescan_timer.timeout.connect(self.rescan)
+
+        if folder:
+            self.set_folder(folder)
+
+    def choose_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Choose Folder", self.folder or "")
+        if folder:
+            self.set_folder(folder)
+
+    def set_folder(self, folder):
+        if self.folder:
+            self.watcher.removePath(self.folder)
+        self.folder = folder
+        self.folder_label.setText(folder)
+        self.watcher.addPath(folder)
+        self.indexer.reset()
+        self.model.clear()
+        self.rescan()
+
+    def rescan(self):
+        if self.folder:
+            self.model.update_entries(list_images(self.folder))
+            self.update_status()
+
+    def update_status(self):
+        total = self.model.rowCount()
+        done = self.indexer.indexed_count()
+        self.status_label.setText(f"{total} images, {min(done, total)} indexed")
+
+    def on_double_clicked(self, index):
+        path = index.data(Qt.UserRole)
+        if path:
+            self.open_callback(path)
+
+    def done(self, result):
+        self.indexer.shutdown()
+        super().done(result)
+
+    def set_titlebar_color(self, color):
+        hwnd = int(self.winId())
+        color_ref = ctypes.c_uint(color)
+        ctypes.windll.dwmapi.DwmSetWindowAttribute(
+            hwnd,
+            DWMWA_CAPTION_COLOR,
+            ctypes.byref(color_ref),
+            ctypes.sizeof(color_ref)
+        )
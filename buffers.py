@@ -0,0 +1,211 @@
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtGui import QPixmap, QImage
+
+import derivatives
+from backend import xp_of, to_device, to_host, free_device_memory
+
+# Pixmaps that effects read from are converted to arrays once and kept,
+# keyed by QPixmap.cacheKey(), together with a device copy when the GPU is
+# used. Results are registered under the pixmap they were shown as, so the
+# next effect applied to that image skips the toImage/frombuffer round trip
+# and the host to device upload.
+MAX_RESIDENT = 4
+# Images an open effect dialog works from are held: they are never evicted,
+# so the source and its device copy stay put for the dialog's lifetime.
+
+# Working precision for effects. At 8 bits every result is rounded before
+# the next effect reads it, so chained effects band. The float depths keep
+# results unrounded on the same 0..255 scale, so kernels handle them alike;
+# only the canvas copy is quantized. Unrounded arrays are kept for the
+# newest MAX_PRECISE resident images, older ones fall back to their 8-bit
+# pixels.
+WORKING_DEPTHS = {"8-bit": np.uint8, "16-bit half": np.float16, "32-bit float": np.float32}
+MAX_PRECISE = 2
+
+_resident = OrderedDict()
+_held = {}
+_working = np.uint8
+
+
+def image_to_array(image):
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    return np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4)).copy()
+
+
+def pixmap_to_array(pixmap):
+    return image_to_array(pixmap.toImage())
+
+
+def array_to_image(arr):
+    arr = np.ascontiguousarray(to_host(arr), dtype=np.uint8)
+    H, W = arr.shape[:2]
+    return QImage(arr.data, W, H, W * 4, QImage.Format_ARGB32).copy()
+
+
+def array_to_pixmap(arr):
+    return QPixmap.fromImage(array_to_image(arr))
+
+
+def set_working_depth(name):
+    global _working
+    _working = WORKING_DEPTHS[name]
+
+
+def working_dtype():
+    return _working
+
+
+def quantize(arr):
+    # Working array -> the 8-bit pixels shown for it
+    xp = xp_of(arr)
+    if arr.dtype == xp.uint8:
+        return arr
+    out = xp.rint(arr.astype(xp.float32))
+    xp.clip(out, 0, 255, out=out)
+    return out.astype(xp.uint8)
+
+
+def _drop(entry, names):
+    for name in names:
+        arr = entry.pop(name, None)
+        if arr is not None:
+            derivatives.detach(arr)
+
+
+def _store(key, entry):
+    # Resident arrays carry their derivatives (luma, histograms, ...) and
+    # drop them when they are evicted
+    for arr in entry.values():
+        derivatives.attach(arr)
+    _resident[key] = entry
+    _resident.move_to_end(key)
+    evictable = [k for k in _resident if k not in _held and k != key]
+    for k in evictable[:max(0, len(_resident) - MAX_RESIDENT)]:
+        evicted = _resident.pop(k)
+        _drop(evicted, list(evicted))
+    for old in [k for k in _resident if k not in _held][:-MAX_PRECISE]:
+        _drop(_resident[old], ("precise", "precise_device"))
+
+
+def hold(pixmap):
+    key = pixmap.cacheKey()
+    _held[key] = _held.get(key, 0) + 1
+
+
+def release(pixmap):
+    key = pixmap.cacheKey()
+    if _held.get(key, 0) > 1:
+        _held[key] -= 1
+    else:
+        _held.pop(key, None)
+
+
+def _upload(entry, name, host, xp):
+    # Device copy of host kept in entry[name]. When the device cap is hit,
+    # the other images' device copies are dropped and it is tried again.
+    if name not in entry:
+        try:
+            entry[name] = to_device(host, xp)
+        except MemoryError:
+            for other in _resident.values():
+                if other is not entry:
+                    _drop(other, ("device", "precise_device"))
+            free_device_memory()
+            entry[name] = to_device(host, xp)
+        derivatives.attach(entry[name])
+    return entry[name]
+
+
+def _entry(pixmap):
+    key = pixmap.cacheKey()
+    entry = _resident.get(key)
+    if entry is None:
+        entry = {"host": pixmap_to_array(pixmap)}
+        _store(key, entry)
+    _resident.move_to_end(key)
+    return entry
+
+
+def source_array(pixmap, xp=None):
+    # Read-only source for an effect, on the host or the given device
+    entry = _entry(pixmap)
+    if xp is None or xp is np:
+        return entry["host"]
+    return _upload(entry, "device", entry["host"], xp)
+
+
+def peek_array(pixmap):
+    # Host pixels for a one-off read: the resident array if there is one,
+    # else a copy that isn't kept, so the LRU is neither filled nor reordered
+    entry = _resident.get(pixmap.cacheKey())
+    if entry is not None:
+        return entry["host"]
+    return pixmap_to_array(pixmap)
+
+
+def working_array(pixmap, xp=None):
+    # Source for an effect at the working depth: the unrounded result the
+    # pixmap was shown from if it is still kept, else its 8-bit pixels
+    if _working is np.uint8:
+        return source_array(pixmap, xp)
+    entry = _entry(pixmap)
+    precise = entry.get("precise")
+    if precise is None or precise.dtype != _working:
+        _drop(entry, ("precise", "precise_device"))
+        precise = entry["host"].astype(_working)
+        entry["precise"] = precise
+        derivatives.attach(precise)
+    if xp is None or xp is np:
+        return precise
+    return _upload(entry, "precise_device", precise, xp)
+
+
+def reduced_array(pixmap, step, xp=None):
+    # Every step-th pixel of the working array, for coarse previews. Kept
+    # with the image's other arrays and dropped with them.
+    src = working_array(pixmap, xp)
+    entry = _entry(pixmap)
+    name = f"reduced{step}" if xp is None or xp is np else f"reduced{step}_device"
+    reduced = entry.get(name)
+    if reduced is None or reduced.dtype != src.dtype:
+        _drop(entry, (name,))
+        reduced = xp_of(src).ascontiguousarray(src[::step, ::step])
+        entry[name] = reduced
+        derivatives.attach(reduced)
+    return reduced
+
+
+def remember(pixmap, arr):
+    key = pixmap.cacheKey()
+    host = to_host(arr)
+    if host.dtype == np.uint8:
+        entry = {"host": host}
+        if arr is not host:
+            entry["device"] = arr
+    else:
+        entry = {"host": quantize(host), "precise": host}
+        if arr is not host:
+            entry["precise_device"] = arr
+    _store(key, entry)
+
+
+def precise_array(pixmap):
+    # The unrounded array a pixmap was shown from, None if not kept
+    entry = _resident.get(pixmap.cacheKey())
+    return entry.get("precise") if entry is not None else None
+
+
+def show_array(arr):
+    # Pixmap for a result, registered so a later effect can reuse the array
+    pixmap = array_to_pixmap(quantize(arr))
+    remember(pixmap, arr)
+    return pixmap
+
+
+def derived(pixmap, xp=None):
+    # Derivatives of a pixmap's resident array
+    return derivatives.of(source_array(pixmap, xp))
@@ -0,0 +1,89 @@
+import numpy as np
+from PyQt5.QtGui import QImage, QColorSpace
+
+from backend import xp_of
+
+# Colour management. The working space is sRGB: files with an embedded
+# profile are converted into it as they are decoded, and the linear-light
+# options of the effects go through its transfer curve. Both are table
+# driven. Qt's colour transforms precompute the profile's curves as lookup
+# tables; one is built per distinct profile and kept. The linear-light
+# tables below do the same for arrays, so no pixel goes through a power
+# function.
+
+SRGB = QColorSpace(QColorSpace.SRgb)
+
+# Encoded values per 8-bit level in the decode table: whole levels land on
+# exact entries and float working values on the nearest 1/64 of a level
+DECODE_STEPS = 64
+# Entries across linear 0..1 in the encode table. Near black sRGB's slope
+# is 12.92, which still keeps neighbouring entries 0.05 levels apart.
+ENCODE_SIZE = 1 << 16
+
+_transforms = {}
+_device_tables = {}
+
+
+def transform_for(space):
+    # Cached transform from space to sRGB, keyed by the profile itself so
+    # images from the same camera or export share one
+    key = bytes(space.iccProfile()) or (space.primaries(), space.transferFunction(), space.gamma())
+    transform = _transforms.get(key)
+    if transform is None:
+        transform = space.transformationToColorSpace(SRGB)
+        _transforms[key] = transform
+    return transform
+
+
+def to_working(image):
+    # Decoded image -> the same colours in working sRGB. Untagged and sRGB
+    # images come back as they are.
+    if image.isNull():
+        return image
+    space = image.colorSpace()
+    if not space.isValid() or space == SRGB:
+        return image
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    image.applyColorTransform(transform_for(space))
+    image.setColorSpace(SRGB)
+    return image
+
+
+def load(path):
+    return to_working(QImage(path))
+
+
+def _srgb_decode(v):
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+
+def _srgb_encode(v):
+    return np.where(v <= 0.0031308, v * 12.92, 1.055 * v ** (1 / 2.4) - 0.055)
+
+
+# Working sRGB <-> linear light, both on the kernels' 0..255 float scale
+SRGB_DECODE = (_srgb_decode(np.arange(255 * DECODE_STEPS + 1) / (255 * DECODE_STEPS)) * 255).astype(np.float32)
+SRGB_ENCODE = (_srgb_encode(np.linspace(0.0, 1.0, ENCODE_SIZE)) * 255).astype(np.float32)
+
+
+def tables(xp):
+    # (decode, encode) tables on the array module xp
+    tables = _device_tables.get(xp)
+    if tables is None:
+        tables = (xp.asarray(SRGB_DECODE), xp.asarray(SRGB_ENCODE))
+        _device_tables[xp] = tables
+    return tables
+
+
+def to_linear(values):
+    xp = xp_of(values)
+    idx = xp.rint(values * DECODE_STEPS)
+    xp.clip(idx, 0, 255 * DECODE_STEPS, out=idx)
+    return tables(xp)[0][idx.astype(xp.int32)]
+
+
+def from_linear(values):
+    xp = xp_of(values)
+    idx = xp.rint(values * ((ENCODE_SIZE - 1) / 255.0))
+    xp.clip(idx, 0, ENCODE_SIZE - 1, out=idx)
+    return tables(xp)[1][idx.astype(xp.int32)]
@@ -0,0 +1,144 @@
+import numpy as np
+
+import jpeg
+from backend import xp_of
+from bands import run_bands, band_rows
+
+# Planes derived from an image that several effects and the colour picker
+# need: luma, RGB mean, HSV, histograms, a summed-area table and JPEG DCT
+# coefficients. They are computed on first use and kept with the image's
+# array. Arrays are never edited in place (every edit makes a new pixmap
+# and array), so an image's derivatives stay valid until the array itself
+# is dropped.
+
+LUMA_B, LUMA_G, LUMA_R = 0.114, 0.587, 0.299
+
+_attached = {}
+
+
+class Derivatives:
+    def __init__(self, arr):
+        self.arr = arr
+        self.xp = xp_of(arr)
+        self._planes = {}
+
+    def _memo(self, name, compute):
+        plane = self._planes.get(name)
+        if plane is None:
+            plane = compute()
+            self._planes[name] = plane
+        return plane
+
+    def luma(self):
+        # Rec. 601 luma as float32, the grey every effect uses. On the host
+        # it is filled in row bands, so the per-channel temporaries stay
+        # band-sized.
+        def plane(a):
+            if a.dtype == self.xp.float16:
+                a = a.astype(self.xp.float32)
+            return (LUMA_R * a[..., 2] + LUMA_G * a[..., 1] + LUMA_B * a[..., 0]).astype(self.xp.float32)
+
+        def compute():
+            a = self.arr
+            if self.xp is not np:
+                return plane(a)
+            H, W = a.shape[:2]
+            out = np.empty((H, W), np.float32)
+
+            def band(y0, y1):
+                out[y0:y1] = plane(a[y0:y1])
+            run_bands(band, H, band_rows(W))
+            return out
+        return self._memo("luma", compute)
+
+    def channel_sum(self):
+        def compute():
+            xp = self.xp
+            acc = xp.uint16 if self.arr.dtype == xp.uint8 else xp.float32
+            return self.arr[..., :3].sum(axis=2, dtype=acc)
+        return self._memo("channel_sum", compute)
+
+    def brightness(self):
+        # Plain mean of R, G and B
+        return self._memo("brightness", lambda: self.channel_sum() / self.xp.float32(3.0))
+
+    def hsv(self):
+        # (H, W, 3) float32: hue in degrees, saturation and value in 0..1
+        def compute():
+            xp = self.xp
+            rgb = self.arr[..., 2::-1].astype(xp.float32) / 255.0
+            r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+            v = rgb.max(axis=2)
+            c = v - rgb.min(axis=2)
+            safe_c = xp.where(c > 0, c, 1.0)
+            h = xp.where(v == r, ((g - b) / safe_c) % 6.0,
+                         xp.where(v == g, (b - r) / safe_c + 2.0, (r - g) / safe_c + 4.0))
+            h = xp.where(c > 0, h * 60.0, 0.0)
+            s = xp.where(v > 0, c / xp.where(v > 0, v, 1.0), 0.0)
+            return xp.stack([h, s, v], axis=2).astype(xp.float32)
+        return self._memo("hsv", compute)
+
+    def histograms(self):
+        # (4, 256) counts for R, G, B and luma
+        def compute():
+            xp = self.xp
+            a = self.arr
+            planes = [a[..., 2], a[..., 1], a[..., 0], xp.clip(self.luma(), 0, 255).astype(xp.uint8)]
+            return xp.stack([xp.bincount(p.ravel(), minlength=256) for p in planes])
+        return self._memo("histograms", compute)
+
+    def integral(self):
+        # Summed-area table of the R+G+B plane with a zero first row and
+        # column. For 8-bit images it is uint32 and allowed to wrap:
+        # differences of wrapped sums are still exact for any box whose true
+        # sum fits in 32 bits, which holds for boxes up to about 5.6 million
+        # pixels. Float images get a float64 table.
+        def compute():
+            xp = self.xp
+            H, W = self.arr.shape[:2]
+            acc = xp.uint32 if self.arr.dtype == xp.uint8 else xp.float64
+            table = xp.zeros((H + 1, W + 1), dtype=acc)
+            table[1:, 1:] = self.channel_sum()
+            xp.cumsum(table, axis=0, dtype=acc, out=table)
+            xp.cumsum(table, axis=1, dtype=acc, out=table)
+            return table
+        return self._memo("integral", compute)
+
+    def block_means(self, size, y0=0, x0=0, rows=None, cols=None):
+        # Mean brightness of size x size blocks tiled from (y0, x0)
+        xp = self.xp
+        H, W = self.arr.shape[:2]
+        if rows is None:
+            rows = (H - y0) // size
+        if cols is None:
+            cols = (W - x0) // size
+        table = self.integral()
+        ys = y0 + xp.arange(rows + 1) * size
+        xs = x0 + xp.arange(cols + 1) * size
+        corners = table[ys[:, None], xs[None, :]]
+        sums = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        return sums.astype(xp.float64) / (3.0 * size * size)
+
+    def dct(self, subsampling="4:2:0"):
+        # Unquantized JPEG coefficients, so a quality change only requantizes
+        return self._memo("dct " + subsampling, lambda: jpeg.forward(self.arr, subsampling))
+
+
+def attach(arr):
+    # Keeps derivatives for arr until it is detached; used for the shared
+    # source arrays that buffers.py holds
+    _attached[id(arr)] = Derivatives(arr)
+
+
+def detach(arr):
+    d = _attached.get(id(arr))
+    if d is not None and d.arr is arr:
+        del _attached[id(arr)]
+
+
+def of(arr):
+    # Derivatives of an attached array, or a throwaway set for any other
+    d = _attached.get(id(arr))
+    if d is not None and d.arr is arr:
+        return d
+    return Derivatives(arr)
@@ -1,8 +1,5 @@
-import sys
 import os
-import numpy as np
 import ctypes
-import cupy as cp
 
 from PyQt5.QtWidgets import (
     QVBoxLayout,
@@ -13,26 +10,37 @@ from PyQt5.QtWidgets import (
     QSlider,
     QComboBox,
     QPushButton,
-    QColorDialog
+    QColorDialog,
+    QCheckBox
 )
-from PyQt5.QtGui import QPixmap, QImage, QColor, QPainter, QTransform
+from PyQt5.QtGui import QColor
 from PyQt5 import QtGui
-from PyQt5.QtCore import Qt, QBuffer, QIODevice, QTimer, pyqtSignal
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+
+import buffers
+import kernels
+import previews
+from backend import get_xp, device_memory
+from jpeg import SUBSAMPLING
+from pixelate import CELL_SHAPES, CELL_STATS
 
 DWMWA_USE_IMMERSIVE_DARK_MODE = 20
 DWMWA_CAPTION_COLOR = 35
 DWMWA_TEXT_COLOR = 36
 
 class CompressionDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_quality=10):
+    effect_name = "compression"
+
+    def __init__(self, parent, original_image, apply_callback, default_quality=10, selection=None):
         super().__init__(parent)
 
         self.setWindowTitle("JPEG Compression")
-        self.setFixedSize(320, 180)
+        self.setFixedSize(320, 300)
         self.set_titlebar_color(0x010101)
 
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
 
         layout = QVBoxLayout()
 
@@ -44,6 +52,19 @@ class CompressionDialog(QDialog):
         layout.addWidget(QLabel("JPEG Quality (1-100):"))
         layout.addWidget(self.slider)
 
+        self.subsampling_combo = QComboBox()
+        self.subsampling_combo.addItems(SUBSAMPLING)
+        layout.addWidget(QLabel("Chroma Subsampling:"))
+        layout.addWidget(self.subsampling_combo)
+
+        self.generations_slider = QSlider(Qt.Horizontal)
+        self.generations_slider.setMinimum(1)
+        self.generations_slider.setMaximum(30)
+        self.generations_slider.setValue(1)
+        self.generations_label = QLabel("Generations: 1")
+        layout.addWidget(self.generations_label)
+        layout.addWidget(self.generations_slider)
+
         buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
 
         layout.addWidget(buttons)
@@ -51,31 +72,65 @@ class CompressionDialog(QDialog):
         self.setLayout(layout)
 
         self.slider.valueChanged.connect(self.on_slider_changed)
+        self.subsampling_combo.currentIndexChanged.connect(self.apply_current)
+        self.generations_slider.valueChanged.connect(self.on_generations_changed)
 
         buttons.accepted.connect(self.accept)
         buttons.rejected.connect(self.reject)
         
         self._last_pixmap = original_image
+        self.progressive = previews.Progressive(original_image, self.effect_name, selection, self.show_stage, self)
 
         # Debounce timer
         self.timer = QTimer(self)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.apply_current)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.timeout.connect(self.prefetch)
 
     def on_slider_changed(self, value):
         self.timer.start(100)
 
+    def on_generations_changed(self, value):
+        self.generations_label.setText(f"Generations: {value}")
+        self.timer.start(100)
+
+    def get_params(self):
+        return {
+            "quality": self.slider.value(),
+            "subsampling": self.subsampling_combo.currentText(),
+            "generations": self.generations_slider.value(),
+        }
+
+    def set_params(self, params):
+        self.slider.setValue(params.get("quality", self.slider.value()))
+        self.subsampling_combo.setCurrentText(params.get("subsampling", self.subsampling_combo.currentText()))
+        self.generations_slider.setValue(params.get("generations", self.generations_slider.value()))
+
+    def neighbour_params(self):
+        return previews.neighbours(self.get_params(), "quality", self.slider)
+
     def apply_current(self):
-        value = self.slider.value()
-        image = self.original_image.toImage()
-        buffer = QBuffer()
-        buffer.open(QIODevice.ReadWrite)
-        image.save(buffer, "JPEG", quality=value)
-        ba = buffer.data()
-        qimg = QImage.fromData(ba, "JPEG")
-        pixmap = QPixmap.fromImage(qimg)
-        self._last_pixmap = pixmap
-        self.apply_callback(pixmap)
+        self.progressive.request(self.get_params())
+
+    def show_stage(self, pixmap, step):
+        # Coarse stages are only shown, the full-size result is what OK applies
+        if step == 1:
+            self._last_pixmap = pixmap
+            self.prefetch_timer.start(previews.PREFETCH_DELAY)
+        self.apply_callback(pixmap, step)
+
+    def prefetch(self):
+        previews.prefetch(self.original_image, self.effect_name, self.neighbour_params(), self.selection)
+
+    def done(self, result):
+        self.prefetch_timer.stop()
+        if result == QDialog.Accepted:
+            self.progressive.finish()
+        self.progressive.cancel()
+        previews.cancel()
+        super().done(result)
 
     def get_pixmap(self):
         return self._last_pixmap
@@ -91,12 +146,17 @@ class CompressionDialog(QDialog):
         )
 
 class DitherDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_threshold=50):
+    effect_name = "dither"
+
+    def __init__(self, parent, original_image, apply_callback, default_threshold=50, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Dither Effect")
         self.setFixedSize(360, 240)
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
+        # Fixed per dialog so the preview doesn't flicker between updates
+        self.seed = int.from_bytes(os.urandom(4), "little")
 
         layout = QVBoxLayout()
 
@@ -127,11 +187,15 @@ class DitherDialog(QDialog):
         buttons.rejected.connect(self.reject)
 
         self._last_pixmap = original_image
+        self.progressive = previews.Progressive(original_image, self.effect_name, selection, self.show_stage, self)
 
         # Debounce timer for preview
         self.timer = QTimer(self)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.apply_current)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.timeout.connect(self.prefetch)
 
         # Preview immediately
         self.apply_current()
@@ -140,66 +204,41 @@ class DitherDialog(QDialog):
         self.threshold_label.setText(f"Threshold: {self.slider.value()}%")
         self.timer.start(200)
 
-    def apply_current(self):
-        method = self.method_combo.currentText()
-        value = self.slider.value()
-        img = self.original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        ptr = img.bits()
-        ptr.setsize(img.byteCount())
-        arr = np.frombuffer(ptr, np.uint8).reshape((img.height(), img.width(), 4))
-
-        gray = (0.299*arr[..., 2] + 0.587*arr[..., 1] + 0.114*arr[..., 0]).astype(np.int16)
-        threshold = int(255 * value / 100)
-
-        # Apply threshold as a “contrast cutoff”: pixels below threshold are forced black
-        below_thresh_mask = gray < threshold
-        gray_above = gray.copy()
-        gray_above[below_thresh_mask] = threshold  # pixels below threshold set to threshold
-
-        if method == "Threshold":
-            dithered = np.where(gray < threshold, 0, 255)
-        elif method == "Floyd-Steinberg":
-            dithered = np.zeros_like(gray)
-            err = np.zeros_like(gray, dtype=np.int16)
-            h, w = gray.shape
-            for y in range(h):
-                old_row = gray_above[y] + err[y]
-                new_row = np.where(old_row < threshold, 0, 255)
-                dithered[y] = new_row
-                quant_error = old_row - new_row
-                if y+1 < h:
-                    err[y+1,:-1] += (quant_error[1:] * 3) // 16
-                    err[y+1] += (quant_error * 5) // 16
-                    err[y+1,1:] += (quant_error[:-1] * 1) // 16
-                if w > 1:
-                    err[y,1:] += (quant_error[:-1] * 7) // 16
-        elif method == "Bayer/Ordered":
-            # 4x4 Bayer matrix
-            bayer = np.array([
-                [0,  8,  2, 10],
-                [12, 4, 14, 6],
-                [3, 11, 1,  9],
-                [15, 7, 13, 5]
-            ]) / 16 * 255
-            H, W = gray.shape
-            tiled = np.tile(bayer, (H//4+1, W//4+1))[:H, :W]
-            dithered = np.where(gray_above > tiled, 255, 0)
-        elif method == "Random":
-            noise = np.random.randint(0, 256, gray.shape)
-            dithered = np.where(gray_above > noise, 255, 0)
-        else:
-            dithered = gray
+    def get_params(self):
+        return {
+            "method": self.method_combo.currentText(),
+            "threshold": self.slider.value(),
+            "seed": self.seed,
+        }
 
-        # Force below-threshold pixels to black
-        dithered[below_thresh_mask] = 0
+    def set_params(self, params):
+        # The seed stays the dialog's own, a restored pattern would repeat
+        self.method_combo.setCurrentText(params.get("method", self.method_combo.currentText()))
+        self.slider.setValue(params.get("threshold", self.slider.value()))
 
-        arr[..., 0] = dithered
-        arr[..., 1] = dithered
-        arr[..., 2] = dithered
+    def neighbour_params(self):
+        return previews.neighbours(self.get_params(), "threshold", self.slider)
 
-        pixmap = QPixmap.fromImage(img)
-        self._last_pixmap = pixmap
-        self.apply_callback(pixmap)
+    def apply_current(self):
+        self.progressive.request(self.get_params())
+
+    def show_stage(self, pixmap, step):
+        # Coarse stages are only shown, the full-size result is what OK applies
+        if step == 1:
+            self._last_pixmap = pixmap
+            self.prefetch_timer.start(previews.PREFETCH_DELAY)
+        self.apply_callback(pixmap, step)
+
+    def prefetch(self):
+        previews.prefetch(self.original_image, self.effect_name, self.neighbour_params(), self.selection)
+
+    def done(self, result):
+        self.prefetch_timer.stop()
+        if result == QDialog.Accepted:
+            self.progressive.finish()
+        self.progressive.cancel()
+        previews.cancel()
+        super().done(result)
 
     def get_pixmap(self):
         return self._last_pixmap
@@ -215,13 +254,16 @@ class DitherDialog(QDialog):
         )
 
 class SaturationDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_saturation=100):
+    effect_name = "saturation"
+
+    def __init__(self, parent, original_image, apply_callback, default_saturation=100, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Saturation Effect")
-        self.setFixedSize(320, 180)
+        self.setFixedSize(320, 210)
         self.set_titlebar_color(0x010101)
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
         layout = QVBoxLayout()
         self.slider = QSlider(Qt.Horizontal)
         self.slider.setMinimum(0)
@@ -230,10 +272,14 @@ class SaturationDialog(QDialog):
         self.sat_label = QLabel(f"Saturation: {default_saturation}%")
         layout.addWidget(self.sat_label)
         layout.addWidget(self.slider)
+        # Mixes towards grey in linear light, which keeps brightness steadier
+        self.linear_check = QCheckBox("linear light")
+        layout.addWidget(self.linear_check)
         buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         layout.addWidget(buttons)
         self.setLayout(layout)
         self.slider.valueChanged.connect(self.on_slider_changed)
+        self.linear_check.toggled.connect(lambda: self.timer.start(300))
         buttons.accepted.connect(self.accept)
         buttons.rejected.connect(self.reject)
         self._last_pixmap = original_image
@@ -249,58 +295,23 @@ class SaturationDialog(QDialog):
         self.sat_label.setText(f"Saturation: {self.slider.value()}%")
         self.timer.start(500)
 
+    def get_params(self):
+        params = {"saturation": self.slider.value()}
+        if self.linear_check.isChecked():
+            params["linear"] = True
+        return params
+
+    def set_params(self, params):
+        self.slider.setValue(params.get("saturation", self.slider.value()))
+        self.linear_check.setChecked(params.get("linear", False))
+
     def apply_current(self):
-        value = self.slider.value()
-        original_image = self.original_image
-        image = original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        # Try GPU-accelerated saturation adjustment using QPainter and ColorMatrix
-        try:
-            factor = value / 100.0
-            result_img = QImage(image.size(), QImage.Format_ARGB32)
-            result_img.fill(Qt.transparent)
-            painter = QPainter(result_img)
-            # Color matrix for saturation
-            s = factor
-            # Luminance coefficients
-            lr, lg, lb = 0.299, 0.587, 0.114
-            matrix = [
-                lr*(1-s)+s, lg*(1-s),     lb*(1-s),     0, 0,
-                lr*(1-s),   lg*(1-s)+s,   lb*(1-s),     0, 0,
-                lr*(1-s),   lg*(1-s),     lb*(1-s)+s,   0, 0,
-                0,          0,            0,            1, 0
-            ]
-            color_transform = QTransform(
-                matrix[0], matrix[1], matrix[2],
-                matrix[5], matrix[6], matrix[7],
-                matrix[10], matrix[11], matrix[12]
-            )
-            # QPainter doesn't support color matrix directly, so fallback to numpy if needed
-            painter.drawImage(0, 0, image)
-            painter.end()
-            arr = np.frombuffer(result_img.bits(), np.uint8).reshape((result_img.height(), result_img.width(), 4))
-            # Apply saturation using numpy for each pixel
-            r = arr[..., 2].astype(np.float32)
-            g = arr[..., 1].astype(np.float32)
-            b = arr[..., 0].astype(np.float32)
-            gray = lr * r + lg * g + lb * b
-            arr[..., 2] = np.clip(gray + s * (r - gray), 0, 255).astype(np.uint8)
-            arr[..., 1] = np.clip(gray + s * (g - gray), 0, 255).astype(np.uint8)
-            arr[..., 0] = np.clip(gray + s * (b - gray), 0, 255).astype(np.uint8)
-            pixmap = QPixmap.fromImage(result_img)
-        except Exception:
-            # Fallback to numpy only
-            ptr = image.bits()
-            ptr.setsize(image.byteCount())
-            arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-            r = arr[..., 2].astype(np.float32)
-            g = arr[..., 1].astype(np.float32)
-            b = arr[..., 0].astype(np.float32)
-            gray = 0.299 * r + 0.587 * g + 0.114 * b
-            s = value / 100.0
-            arr[..., 2] = np.clip(gray + s * (r - gray), 0, 255).astype(np.uint8)
-            arr[..., 1] = np.clip(gray + s * (g - gray), 0, 255).astype(np.uint8)
-            arr[..., 0] = np.clip(gray + s * (b - gray), 0, 255).astype(np.uint8)
-            pixmap = QPixmap.fromImage(image)
+        xp = get_xp()
+        src = buffers.working_array(self.original_image, xp)
+        if self.selection is None:
+            pixmap = buffers.show_array(kernels.apply(self.effect_name, src, **self.get_params()))
+        else:
+            pixmap = self.selection.apply(self.original_image, src, self.effect_name, self.get_params())
         self._last_pixmap = pixmap
         self.apply_callback(pixmap)
 
@@ -318,13 +329,16 @@ class SaturationDialog(QDialog):
         )
 
 class ScanlinesDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_intensity=50, default_thickness=2):
+    effect_name = "scanlines"
+
+    def __init__(self, parent, original_image, apply_callback, default_intensity=50, default_thickness=2, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Scanlines Effect")
         self.setFixedSize(320, 180)
         self.set_titlebar_color(0x010101)
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
         layout = QVBoxLayout()
         self.intensity_slider = QSlider(Qt.Horizontal)
         self.intensity_slider.setMinimum(0)
@@ -359,21 +373,23 @@ class ScanlinesDialog(QDialog):
         self.thickness_label.setText(f"Thickness: {self.thickness_slider.value()}px")
         self.timer.start(100)
 
+    def get_params(self):
+        return {
+            "intensity": self.intensity_slider.value(),
+            "thickness": self.thickness_slider.value(),
+        }
+
+    def set_params(self, params):
+        self.intensity_slider.setValue(params.get("intensity", self.intensity_slider.value()))
+        self.thickness_slider.setValue(params.get("thickness", self.thickness_slider.value()))
+
     def apply_current(self):
-        intensity = self.intensity_slider.value()
-        thickness = self.thickness_slider.value()
-        original_image = self.original_image
-        image = original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        # Only add scanlines (draw black lines)
-        painter = QPainter(image)
-        pen = QColor(0, 0, 0, int(255 * intensity / 100))
-        painter.setPen(pen)
-        for y in range(0, image.height(), thickness * 2):
-            for t in range(thickness):
-                if y + t < image.height():
-                    painter.drawLine(0, y + t, image.width(), y + t)
-        painter.end()
-        pixmap = QPixmap.fromImage(image)
+        xp = get_xp()
+        src = buffers.working_array(self.original_image, xp)
+        if self.selection is None:
+            pixmap = buffers.show_array(kernels.apply(self.effect_name, src, **self.get_params()))
+        else:
+            pixmap = self.selection.apply(self.original_image, src, self.effect_name, self.get_params())
         self._last_pixmap = pixmap
         self.apply_callback(pixmap)
 
@@ -391,13 +407,18 @@ class ScanlinesDialog(QDialog):
         )
 
 class NoiseDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_amount=20):
+    effect_name = "noise"
+
+    def __init__(self, parent, original_image, apply_callback, default_amount=20, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Noise Effect")
         self.setFixedSize(320, 180)
         self.set_titlebar_color(0x010101)
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
+        # Fixed per dialog so the preview doesn't flicker between updates
+        self.seed = int.from_bytes(os.urandom(4), "little")
         layout = QVBoxLayout()
         self.amount_slider = QSlider(Qt.Horizontal)
         self.amount_slider.setMinimum(0)
@@ -423,17 +444,19 @@ class NoiseDialog(QDialog):
         self.amount_label.setText(f"Noise Amount: {self.amount_slider.value()}%")
         self.timer.start(100)
 
+    def get_params(self):
+        return {"amount": self.amount_slider.value(), "seed": self.seed}
+
+    def set_params(self, params):
+        self.amount_slider.setValue(params.get("amount", self.amount_slider.value()))
+
     def apply_current(self):
-        amount = self.amount_slider.value()
-        original_image = self.original_image
-        image = original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        ptr = image.bits()
-        ptr.setsize(image.byteCount())
-        arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-        max_noise = int(128 * amount / 100)
-        noise = np.random.randint(-max_noise, max_noise+1, arr[..., 0:3].shape, dtype=np.int16)
-        arr[..., 0:3] = np.clip(arr[..., 0:3] + noise, 0, 255).astype(np.uint8)
-        pixmap = QPixmap.fromImage(image)
+        xp = get_xp()
+        src = buffers.working_array(self.original_image, xp)
+        if self.selection is None:
+            pixmap = buffers.show_array(kernels.apply(self.effect_name, src, **self.get_params()))
+        else:
+            pixmap = self.selection.apply(self.original_image, src, self.effect_name, self.get_params())
         self._last_pixmap = pixmap
         self.apply_callback(pixmap)
 
@@ -451,13 +474,16 @@ class NoiseDialog(QDialog):
         )
 
 class HalftoneDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_dot_size=6):
+    effect_name = "halftone"
+
+    def __init__(self, parent, original_image, apply_callback, default_dot_size=6, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Halftone Effect")
         self.setFixedSize(340, 180)
         self.set_titlebar_color(0x010101)
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
         layout = QVBoxLayout()
         self.dot_edit = QLineEdit(str(default_dot_size))
         self.dot_edit.setValidator(QtGui.QIntValidator(2, 512))
@@ -471,6 +497,7 @@ class HalftoneDialog(QDialog):
         buttons.accepted.connect(self.accept)
         buttons.rejected.connect(self.reject)
         self._last_pixmap = original_image
+        self.progressive = previews.Progressive(original_image, self.effect_name, selection, self.show_stage, self)
         self.timer = QTimer(self)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.apply_current)
@@ -485,55 +512,31 @@ class HalftoneDialog(QDialog):
             self.dot_label.setText("Dot Size: ?px")
         self.timer.start(100)
 
-    def apply_current(self):
+    def get_params(self):
         try:
             dot_size = int(self.dot_edit.text())
         except Exception:
             dot_size = 8
+        return {"dot_size": dot_size}
 
-        original_image = self.original_image
-        image = original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        ptr = image.bits()
-        ptr.setsize(image.byteCount())
-        arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-        H, W = arr.shape[:2]
-
-        # Vectorized mean grayscale over blocks
-        if dot_size > 0:
-            reshaped = arr[:H - H % dot_size, :W - W % dot_size, :3] \
-                .reshape(H // dot_size, dot_size, W // dot_size, dot_size, 3)
-            gray_vals = reshaped.mean(axis=(1, 3)).mean(axis=-1)
-        else:
-            reshaped = arr[:H, :W, :3] \
-                .reshape(H, 1, W, 1, 3)
-            gray_vals = reshaped.mean(axis=(1, 3)).mean(axis=-1)
-
-        # Convert grayscale to radius
-        radius = (gray_vals / 255.0 * (dot_size // 2)).astype(np.int32)
-
-        # Draw with painter
-        result_img = QImage(W, H, QImage.Format_ARGB32)
-        result_img.fill(Qt.black)
-        painter = QPainter(result_img)
-        painter.setRenderHint(QPainter.Antialiasing, True)
-
-        for by in range(radius.shape[0]):
-            for bx in range(radius.shape[1]):
-                r = radius[by, bx]
-                if r > 0:
-                    cx = bx * dot_size + dot_size // 2
-                    cy = by * dot_size + dot_size // 2
-                    g = int(gray_vals[by, bx])
-                    painter.setBrush(QColor(g, g, g))
-                    painter.setPen(Qt.NoPen)
-                    painter.drawEllipse(cx - r, cy - r, r * 2, r * 2)
-
-
-        painter.end()
-        pixmap = QPixmap.fromImage(result_img)
-        self._last_pixmap = pixmap
-        self.apply_callback(pixmap)
+    def set_params(self, params):
+        if "dot_size" in params:
+            self.dot_edit.setText(str(params["dot_size"]))
 
+    def apply_current(self):
+        self.progressive.request(self.get_params())
+
+    def show_stage(self, pixmap, step):
+        # Coarse stages are only shown, the full-size result is what OK applies
+        if step == 1:
+            self._last_pixmap = pixmap
+        self.apply_callback(pixmap, step)
+
+    def done(self, result):
+        if result == QDialog.Accepted:
+            self.progressive.finish()
+        self.progressive.cancel()
+        super().done(result)
 
     def get_pixmap(self):
         return self._last_pixmap
@@ -549,14 +552,25 @@ class HalftoneDialog(QDialog):
         )
 
 class PixelateDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_blocksize=8):
+    effect_name = "pixelate"
+
+    def __init__(self, parent, original_image, apply_callback, default_blocksize=8, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Pixelate Effect")
-        self.setFixedSize(320, 180)
+        self.setFixedSize(320, 300)
         self.set_titlebar_color(0x010101)
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
         layout = QVBoxLayout()
+        self.shape_combo = QComboBox()
+        self.shape_combo.addItems(CELL_SHAPES)
+        layout.addWidget(QLabel("Cell Shape:"))
+        layout.addWidget(self.shape_combo)
+        self.stat_combo = QComboBox()
+        self.stat_combo.addItems(CELL_STATS)
+        layout.addWidget(QLabel("Cell Colour:"))
+        layout.addWidget(self.stat_combo)
         self.slider = QSlider(Qt.Horizontal)
         self.slider.setMinimum(2)
         self.slider.setMaximum(128)
@@ -568,12 +582,18 @@ class PixelateDialog(QDialog):
         layout.addWidget(buttons)
         self.setLayout(layout)
         self.slider.valueChanged.connect(self.on_slider_changed)
+        self.shape_combo.currentIndexChanged.connect(self.apply_current)
+        self.stat_combo.currentIndexChanged.connect(self.apply_current)
         buttons.accepted.connect(self.accept)
         buttons.rejected.connect(self.reject)
         self._last_pixmap = original_image
+        self.progressive = previews.Progressive(original_image, self.effect_name, selection, self.show_stage, self)
         self.timer = QTimer(self)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.apply_current)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.timeout.connect(self.prefetch)
         # Preview on open
         self.apply_current()
 
@@ -581,52 +601,41 @@ class PixelateDialog(QDialog):
         self.block_label.setText(f"Pixel Size: {self.slider.value()}px")
         self.timer.start(500)
 
-    def apply_current(self):
-        blocksize = self.slider.value()
-        original_image = self.original_image
-        image = original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        ptr = image.bits()
-        ptr.setsize(image.byteCount())
-        arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-
-        # Move RGB channels to GPU
-        gpu_arr = cp.asarray(arr[..., :3])  # shape (H, W, 3)
-        H, W = gpu_arr.shape[:2]
-
-        # Compute number of blocks in each dimension
-        H_blocks = (H + blocksize - 1) // blocksize
-        W_blocks = (W + blocksize - 1) // blocksize
-
-        # Pad so dimensions are multiples of blocksize
-        pad_H = H_blocks * blocksize - H
-        pad_W = W_blocks * blocksize - W
-        gpu_arr_padded = cp.pad(gpu_arr, ((0, pad_H), (0, pad_W), (0, 0)), mode="edge")
-
-        # Reshape into blocks
-        reshaped = gpu_arr_padded.reshape(
-            H_blocks, blocksize,
-            W_blocks, blocksize,
-            3
-        )
-
-        # Compute mean per block (vectorized, GPU accelerated)
-        block_means = reshaped.mean(axis=(1, 3), keepdims=True).astype(cp.uint8)
-
-        # Broadcast back to block shape
-        pixelated = cp.broadcast_to(block_means, reshaped.shape)
+    def get_params(self):
+        return {
+            "blocksize": self.slider.value(),
+            "shape": self.shape_combo.currentText(),
+            "stat": self.stat_combo.currentText(),
+        }
 
-        # Reshape back to full image, then crop to original size
-        gpu_result = pixelated.reshape(H_blocks * blocksize, W_blocks * blocksize, 3)
-        gpu_result = gpu_result[:H, :W]
+    def set_params(self, params):
+        self.slider.setValue(params.get("blocksize", self.slider.value()))
+        self.shape_combo.setCurrentText(params.get("shape", self.shape_combo.currentText()))
+        self.stat_combo.setCurrentText(params.get("stat", self.stat_combo.currentText()))
 
-        # Copy result back to CPU and insert alpha channel
-        result = cp.asnumpy(gpu_result)
-        arr[..., :3] = result
-
-        pixmap = QPixmap.fromImage(image)
-        self._last_pixmap = pixmap
-        self.apply_callback(pixmap)
+    def neighbour_params(self):
+        return previews.neighbours(self.get_params(), "blocksize", self.slider)
 
+    def apply_current(self):
+        self.progressive.request(self.get_params())
+
+    def show_stage(self, pixmap, step):
+        # Coarse stages are only shown, the full-size result is what OK applies
+        if step == 1:
+            self._last_pixmap = pixmap
+            self.prefetch_timer.start(previews.PREFETCH_DELAY)
+        self.apply_callback(pixmap, step)
+
+    def prefetch(self):
+        previews.prefetch(self.original_image, self.effect_name, self.neighbour_params(), self.selection)
+
+    def done(self, result):
+        self.prefetch_timer.stop()
+        if result == QDialog.Accepted:
+            self.progressive.finish()
+        self.progressive.cancel()
+        previews.cancel()
+        super().done(result)
 
     def get_pixmap(self):
         return self._last_pixmap
@@ -642,13 +651,16 @@ class PixelateDialog(QDialog):
         )
 
 class PixelSortDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_axis=0):
+    effect_name = "pixelsort"
+
+    def __init__(self, parent, original_image, apply_callback, default_axis=0, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Pixel Sort")
         self.setFixedSize(340, 260)
         self.set_titlebar_color(0x010101)
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
 
         layout = QVBoxLayout()
 
@@ -686,6 +698,7 @@ class PixelSortDialog(QDialog):
         buttons.rejected.connect(self.reject)
 
         self._last_pixmap = original_image
+        self.progressive = previews.Progressive(original_image, self.effect_name, selection, self.show_stage, self)
         self.timer = QTimer(self)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.apply_current)
@@ -699,11 +712,10 @@ class PixelSortDialog(QDialog):
 
     def _update_offset_slider(self):
         if self.original_image:
-            img = self.original_image.toImage()
             if self.direction_combo.currentIndex() in [0, 1]:
-                self.offset_slider.setMaximum(img.width() - 1)
+                self.offset_slider.setMaximum(self.original_image.width() - 1)
             else:
-                self.offset_slider.setMaximum(img.height() - 1)
+                self.offset_slider.setMaximum(self.original_image.height() - 1)
             self.offset_slider.setValue(0)
 
     def on_slider_changed(self, value):
@@ -711,46 +723,32 @@ class PixelSortDialog(QDialog):
         self.offset_label.setText(f"offset position: {self.offset_slider.value()}px")
         self.timer.start(100)
 
+    def get_params(self):
+        return {
+            "direction": self.direction_combo.currentIndex(),
+            "threshold": self.threshold_slider.value(),
+            "offset": self.offset_slider.value(),
+        }
+
+    def set_params(self, params):
+        self.direction_combo.setCurrentIndex(params.get("direction", self.direction_combo.currentIndex()))
+        self.threshold_slider.setValue(params.get("threshold", self.threshold_slider.value()))
+        self.offset_slider.setValue(params.get("offset", self.offset_slider.value()))
+
     def apply_current(self):
-        direction = self.direction_combo.currentIndex()
-        threshold_percent = self.threshold_slider.value()
-        offset = self.offset_slider.value()
-        original_image = self.original_image
-        image = original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        ptr = image.bits()
-        ptr.setsize(image.byteCount())
-        arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-
-        threshold = int(255 * threshold_percent / 100)
-        if threshold == 0:
-            threshold = -1
-
-        # Move RGB array to GPU
-        gpu_arr = cp.asarray(arr[..., :3])
-        H, W = gpu_arr.shape[:2]
-
-        brightness = gpu_arr.mean(axis=2)  # H x W
-
-        if direction in [0, 1]:  # horizontal
-            mask = cp.arange(W)[None, :] >= offset
-            mask = mask & (brightness > threshold)
-            indices = cp.argsort(cp.where(mask, brightness, -cp.inf), axis=1)
-            sorted_arr = cp.take_along_axis(gpu_arr, indices[:, :, None], axis=1)
-            if direction == 1:  # right
-                sorted_arr = sorted_arr[:, ::-1, :]
-        else:  # vertical
-            mask = cp.arange(H)[:, None] >= offset
-            mask = mask & (brightness > threshold)
-            indices = cp.argsort(cp.where(mask, brightness, -cp.inf), axis=0)
-            sorted_arr = cp.take_along_axis(gpu_arr, indices[:, :, None], axis=0)
-            if direction == 3:  # bottom
-                sorted_arr = sorted_arr[::-1, :, :]
-
-        arr[..., :3] = cp.asnumpy(sorted_arr)
-
-        pixmap = QPixmap.fromImage(image)
-        self._last_pixmap = pixmap
-        self.apply_callback(pixmap)
+        self.progressive.request(self.get_params())
+
+    def show_stage(self, pixmap, step):
+        # Coarse stages are only shown, the full-size result is what OK applies
+        if step == 1:
+            self._last_pixmap = pixmap
+        self.apply_callback(pixmap, step)
+
+    def done(self, result):
+        if result == QDialog.Accepted:
+            self.progressive.finish()
+        self.progressive.cancel()
+        super().done(result)
 
     def get_pixmap(self):
         return self._last_pixmap
@@ -766,7 +764,9 @@ class PixelSortDialog(QDialog):
         )
 
 class VectorDisplaceDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback):
+    effect_name = "displace"
+
+    def __init__(self, parent, original_image, apply_callback, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Vector Displacement")
         self.setFixedSize(340, 220)
@@ -774,6 +774,7 @@ class VectorDisplaceDialog(QDialog):
 
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
 
         layout = QVBoxLayout()
 
@@ -795,6 +796,7 @@ class VectorDisplaceDialog(QDialog):
         buttons.rejected.connect(self.reject)
 
         self._last_pixmap = original_image
+        self.progressive = previews.Progressive(original_image, self.effect_name, selection, self.show_stage, self)
         self.timer = QTimer(self)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.apply_current)
@@ -805,35 +807,26 @@ class VectorDisplaceDialog(QDialog):
         self.scale_label.setText(f"strength: {self.scale_slider.value()}")
         self.timer.start(100)
 
-    def apply_current(self):
-        scale = self.scale_slider.value()
-        scale = scale ** 1.5
-
-        image = self.original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        ptr = image.bits()
-        ptr.setsize(image.byteCount())
-        arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-
-        gpu_arr = cp.asarray(arr[..., :3], dtype=cp.float32)
-        H, W = gpu_arr.shape[:2]
-
-        # Normalize [0,255] → [-1,1]
-        norm = (gpu_arr / 127.5) - 1.0
+    def get_params(self):
+        return {"strength": self.scale_slider.value()}
 
-        dx = norm[..., 0] * scale
-        dy = norm[..., 1] * scale
+    def set_params(self, params):
+        self.scale_slider.setValue(params.get("strength", self.scale_slider.value()))
 
-        # Generate sampling grid
-        x, y = cp.meshgrid(cp.arange(W), cp.arange(H))
-        x2 = cp.clip((x + dx).astype(cp.int32), 0, W - 1)
-        y2 = cp.clip((y + dy).astype(cp.int32), 0, H - 1)
+    def apply_current(self):
+        self.progressive.request(self.get_params())
 
-        displaced = gpu_arr[y2, x2, :]
-        arr[..., :3] = cp.asnumpy(displaced)
+    def show_stage(self, pixmap, step):
+        # Coarse stages are only shown, the full-size result is what OK applies
+        if step == 1:
+            self._last_pixmap = pixmap
+        self.apply_callback(pixmap, step)
 
-        pixmap = QPixmap.fromImage(image)
-        self._last_pixmap = pixmap
-        self.apply_callback(pixmap)
+    def done(self, result):
+        if result == QDialog.Accepted:
+            self.progressive.finish()
+        self.progressive.cancel()
+        super().done(result)
 
     def get_pixmap(self):
         return self._last_pixmap
@@ -849,14 +842,17 @@ class VectorDisplaceDialog(QDialog):
         )
 
 class ColorizeDialog(QDialog):
-    def __init__(self, parent, original_image, apply_callback, default_colors=None):
+    effect_name = "colorize"
+
+    def __init__(self, parent, original_image, apply_callback, default_colors=None, selection=None):
         super().__init__(parent)
         self.setWindowTitle("Colorize by Channel")
-        self.setFixedSize(360, 220)
+        self.setFixedSize(360, 250)
         self.set_titlebar_color(0x010101)
 
         self.original_image = original_image
         self.apply_callback = apply_callback
+        self.selection = selection
 
         if default_colors is None:
             default_colors = {
@@ -880,6 +876,10 @@ class ColorizeDialog(QDialog):
         layout.addWidget(self.g_button)
         layout.addWidget(self.b_button)
 
+        # Channels are mixed in linear light, like overlapping light sources
+        self.linear_check = QCheckBox("linear light")
+        layout.addWidget(self.linear_check)
+
         buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         layout.addWidget(buttons)
 
@@ -889,6 +889,7 @@ class ColorizeDialog(QDialog):
         self.r_button.clicked.connect(lambda: self.pick_color("R"))
         self.g_button.clicked.connect(lambda: self.pick_color("G"))
         self.b_button.clicked.connect(lambda: self.pick_color("B"))
+        self.linear_check.toggled.connect(lambda: self.timer.start(300))
         buttons.accepted.connect(self.accept)
         buttons.rejected.connect(self.reject)
 
@@ -926,29 +927,28 @@ class ColorizeDialog(QDialog):
                 self.timer.start(300)
 
 
-    def apply_current(self):
-        image = self.original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-        ptr = image.bits()
-        ptr.setsize(image.byteCount())
-        arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-
-        gpu_arr = cp.asarray(arr[..., :3], dtype=cp.float32)
-
-        r_map = cp.array([self.colors["R"].red(), self.colors["R"].green(), self.colors["R"].blue()], dtype=cp.float32)
-        g_map = cp.array([self.colors["G"].red(), self.colors["G"].green(), self.colors["G"].blue()], dtype=cp.float32)
-        b_map = cp.array([self.colors["B"].red(), self.colors["B"].green(), self.colors["B"].blue()], dtype=cp.float32)
-
-        r_chan = gpu_arr[..., 0:1] / 255.0
-        g_chan = gpu_arr[..., 1:2] / 255.0
-        b_chan = gpu_arr[..., 2:3] / 255.0
-
-        recolored = r_chan * r_map + g_chan * g_map + b_chan * b_map
-        recolored = cp.clip(recolored, 0, 255).astype(cp.uint8)
+    def get_params(self):
+        params = {"colors": {ch: c.getRgb()[:3] for ch, c in self.colors.items()}}
+        if self.linear_check.isChecked():
+            params["linear"] = True
+        return params
 
-        gpu_arr[...] = recolored
+    def set_params(self, params):
+        self.linear_check.setChecked(params.get("linear", False))
+        for channel, rgb in params.get("colors", {}).items():
+            color = QColor(*rgb)
+            self.colors[channel] = color
+            button = getattr(self, f"{channel.lower()}_button")
+            button.setStyleSheet(f"background-color: {color.name()}")
+        self.timer.start(300)
 
-        arr[..., :3] = cp.asnumpy(gpu_arr)
-        pixmap = QPixmap.fromImage(image)
+    def apply_current(self):
+        xp = get_xp()
+        src = buffers.working_array(self.original_image, xp)
+        if self.selection is None:
+            pixmap = buffers.show_array(kernels.apply(self.effect_name, src, **self.get_params()))
+        else:
+            pixmap = self.selection.apply(self.original_image, src, self.effect_name, self.get_params())
         self._last_pixmap = pixmap
         self.apply_callback(pixmap)
 
@@ -975,11 +975,11 @@ class ColorizeDialog(QDialog):
 class PreferencesDialog(QDialog):
     theme_changed = pyqtSignal(str)
 
-    def __init__(self, current_theme="cmd", parent=None):
+    def __init__(self, current_theme="cmd", gpu_limit_mb=0, parent=None):
         super().__init__(parent)
 
         self.setWindowTitle("Preferences")
-        self.setFixedSize(300, 150)
+        self.setFixedSize(300, 230)
         self.set_titlebar_color(0x010101)
 
         layout = QVBoxLayout()
@@ -993,6 +993,13 @@ class PreferencesDialog(QDialog):
         layout.addWidget(QLabel("Theme:"))
         layout.addWidget(self.theme_combo)
 
+        # Cap on the GPU memory pool, 0 for none
+        self.gpu_limit_edit = QLineEdit(str(gpu_limit_mb))
+        self.gpu_limit_edit.setValidator(QtGui.QIntValidator(0, 1 << 20))
+        used, held = device_memory()
+        layout.addWidget(QLabel(f"GPU memory limit (MB, 0 = none) - in use {used >> 20} / {held >> 20} MB:"))
+        layout.addWidget(self.gpu_limit_edit)
+
         # Buttons
         buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         buttons.accepted.connect(self.accept)
@@ -1004,6 +1011,9 @@ class PreferencesDialog(QDialog):
     def select_theme(self):
         return self.theme_combo.currentText()
 
+    def gpu_limit_mb(self):
+        return int(self.gpu_limit_edit.text() or 0)
+
     def set_titlebar_color(self, color):
         hwnd = int(self.winId())
         color_ref = ctypes.c_uint(color)
@@ -0,0 +1,358 @@
+import os
+import re
+import struct
+import zlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+from PyQt5.QtGui import QImageReader
+from PyQt5.QtCore import QThread, pyqtSignal
+
+import colorspace
+import kernels
+from buffers import show_array, image_to_array
+
+# Multi-frame images: every frame of a GIF, or a numbered PNG sequence,
+# held as one (N, H, W, 4) BGRA array. Effects run over the frames in
+# parallel with identical parameters; noise and dither patterns come from
+# the effect's seed and the pixel position, so a still area stays still.
+
+DEFAULT_DELAY = 100
+WORKERS = os.cpu_count() or 4
+FRAME_NUMBER = re.compile(r"^(.*?)(\d+)(\.png)$", re.IGNORECASE)
+
+
+class FrameSequence:
+    def __init__(self, frames, delays):
+        self.frames = frames
+        self.delays = list(delays)
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    @property
+    def size(self):
+        return self.frames.shape[2], self.frames.shape[1]
+
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def pixmap(self, index):
+        return show_array(self.frames[index])
+
+    def map(self, fn):
+        # fn(frame) -> frame for every frame, across a thread pool; the
+        # kernels spend their time in numpy and Qt, outside the GIL
+        first = fn(self.frames[0])
+        out = np.empty((len(self),) + first.shape, first.dtype)
+        out[0] = first
+
+        def run(i):
+            out[i] = fn(self.frames[i])
+
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            list(pool.map(run, range(1, len(self))))
+        return FrameSequence(out, self.delays)
+
+
+def frame_count(path):
+    return QImageReader(path).imageCount()
+
+
+def sequence_paths(path):
+    # Every file next to path with the same name around its frame number,
+    # in numeric order: shot_0001.png, shot_0002.png, ...
+    folder, name = os.path.split(path)
+    match = FRAME_NUMBER.match(name)
+    if match is None:
+        return [path]
+    prefix, _, suffix = match.groups()
+    numbered = []
+    for other in os.listdir(folder or "."):
+        m = FRAME_NUMBER.match(other)
+        if m and m.group(1) == prefix and m.group(3).lower() == suffix.lower():
+            numbered.append((int(m.group(2)), os.path.join(folder, other)))
+    return [p for _, p in sorted(numbered)]
+
+
+def load_sequence(path, delay=DEFAULT_DELAY):
+    # All frames of an animated file, or the numbered PNG sequence path is
+    # part of. Frames that differ in size from the first are skipped.
+    images, delays = [], []
+    if path.lower().endswith(".png") and FRAME_NUMBER.match(os.path.basename(path)):
+        for frame_path in sequence_paths(path):
+            image = colorspace.load(frame_path)
+            if not image.isNull():
+                images.append(image)
+                delays.append(delay)
+    else:
+        reader = QImageReader(path)
+        while True:
+            image = reader.read()
+            if image.isNull():
+                break
+            images.append(colorspace.to_working(image))
+            delays.append(reader.nextImageDelay() or delay)
+            if not reader.canRead():
+                break
+    if not images:
+        return None
+    size = images[0].size()
+    keep = [i for i, image in enumerate(images) if image.size() == size]
+    frames = np.stack([image_to_array(images[i]) for i in keep])
+    return FrameSequence(frames, [delays[i] for i in keep])
+
+
+def effect_fn(name, params, selection=None):
+    # Per-frame function for an effect, limited to a selection if given
+    def fn(frame):
+        if selection is None:
+            return kernels.apply(name, frame, **dict(params))
+        out = frame.copy()
+        r = selection.rect
+        out[r.y():r.y() + r.height(), r.x():r.x() + r.width()] = selection.patch(frame, name, dict(params))
+        return out
+    return fn
+
+
+def apply_effect(sequence, name, params, selection=None):
+    return sequence.map(effect_fn(name, params, selection))
+
+
+##########################################################
+#........................................................#
+#..........................GIF...........................#
+#........................................................#
+##########################################################
+
+def _color_keys(frames):
+    # 15-bit RGB key per pixel
+    r = frames[..., 2].astype(np.uint16) >> 3
+    g = frames[..., 1].astype(np.uint16) >> 3
+    b = frames[..., 0].astype(np.uint16) >> 3
+    return (r << 10) | (g << 5) | b
+
+
+def build_palette(frames, colors=255, max_samples=1 << 20):
+    # One palette for the whole animation, so colours don't shift from frame
+    # to frame: the most common 15-bit colours, each the mean of the pixels
+    # that fell into it
+    step = max(1, int(np.ceil(frames[..., 0].size / max_samples)))
+    sample = frames.reshape(-1, 4)[::step]
+    sample = sample[sample[:, 3] >= 128]
+    keys = _color_keys(sample).astype(np.int64)
+    counts = np.bincount(keys, minlength=1 << 15)
+    top = np.argsort(counts)[::-1][:colors]
+    top = top[counts[top] > 0]
+    palette = np.zeros((len(top), 3), np.float64)
+    for c, channel in enumerate((2, 1, 0)):
+        sums = np.bincount(keys, weights=sample[:, channel], minlength=1 << 15)
+        palette[:, c] = sums[top] / counts[top]
+    if len(palette) == 0:
+        palette = np.zeros((1, 3))
+    return np.rint(palette).astype(np.uint8)
+
+
+def _palette_lut(palette):
+    # Nearest palette entry for each of the 32768 15-bit colours
+    keys = np.arange(1 << 15)
+    centres = np.stack([(keys >> 10) & 31, (keys >> 5) & 31, keys & 31], axis=1) * 8 + 4
+    lut = np.empty(1 << 15, np.uint8)
+    pal = palette.astype(np.int32)
+    for start in range(0, 1 << 15, 4096):
+        block = centres[start:start + 4096, None, :] - pal[None, :, :]
+        lut[start:start + 4096] = np.argmin((block * block).sum(axis=2), axis=1)
+    return lut
+
+
+def lzw_encode(data, min_code_size=8):
+    # GIF variable-width LZW, packed LSB first
+    clear = 1 << min_code_size
+    end = clear + 1
+    out = bytearray()
+    bits = 0
+    nbits = 0
+    code_size = min_code_size + 1
+    next_code = end + 1
+    table = {}
+
+    def emit(code, size):
+        nonlocal bits, nbits
+        bits |= code << nbits
+        nbits += size
+        while nbits >= 8:
+            out.append(bits & 0xFF)
+            bits >>= 8
+            nbits -= 8
+
+    emit(clear, code_size)
+    if len(data) == 0:
+        emit(end, code_size)
+        if nbits:
+            out.append(bits & 0xFF)
+        return bytes(out)
+
+    prefix = data[0]
+    for byte in data[1:]:
+        key = (prefix << 8) | byte
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix, code_size)
+        if next_code < 4096:
+            table[key] = next_code
+            next_code += 1
+            if next_code > (1 << code_size) and code_size < 12:
+                code_size += 1
+        else:
+            emit(clear, code_size)
+            table.clear()
+            next_code = end + 1
+            code_size = min_code_size + 1
+        prefix = byte
+    emit(prefix, code_size)
+    emit(end, code_size)
+    if nbits:
+        out.append(bits & 0xFF)
+    return bytes(out)
+
+
+def _sub_blocks(data):
+    out = bytearray()
+    for i in range(0, len(data), 255):
+        chunk = data[i:i + 255]
+        out.append(len(chunk))
+        out += chunk
+    out.append(0)
+    return bytes(out)
+
+
+def _encode_gif_frame(indices):
+    # Runs in a worker process: LZW is a byte-at-a-time loop
+    return _sub_blocks(lzw_encode(indices))
+
+
+def write_gif(path, sequence, loop=0):
+    frames = sequence.frames
+    n, H, W = frames.shape[:3]
+    palette = build_palette(frames)
+    lut = _palette_lut(palette)
+    transparent = len(palette)
+    table = np.zeros((256, 3), np.uint8)
+    table[:len(palette)] = palette
+
+    indices = []
+    for frame in frames:
+        idx = lut[_color_keys(frame)]
+        idx[frame[..., 3] < 128] = transparent
+        indices.append(idx.tobytes())
+
+    with ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        encoded = list(pool.map(_encode_gif_frame, indices))
+
+    with open(path, "wb") as f:
+        f.write(b"GIF89a")
+        f.write(struct.pack("<HHBBB", W, H, 0xF7, 0, 0))
+        f.write(table.tobytes())
+        f.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+        for i, data in enumerate(encoded):
+            delay = max(2, int(round(sequence.delays[i] / 10)))
+            # Disposal 2 clears each frame before the next one is drawn
+            f.write(b"\x21\xF9\x04" + struct.pack("<BHBB", (2 << 2) | 1, delay, transparent, 0))
+            f.write(b"\x2C" + struct.pack("<HHHHB", 0, 0, W, H, 0))
+            f.write(b"\x08")
+            f.write(data)
+        f.write(b"\x3B")
+
+
+##########################################################
+#........................................................#
+#..........................APNG..........................#
+#........................................................#
+##########################################################
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def _png_rows(frame):
+    # RGBA rows with the Sub filter, which suits photos and flat art alike
+    rgba = frame[..., [2, 1, 0, 3]]
+    filtered = rgba.copy()
+    filtered[:, 1:] -= rgba[:, :-1]
+    H = frame.shape[0]
+    rows = np.empty((H, 1 + frame.shape[1] * 4), np.uint8)
+    rows[:, 0] = 1
+    rows[:, 1:] = filtered.reshape(H, -1)
+    return zlib.compress(rows.tobytes(), 6)
+
+
+def write_apng(path, sequence, loop=0):
+    frames = sequence.frames
+    n, H, W = frames.shape[:3]
+    # zlib releases the GIL, so threads compress frames in parallel
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        compressed = list(pool.map(_png_rows, frames))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", W, H, 8, 6, 0, 0, 0)))
+        f.write(_png_chunk(b"acTL", struct.pack(">II", n, loop)))
+        seq = 0
+        for i, data in enumerate(compressed):
+            f.write(_png_chunk(b"fcTL", struct.pack(
+                ">IIIIIHHBB", seq, W, H, 0, 0, int(sequence.delays[i]), 1000, 0, 0
+            )))
+            seq += 1
+            if i == 0:
+                f.write(_png_chunk(b"IDAT", data))
+            else:
+                f.write(_png_chunk(b"fdAT", struct.pack(">I", seq) + data))
+                seq += 1
+        f.write(_png_chunk(b"IEND", b""))
+
+
+def write_sequence(path, sequence):
+    if path.lower().endswith(".gif"):
+        write_gif(path, sequence)
+    else:
+        write_apng(path, sequence)
+
+
+class ExportThread(QThread):
+    # Encodes and writes an animation off the GUI thread
+    exported = pyqtSignal(str, str)
+
+    def __init__(self, path, sequence, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.sequence = sequence
+
+    def run(self):
+        try:
+            write_sequence(self.path, self.sequence)
+            self.exported.emit(self.path, "")
+        except Exception as e:
+            self.exported.emit(self.path, str(e))
+
+
+class SequenceThread(QThread):
+    # Runs fn over every frame off the GUI thread. Exactly one of applied
+    # and failed is emitted.
+    applied = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, sequence, fn, parent=None):
+        super().__init__(parent)
+        self.sequence = sequence
+        self.fn = fn
+
+    def run(self):
+        try:
+            sequence = self.sequence.map(self.fn)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.applied.emit(sequence)
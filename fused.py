@@ -0,0 +1,408 @@
+import threading
+
+import numpy as np
+
+import backend
+import colorspace
+from bands import run_bands, band_rows
+
+# Hand-written one-pass kernels for the effects whose generic array code
+# makes several full-frame temporaries: colorize's 3x3 channel mix,
+# displacement sampling and the per-line sort behind pixel sort. On the GPU
+# they are CuPy elementwise kernels; on the CPU they are numba functions run
+# on the band pool (numba is optional, without it the array code is used).
+# Each entry point returns None when it has no kernel for the input, and
+# the caller then runs the reference code in kernels.py, which is also what
+# check() compares the kernels against.
+
+# Pixel sort keys: 0 for pixels left out of the sort, then 1 + R + G + B
+SORT_BINS = 1 + 3 * 255 + 1
+
+enabled = True
+
+_cuda = None
+_cpu = None
+_cpu_probed = False
+_build_lock = threading.Lock()
+
+
+# CPU kernels. Plain Python over one band, compiled by numba with the GIL
+# released so the bands run in parallel.
+
+def _colorize_rows(chunk, mix, linear, decode, encode, decode_steps, encode_scale):
+    h, w = chunk.shape[:2]
+    decode_max = decode.shape[0] - 1
+    encode_max = encode.shape[0] - 1
+    src = np.empty(3, np.float32)
+    for y in range(h):
+        for x in range(w):
+            for c in range(3):
+                s = chunk[y, x, c]
+                if linear:
+                    k = min(max(np.rint(s * decode_steps), 0), decode_max)
+                    s = decode[int(k)]
+                src[c] = s / np.float32(255.0)
+            for c in range(3):
+                r = src[0] * mix[0, c] + src[1] * mix[1, c] + src[2] * mix[2, c]
+                if linear:
+                    k = min(max(np.rint(r * encode_scale), 0), encode_max)
+                    r = encode[int(k)]
+                chunk[y, x, c] = r
+
+
+def _displace_rows(src, out, scale, y0, y1):
+    H, W = src.shape[:2]
+    for y in range(y0, y1):
+        for x in range(W):
+            dx = (np.float32(src[y, x, 0]) / np.float32(127.5) - np.float32(1.0)) * scale
+            dy = (np.float32(src[y, x, 1]) / np.float32(127.5) - np.float32(1.0)) * scale
+            x2 = min(max(int(x + np.float64(dx)), 0), W - 1)
+            y2 = min(max(int(y + np.float64(dy)), 0), H - 1)
+            for c in range(3):
+                out[y, x, c] = src[y2, x2, c]
+            out[y, x, 3] = src[y, x, 3]
+
+
+def _sort_lines(src, out, l0, l1, n, line_stride, step, offset, limit, reverse):
+    # src and out are (pixels, 4). Stable counting sort of each line by key.
+    hist = np.empty(SORT_BINS, np.int64)
+    for line in range(l0, l1):
+        base = line * line_stride
+        hist[:] = 0
+        for p in range(n):
+            j = base + p * step
+            key = np.int64(src[j, 0]) + src[j, 1] + src[j, 2]
+            hist[key + 1 if p >= offset and key > limit else 0] += 1
+        total = 0
+        for b in range(SORT_BINS):
+            count = hist[b]
+            hist[b] = total
+            total += count
+        for p in range(n):
+            j = base + p * step
+            key = np.int64(src[j, 0]) + src[j, 1] + src[j, 2]
+            b = key + 1 if p >= offset and key > limit else 0
+            q = hist[b]
+            hist[b] = q + 1
+            if reverse:
+                q = n - 1 - q
+            k = base + q * step
+            out[k, 0] = src[j, 0]
+            out[k, 1] = src[j, 1]
+            out[k, 2] = src[j, 2]
+            out[k, 3] = src[k, 3]
+
+
+F0 = np.float32(0.0)
+F255 = np.float32(255.0)
+
+
+def _blend_rows(acc, top, cover, opacity, mode, round_8bit):
+    # One layer blended into a float32 block of the composite, in the same
+    # float32 steps as layers.BLEND_MODES, then clipped (and rounded for
+    # 8-bit). cover is the mask for the block, or empty for none. mode is
+    # an index into layers.BLEND_MODES.
+    h, w = acc.shape[:2]
+    masked = cover.shape[0] > 0
+    for y in range(h):
+        for x in range(w):
+            t = opacity * cover[y, x] if masked else opacity
+            for c in range(4):
+                a = acc[y, x, c]
+                b = np.float32(top[y, x, c])
+                if c == 3 or mode == 0:
+                    r = b
+                elif mode == 1:
+                    r = a * b / F255
+                elif mode == 2:
+                    r = a + b - a * b / F255
+                elif mode == 3:
+                    r = np.float32(2.0) * a * b / F255 if a <= np.float32(127.5) else \
+                        F255 - np.float32(2.0) * (F255 - a) * (F255 - b) / F255
+                elif mode == 4:
+                    an = a / F255
+                    bn = b / F255
+                    if an <= np.float32(0.25):
+                        d = ((np.float32(16.0) * an - np.float32(12.0)) * an + np.float32(4.0)) * an
+                    else:
+                        d = np.sqrt(an)
+                    if bn <= np.float32(0.5):
+                        r = F255 * (an - (np.float32(1.0) - np.float32(2.0) * bn) * an * (np.float32(1.0) - an))
+                    else:
+                        r = F255 * (an + (np.float32(2.0) * bn - np.float32(1.0)) * (d - an))
+                elif mode == 5:
+                    r = min(a, b)
+                elif mode == 6:
+                    r = max(a, b)
+                elif mode == 7:
+                    r = abs(a - b)
+                elif mode == 8:
+                    r = min(a + b, F255)
+                else:
+                    r = max(a - b, F0)
+                v = a + (r - a) * t
+                v = min(max(v, F0), F255)
+                if round_8bit:
+                    v = np.rint(v)
+                acc[y, x, c] = v
+
+
+# GPU kernels, one thread per pixel (per line for the sort)
+
+_COLORIZE_CUDA = r'''
+float src[3];
+for (int c = 0; c < 3; c++) {
+    float s = chunk[i * 4 + c];
+    if (linear) {
+        float k = fminf(fmaxf(rintf(s * decode_steps), 0.0f), (float)decode_max);
+        s = decode[(int)k];
+    }
+    src[c] = s / 255.0f;
+}
+for (int c = 0; c < 3; c++) {
+    float r = src[0] * mix[c] + src[1] * mix[3 + c] + src[2] * mix[6 + c];
+    if (linear) {
+        float k = fminf(fmaxf(rintf(r * encode_scale), 0.0f), (float)encode_max);
+        r = encode[(int)k];
+    }
+    chunk[i * 4 + c] = r;
+}
+'''
+
+_DISPLACE_CUDA = r'''
+int x = i % W, y = i / W;
+float dx = ((float)src[i * 4] / 127.5f - 1.0f) * scale;
+float dy = ((float)src[i * 4 + 1] / 127.5f - 1.0f) * scale;
+long long x2 = (long long)((double)x + (double)dx);
+long long y2 = (long long)((double)y + (double)dy);
+x2 = x2 < 0 ? 0 : (x2 > W - 1 ? W - 1 : x2);
+y2 = y2 < 0 ? 0 : (y2 > H - 1 ? H - 1 : y2);
+ptrdiff_t j = (y2 * W + x2) * 4;
+out[i * 4] = src[j];
+out[i * 4 + 1] = src[j + 1];
+out[i * 4 + 2] = src[j + 2];
+out[i * 4 + 3] = src[i * 4 + 3];
+'''
+
+_SORT_CUDA = r'''
+int hist[%d];
+ptrdiff_t base = (ptrdiff_t)i * line_stride;
+for (int b = 0; b < %d; b++) hist[b] = 0;
+for (int p = 0; p < n; p++) {
+    ptrdiff_t j = (base + (ptrdiff_t)p * step) * 4;
+    int key = src[j] + src[j + 1] + src[j + 2];
+    hist[p >= offset && key > limit ? key + 1 : 0]++;
+}
+int total = 0;
+for (int b = 0; b < %d; b++) {
+    int count = hist[b];
+    hist[b] = total;
+    total += count;
+}
+for (int p = 0; p < n; p++) {
+    ptrdiff_t j = (base + (ptrdiff_t)p * step) * 4;
+    int key = src[j] + src[j + 1] + src[j + 2];
+    int q = hist[p >= offset && key > limit ? key + 1 : 0]++;
+    if (reverse) q = n - 1 - q;
+    ptrdiff_t k = (base + (ptrdiff_t)q * step) * 4;
+    out[k] = src[j];
+    out[k + 1] = src[j + 1];
+    out[k + 2] = src[j + 2];
+    out[k + 3] = src[k + 3];
+}
+''' % (SORT_BINS, SORT_BINS, SORT_BINS)
+
+
+def _cuda_kernels():
+    # Built on first use; CuPy compiles each one on its first launch and
+    # keeps the binary in its on-disk cache
+    global _cuda
+    with _build_lock:
+        if _cuda is None:
+            cp = backend.cp
+            _cuda = {
+                "colorize": cp.ElementwiseKernel(
+                    "raw float32 mix, bool linear, raw float32 decode, raw float32 encode, "
+                    "float32 decode_steps, int32 decode_max, float32 encode_scale, int32 encode_max",
+                    "raw float32 chunk", _COLORIZE_CUDA, "cw_colorize"),
+                "displace": cp.ElementwiseKernel(
+                    "raw T src, float32 scale, int64 W, int64 H",
+                    "raw T out", _DISPLACE_CUDA, "cw_displace"),
+                "sort": cp.ElementwiseKernel(
+                    "raw uint8 src, int32 n, int64 line_stride, int64 step, int32 offset, int32 limit, bool reverse",
+                    "raw uint8 out", _SORT_CUDA, "cw_sort_lines"),
+            }
+        return _cuda
+
+
+def _cpu_kernels():
+    # numba versions of the functions above, or None without numba
+    global _cpu, _cpu_probed
+    with _build_lock:
+        if not _cpu_probed:
+            try:
+                import numba
+                jit = numba.njit(nogil=True, cache=True)
+                _cpu = {
+                    "colorize": jit(_colorize_rows),
+                    "displace": jit(_displace_rows),
+                    "sort": jit(_sort_lines),
+                    "blend": jit(_blend_rows),
+                }
+            except ImportError:
+                _cpu = None
+            _cpu_probed = True
+        return _cpu
+
+
+def _kernels(arr):
+    if not enabled:
+        return None
+    if backend.xp_of(arr) is not np:
+        return _cuda_kernels()
+    if arr.dtype == np.float16:
+        # numba has no float16 arithmetic
+        return None
+    return _cpu_kernels()
+
+
+def colorize(chunk, mix, linear=False):
+    # In place on a float32 (h, w, 4) chunk. mix is the 3x3 float32 matrix
+    # from source channel to output channel. Returns False if not handled.
+    k = _kernels(chunk)
+    if k is None or not chunk.flags.c_contiguous:
+        return False
+    xp = backend.xp_of(chunk)
+    decode, encode = colorspace.tables(xp)
+    if linear:
+        mix = colorspace.to_linear(mix)
+    encode_scale = np.float32((colorspace.ENCODE_SIZE - 1) / 255.0)
+    if xp is np:
+        k["colorize"](chunk, mix, linear, decode, encode, np.float32(colorspace.DECODE_STEPS), encode_scale)
+    else:
+        k["colorize"](xp.asarray(mix.ravel()), linear, decode, encode,
+                      np.float32(colorspace.DECODE_STEPS), decode.size - 1, encode_scale, encode.size - 1,
+                      chunk.reshape(-1), size=chunk.shape[0] * chunk.shape[1])
+    return True
+
+
+def displace(arr, scale):
+    k = _kernels(arr)
+    if k is None:
+        return None
+    xp = backend.xp_of(arr)
+    arr = xp.ascontiguousarray(arr)
+    H, W = arr.shape[:2]
+    out = xp.empty_like(arr)
+    if xp is np:
+        rows = band_rows(W)
+        run_bands(lambda y0, y1: k["displace"](arr, out, np.float32(scale), y0, y1), H, rows)
+    else:
+        k["displace"](arr.reshape(-1), np.float32(scale), W, H, out.reshape(-1), size=H * W)
+    return out
+
+
+def pixelsort(arr, vertical, reverse, offset, limit):
+    # Stable sort of every row (or column) by R + G + B, pixels before
+    # offset or with a sum not above limit first. Only 8-bit images: their
+    # keys are small integers, so each line is one counting sort.
+    if arr.dtype != np.uint8:
+        return None
+    k = _kernels(arr)
+    if k is None:
+        return None
+    xp = backend.xp_of(arr)
+    H, W = arr.shape[:2]
+    if vertical:
+        lines, n, line_stride, step = W, H, 1, W
+    else:
+        lines, n, line_stride, step = H, W, W, 1
+    arr = xp.ascontiguousarray(arr)
+    out = xp.empty_like(arr)
+    if xp is np:
+        src = arr.reshape(-1, 4)
+        dst = out.reshape(-1, 4)
+        run_bands(lambda l0, l1: k["sort"](src, dst, l0, l1, n, line_stride, step, offset, limit, reverse),
+                  lines, band_rows(n))
+    else:
+        k["sort"](arr.reshape(-1), n, line_stride, step, offset, limit, reverse, out.reshape(-1), size=lines)
+    return out
+
+
+def blend(acc, top, cover, opacity, mode, dtype):
+    # Layer compositing on the CPU: acc is a float32 block, top the layer's
+    # pixels over it, cover its mask or None; the result is held to dtype.
+    # GPU blocks and float16 go through the array code in layers.py.
+    if backend.xp_of(acc) is not np or dtype == np.float16:
+        return False
+    k = _kernels(acc)
+    if k is None:
+        return False
+    if cover is None:
+        cover = np.empty((0, 0), np.float32)
+    k["blend"](acc, top, cover, np.float32(opacity), mode, dtype == np.uint8)
+    return True
+
+
+def warm_up(xp=np):
+    # Compiles the kernels for the working depths with a tiny image, so the
+    # first preview doesn't wait for it
+    import kernels
+    for dtype in (xp.uint8, xp.float32):
+        arr = xp.zeros((4, 4, 4), dtype)
+        kernels.colorize(arr)
+        kernels.colorize(arr, linear=True)
+        kernels.displace(arr)
+        kernels.pixelsort(arr)
+
+
+def check(xp=np, size=(97, 131), seed=0):
+    # Largest difference between each kernel and the reference code, over
+    # random images at every working depth and a spread of parameters
+    global enabled
+    import kernels
+    rng = np.random.default_rng(seed)
+    cases = [
+        ("colorize", {"colors": {"R": (255, 40, 0), "G": (10, 200, 90), "B": (30, 60, 255)}}),
+        ("colorize", {"colors": {"R": (255, 40, 0), "G": (10, 200, 90), "B": (30, 60, 255)}, "linear": True}),
+        ("displace", {"strength": 20}),
+        ("displace", {"strength": 80}),
+    ] + [("pixelsort", {"direction": d, "threshold": t, "offset": o})
+         for d in range(4) for t, o in ((0, 0), (40, 7), (100, 0))]
+    results = []
+    for dtype in (np.uint8, np.float16, np.float32):
+        img = rng.integers(0, 256, (size[0], size[1], 4)).astype(dtype)
+        # Flat patches so the sort has ties to keep in order
+        img[10:30, 20:60, :3] = 128
+        arr = backend.to_device(img, xp)
+        for name, params in cases:
+            enabled = True
+            try:
+                got = backend.to_host(kernels.EFFECTS[name](arr, **params)).astype(np.float64)
+                enabled = False
+                want = backend.to_host(kernels.EFFECTS[name](arr, **params)).astype(np.float64)
+            finally:
+                enabled = True
+            results.append((name, params, np.dtype(dtype).name, float(np.abs(got - want).max())))
+    return results
+
+
+def main():
+    backends = [np] + ([backend.cp] if backend.probe() else [])
+    cpu = _cpu_kernels() is not None
+    worst = 0.0
+    for xp in backends:
+        where = "gpu" if xp is not np else ("cpu (numba)" if cpu else "cpu (no numba, reference only)")
+        for name, params, dtype, diff in check(xp):
+            worst = max(worst, diff)
+            print(f"{where:<32}{name:<11}{dtype:<9}{diff:8.3f}  {params}")
+    # 8-bit results may differ by a rounding step where the kernels sum in
+    # a different order than the array code
+    return 0 if worst <= 1.0 else 1
+
+
+if __name__ == "__main__":
+    import sys
+    # Through the module kernels.py imports, not this __main__ copy
+    import fused
+    sys.exit(fused.main())
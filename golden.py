@@ -0,0 +1,190 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+from PyQt5.QtGui import QImage
+
+import backend
+from buffers import WORKING_DEPTHS, image_to_array, array_to_image, quantize
+from pipeline import Pipeline
+
+# Golden-image regression check for the effect kernels. Every case runs an
+# effect (or a short chain) with fixed parameters and seeds on a few
+# synthetic reference images and compares the 8-bit result with a stored
+# PNG in golden/. Runs headless on the CPU and, when CuPy has a device, on
+# the GPU too:
+#
+#   python golden.py                 check everything, exit 1 on a failure
+#   python golden.py --update        rewrite the goldens from the NumPy run
+#   python golden.py --only pixelsort --backend numpy --failures /tmp/out
+#
+# A case passes when no channel is further than max_abs levels from the
+# golden and the PSNR is at least min_psnr. Integer-exact effects allow no
+# difference; ones that round float maths get a level or two, since the
+# GPU and BLAS may sum in another order. The float working depths are held
+# to the same goldens with DEPTH_SLACK more, as they only differ from
+# 8-bit by where results are rounded.
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+SIZE = (48, 64)
+DEPTH_SLACK = 1
+
+EXACT = (0, float("inf"))
+ROUNDED = (1, 50.0)
+LOSSY = (3, 40.0)
+
+CASES = [
+    ("invert", [("invert", {})], EXACT),
+    ("saturation-gray", [("saturation", {"saturation": 0})], ROUNDED),
+    ("saturation-boost", [("saturation", {"saturation": 250})], ROUNDED),
+    ("saturation-linear", [("saturation", {"saturation": 180, "linear": True})], ROUNDED),
+    ("colorize-default", [("colorize", {})], ROUNDED),
+    ("colorize-mix", [("colorize", {"colors": {"R": (255, 40, 0), "G": (10, 200, 90), "B": (30, 60, 255)}})], ROUNDED),
+    ("colorize-linear", [("colorize", {"colors": {"R": (255, 40, 0), "G": (10, 200, 90), "B": (30, 60, 255)},
+                                       "linear": True})], ROUNDED),
+    ("noise", [("noise", {"amount": 35, "seed": 7})], EXACT),
+    ("scanlines", [("scanlines", {"intensity": 60, "thickness": 3})], ROUNDED),
+    ("dither-threshold", [("dither", {"method": "Threshold", "threshold": 50})], EXACT),
+    ("dither-bayer", [("dither", {"method": "Bayer/Ordered", "threshold": 40})], EXACT),
+    ("dither-random", [("dither", {"method": "Random", "threshold": 50, "seed": 3})], EXACT),
+    ("dither-floyd", [("dither", {"method": "Floyd-Steinberg", "threshold": 45})], EXACT),
+    ("halftone-6", [("halftone", {"dot_size": 6})], ROUNDED),
+    ("halftone-11", [("halftone", {"dot_size": 11})], ROUNDED),
+    ("pixelate-square", [("pixelate", {"blocksize": 8})], ROUNDED),
+    ("pixelate-hex", [("pixelate", {"blocksize": 10, "shape": "hex"})], ROUNDED),
+    ("pixelate-rect-median", [("pixelate", {"blocksize": 6, "shape": "rect 2:1", "stat": "median"})], ROUNDED),
+    ("pixelate-voronoi", [("pixelate", {"blocksize": 12, "shape": "voronoi"})], ROUNDED),
+    ("pixelsort-left", [("pixelsort", {"direction": 0})], EXACT),
+    ("pixelsort-right", [("pixelsort", {"direction": 1, "threshold": 40, "offset": 10})], EXACT),
+    ("pixelsort-bottom", [("pixelsort", {"direction": 3, "threshold": 20})], EXACT),
+    ("displace-30", [("displace", {"strength": 30})], EXACT),
+    ("displace-80", [("displace", {"strength": 80})], EXACT),
+    ("compression-q10", [("compression", {"quality": 10})], LOSSY),
+    ("compression-q50-444x3", [("compression", {"quality": 50, "subsampling": "4:4:4", "generations": 3})], LOSSY),
+    ("chain-pointwise", [("saturation", {"saturation": 140}), ("noise", {"amount": 15, "seed": 1}),
+                         ("scanlines", {"intensity": 40})], ROUNDED),
+    ("chain-sort-halftone", [("pixelsort", {"direction": 2, "threshold": 30}), ("halftone", {"dot_size": 8})], ROUNDED),
+]
+
+
+def reference_images(size=SIZE):
+    # Synthetic BGRA inputs, the same on every machine: smooth ramps with an
+    # alpha ramp, seeded noise, and flat shapes full of equal values
+    H, W = size
+    y, x = np.mgrid[0:H, 0:W]
+    images = {}
+
+    ramp = np.empty((H, W, 4), np.uint8)
+    ramp[..., 0] = x * 255 // (W - 1)
+    ramp[..., 1] = y * 255 // (H - 1)
+    ramp[..., 2] = (x + y) * 255 // (W + H - 2)
+    ramp[..., 3] = np.where(x > W // 2, 255 - (y * 200 // (H - 1)), 255)
+    images["ramp"] = ramp
+
+    images["noise"] = np.random.default_rng(1234).integers(0, 256, (H, W, 4)).astype(np.uint8)
+    images["noise"][..., 3] = 255
+
+    shapes = np.full((H, W, 4), (40, 90, 200, 255), np.uint8)
+    shapes[(x - W // 3) ** 2 + (y - H // 2) ** 2 < (H // 3) ** 2] = (250, 250, 250, 255)
+    shapes[H // 4:H * 3 // 4, W // 2:W * 7 // 8] = (10, 180, 60, 255)
+    shapes[:, ::7] = (0, 0, 0, 255)
+    images["shapes"] = shapes
+    return images
+
+
+def golden_path(case, image):
+    return os.path.join(GOLDEN_DIR, f"{case}-{image}.png")
+
+
+def render(steps, arr, xp=np, dtype=np.uint8):
+    # One case on one image -> the 8-bit BGRA result
+    return quantize(Pipeline(steps).run(arr.astype(dtype), xp))
+
+
+def compare(got, want):
+    # (max abs difference, PSNR in dB) over all four channels
+    diff = got.astype(np.int16) - want.astype(np.int16)
+    max_abs = int(np.abs(diff).max())
+    mse = float(np.mean(diff.astype(np.float64) ** 2))
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+    return max_abs, psnr
+
+
+def load(path):
+    image = QImage(path)
+    return image_to_array(image) if not image.isNull() else None
+
+
+def update(cases, images):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    for case, steps, _ in cases:
+        for image, arr in images.items():
+            array_to_image(render(steps, arr)).save(golden_path(case, image), "PNG")
+    return len(cases) * len(images)
+
+
+def check(cases, images, backends, depths, failures_dir=None, out=sys.stdout):
+    # Prints one line per failure and a summary, returns the failure count
+    failed = 0
+    total = 0
+    for xp in backends:
+        where = "cupy" if xp is not np else "numpy"
+        for depth in depths:
+            slack = 0 if WORKING_DEPTHS[depth] is np.uint8 else DEPTH_SLACK
+            for case, steps, (max_abs, min_psnr) in cases:
+                for image, arr in images.items():
+                    total += 1
+                    want = load(golden_path(case, image))
+                    if want is None:
+                        failed += 1
+                        print(f"MISSING {case}-{image}.png (run with --update)", file=out)
+                        continue
+                    got = render(steps, arr, xp, WORKING_DEPTHS[depth])
+                    diff, psnr = compare(got, want)
+                    if diff <= max_abs + slack and psnr >= min_psnr:
+                        continue
+                    failed += 1
+                    print(f"FAIL {where:<6}{depth:<14}{case:<24}{image:<8}max {diff:3d} (<= {max_abs + slack})"
+                          f"  psnr {psnr:6.2f} (>= {min_psnr})", file=out)
+                    if failures_dir:
+                        os.makedirs(failures_dir, exist_ok=True)
+                        name = f"{where}-{depth.replace(' ', '_')}-{case}-{image}.png"
+                        array_to_image(got).save(os.path.join(failures_dir, name), "PNG")
+    print(f"{total - failed}/{total} passed", file=out)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the effect kernels against stored golden images")
+    parser.add_argument("--update", action="store_true", help="rewrite the goldens from the NumPy 8-bit run")
+    parser.add_argument("--only", action="append", default=[], help="cases whose name starts with this")
+    parser.add_argument("--backend", choices=["numpy", "cupy", "all"], default="all",
+                        help="all runs CuPy too when a device is available")
+    parser.add_argument("--depth", choices=list(WORKING_DEPTHS) + ["all"], default="all")
+    parser.add_argument("--failures", default=None, help="folder to write failing results to")
+    args = parser.parse_args(argv)
+
+    cases = [c for c in CASES if not args.only or any(c[0].startswith(p) for p in args.only)]
+    if not cases:
+        parser.error("no cases match --only")
+    images = reference_images()
+    if args.update:
+        print(f"wrote {update(cases, images)} goldens to {GOLDEN_DIR}")
+        return 0
+
+    backends = []
+    if args.backend in ("numpy", "all"):
+        backends.append(np)
+    if args.backend in ("cupy", "all"):
+        if backend.probe():
+            backends.append(backend.cp)
+        elif args.backend == "cupy":
+            print("golden.py: no CuPy device", file=sys.stderr)
+            return 1
+    depths = list(WORKING_DEPTHS) if args.depth == "all" else [args.depth]
+    return 1 if check(cases, images, backends, depths, args.failures) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+import numpy as np
+
+from backend import xp_of
+
+# JPEG artifacts without a codec. The lossy steps of a baseline encoder are
+# reproduced directly on arrays: RGB to YCbCr, chroma subsampling, an 8x8
+# block DCT and rounding against the quality-scaled quant tables, then the
+# same steps back. Entropy coding is lossless, so it is skipped. The forward
+# transform of an image does not depend on the quality, so callers can keep
+# its coefficients and only requantize when the quality changes.
+
+SUBSAMPLING = ["4:2:0", "4:2:2", "4:4:4"]
+
+# Chroma block size in luma pixels, (rows, columns)
+FACTORS = {"4:2:0": (2, 2), "4:2:2": (1, 2), "4:4:4": (1, 1)}
+
+# ITU T.81 Annex K tables, the ones libjpeg scales by quality
+LUMA_QUANT = np.array([
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99],
+])
+
+CHROMA_QUANT = np.array([
+    [17, 18, 24, 47, 99, 99, 99, 99],
+    [18, 21, 26, 66, 99, 99, 99, 99],
+    [24, 26, 56, 99, 99, 99, 99, 99],
+    [47, 66, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+])
+
+
+def quant_table(base, quality):
+    # libjpeg's quality scaling, baseline tables limited to 1..255
+    quality = min(max(int(quality), 1), 100)
+    scale = 5000 // quality if quality < 50 else 200 - quality * 2
+    return np.clip((base * scale + 50) // 100, 1, 255).astype(np.float32)
+
+
+def _dct_matrix():
+    # Orthonormal DCT-II basis, rows are frequencies
+    k = np.arange(8)
+    m = np.cos((2 * k[None, :] + 1) * k[:, None] * np.pi / 16) * np.sqrt(2 / 8)
+    m[0] /= np.sqrt(2)
+    return m.astype(np.float32)
+
+
+DCT = _dct_matrix()
+
+
+class Coefficients:
+    # DCT coefficients of the Y, Cb and Cr planes of one image. Each plane
+    # keeps the image layout, the 8x8 block at (8 * i, 8 * j) holding the
+    # coefficients of the pixels there.
+    def __init__(self, planes, shape, subsampling):
+        self.planes = planes
+        self.shape = shape
+        self.subsampling = subsampling
+
+    @property
+    def nbytes(self):
+        return sum(p.nbytes for p in self.planes)
+
+
+def _transform(plane, left, right):
+    # left @ block @ right for every 8x8 block, as two large matrix products
+    # instead of one tiny product per block
+    h, w = plane.shape
+    out = (plane.reshape(h, w // 8, 8) @ right).reshape(h // 8, 8, w)
+    return (left @ out).reshape(h, w)
+
+
+def forward(arr, subsampling="4:2:0"):
+    # (H, W, 4) BGRA uint8 -> Coefficients. The image is padded to whole
+    # MCUs by repeating its edge pixels, as encoders do.
+    xp = xp_of(arr)
+    fy, fx = FACTORS[subsampling]
+    H, W = arr.shape[:2]
+    ph, pw = -H % (8 * fy), -W % (8 * fx)
+    src = xp.pad(arr[..., :3], ((0, ph), (0, pw), (0, 0)), mode="edge").astype(xp.float32)
+    b, g, r = src[..., 0], src[..., 1], src[..., 2]
+    y = 0.299 * r + 0.587 * g + 0.114 * b
+    cb = -0.168736 * r - 0.331264 * g + 0.5 * b + 128.0
+    cr = 0.5 * r - 0.418688 * g - 0.081312 * b + 128.0
+
+    basis = xp.asarray(DCT)
+    planes = []
+    for i, plane in enumerate((y, cb, cr)):
+        if i and (fy, fx) != (1, 1):
+            h, w = plane.shape
+            plane = plane.reshape(h // fy, fy, w // fx, fx).mean(axis=(1, 3))
+        planes.append(_transform(plane - 128.0, basis, basis.T))
+    return Coefficients(planes, (H, W), subsampling)
+
+
+def inverse(coefficients, quality, xp=None):
+    # Quantizes the coefficients for quality and decodes them to (H, W, 3)
+    # BGR uint8
+    planes = coefficients.planes
+    if xp is None:
+        xp = xp_of(planes[0])
+    fy, fx = FACTORS[coefficients.subsampling]
+    basis = xp.asarray(DCT)
+    decoded = []
+    for i, coef in enumerate(planes):
+        h, w = coef.shape
+        table = xp.asarray(quant_table(CHROMA_QUANT if i else LUMA_QUANT, quality))[:, None, :]
+        blocks = coef.reshape(h // 8, 8, w // 8, 8)
+        coef = (xp.rint(blocks / table) * table).reshape(h, w)
+        plane = _transform(coef, basis.T, basis)
+        if i == 0:
+            # Chroma stays centred on zero for the conversion below
+            plane += 128.0
+        decoded.append(plane)
+
+    # Chroma is upsampled by repetition, added to the luma of the fy x fx
+    # pixels each chroma sample covers by broadcasting
+    y, cb, cr = decoded
+    ph, pw = y.shape
+    luma = y.reshape(ph // fy, fy, pw // fx, fx)
+    out = xp.empty((ph // fy, fy, pw // fx, fx, 3), dtype=xp.float32)
+    terms = (1.772 * cb, -0.344136 * cb - 0.714136 * cr, 1.402 * cr)
+    for c, term in enumerate(terms):
+        out[..., c] = luma + term[:, None, :, None]
+    H, W = coefficients.shape
+    out = out.reshape(ph, pw, 3)[:H, :W]
+    xp.rint(out, out=out)
+    xp.clip(out, 0, 255, out=out)
+    return out.astype(xp.uint8)
+
+
+def compress(arr, quality=10, subsampling="4:2:0", generations=1, coefficients=None):
+    # generations encode/decode round trips at the same settings, the image
+    # being rounded to 8 bits in between like a file saved again and again.
+    # coefficients of arr can be passed in to skip the first transform.
+    if coefficients is None:
+        coefficients = forward(arr, subsampling)
+    out = arr.copy()
+    for n in range(max(1, int(generations))):
+        if n:
+            coefficients = forward(out, subsampling)
+        out[..., :3] = inverse(coefficients, quality)
+    return out
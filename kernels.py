@@ -0,0 +1,430 @@
+import numpy as np
+
+import derivatives
+import fused
+import jpeg
+from colorspace import to_linear, from_linear
+from derivatives import LUMA_B, LUMA_G, LUMA_R
+from backend import xp_of, to_host, to_device, hash32
+from bands import run_bands, band_rows
+from pixelate import pixelate as _pixelate
+
+# Effect kernels on (H, W, 4) arrays in Qt's ARGB32 memory order
+# (B, G, R, A), uint8 or float on the same 0..255 scale (see the working
+# depths in buffers.py). They run on whatever array module the input lives
+# on and return a new array of the input's dtype; the dialogs in effects.py,
+# the pipeline and headless tools all go through these.
+#
+# Pointwise effects are written as stages that work in place on a float32
+# chunk of rows starting at row y0, so the pipeline can run several of them
+# back to back on one tile. Stages with a linear option do their maths on
+# linear-light values and encode the result back to sRGB.
+#
+# Colorize, displace and pixel sort go through the one-pass kernels in
+# fused.py where there is one for the input; the *_reference functions are
+# the array versions used otherwise and to check the kernels against.
+
+
+def _luma(chunk):
+    return LUMA_R * chunk[..., 2] + LUMA_G * chunk[..., 1] + LUMA_B * chunk[..., 0]
+
+
+def invert_stage(chunk, y0, xp):
+    chunk[..., :3] = 255.0 - chunk[..., :3]
+
+
+def saturation_stage(chunk, y0, xp, saturation=100, luma=None, linear=False):
+    # luma can be passed in when the chunk is an unmodified source image
+    s = saturation / 100.0
+    if linear:
+        rgb = to_linear(chunk[..., :3])
+        gray = _luma(rgb)[..., None]
+    else:
+        rgb = chunk[..., :3]
+        gray = (_luma(chunk) if luma is None else luma[y0:y0 + chunk.shape[0]])[..., None]
+    rgb -= gray
+    rgb *= s
+    rgb += gray
+    if linear:
+        chunk[..., :3] = from_linear(rgb)
+
+
+def colorize_stage(chunk, y0, xp, colors=None, linear=False):
+    # colors maps each source channel to the (r, g, b) it is drawn with
+    if colors is None:
+        colors = {"R": (255, 0, 0), "G": (0, 255, 0), "B": (0, 0, 255)}
+    mix = np.array([
+        [colors["B"][2], colors["B"][1], colors["B"][0]],
+        [colors["G"][2], colors["G"][1], colors["G"][0]],
+        [colors["R"][2], colors["R"][1], colors["R"][0]],
+    ], dtype=np.float32)
+    if not fused.colorize(chunk, mix, linear):
+        colorize_reference(chunk, xp, mix, linear)
+
+
+def colorize_reference(chunk, xp, mix, linear=False):
+    if linear:
+        src = to_linear(chunk[..., :3]) / 255.0
+        chunk[..., :3] = from_linear(src @ to_linear(xp.asarray(mix)))
+    else:
+        src = chunk[..., :3] / 255.0
+        chunk[..., :3] = src @ xp.asarray(mix)
+
+
+def noise_stage(chunk, y0, xp, amount=20, seed=0):
+    max_noise = int(128 * amount / 100)
+    if max_noise == 0:
+        return
+    h, w = chunk.shape[:2]
+    idx = xp.arange(y0 * w * 3, (y0 + h) * w * 3, dtype=xp.uint32).reshape(h, w, 3)
+    idx += np.uint32((seed * 0x9E3779B9) & 0xFFFFFFFF)
+    # Depends only on the pixel position and the seed, not on the tiling
+    noise = hash32(idx) % np.uint32(2 * max_noise + 1)
+    chunk[..., :3] += noise.astype(xp.float32) - max_noise
+
+
+def scanlines_stage(chunk, y0, xp, intensity=50, thickness=2):
+    # Black lines composited source-over, as QPainter would draw them
+    a = intensity / 100.0
+    if a == 0:
+        return
+    rows = (xp.arange(y0, y0 + chunk.shape[0]) % (thickness * 2)) < thickness
+    lines = chunk[rows]
+    da = lines[..., 3:4] / 255.0
+    out_a = a + da * (1.0 - a)
+    keep = xp.where(out_a > 0, da * (1.0 - a) / xp.maximum(out_a, 1e-6), 0.0)
+    lines[..., :3] *= keep
+    lines[..., 3:4] = out_a * 255.0
+    chunk[rows] = lines
+
+
+POINTWISE = {
+    "invert": invert_stage,
+    "saturation": saturation_stage,
+    "colorize": colorize_stage,
+    "noise": noise_stage,
+    "scanlines": scanlines_stage,
+}
+
+
+def run_stages(arr, stages):
+    # stages is a list of (stage, params). On the GPU the whole frame is one
+    # band. On the CPU it is walked in row bands on the band pool, so each
+    # pixel is loaded and stored once for the whole run and only a band's
+    # worth of float32 is alive per thread.
+    if not isinstance(arr, np.ndarray):
+        return run_band(arr, stages)
+    H, W = arr.shape[:2]
+    out = np.empty_like(arr)
+    run_bands(lambda y0, y1: run_band(arr[y0:y1], stages, y0, out[y0:y1]), H, band_rows(W))
+    return out
+
+
+def run_band(arr, stages, y0=0, out=None):
+    # One float32 copy of the rows starting at y0, all stages applied in
+    # turn with clipping in between, one store back
+    xp = xp_of(arr)
+    chunk = arr.astype(xp.float32)
+    for stage, params in stages:
+        stage(chunk, y0, xp, **params)
+        xp.clip(chunk, 0, 255, out=chunk)
+    if (arr if out is None else out).dtype == xp.uint8:
+        # Rounded like buffers.quantize, not truncated by the cast
+        xp.rint(chunk, out=chunk)
+    if out is None:
+        return chunk if arr.dtype == chunk.dtype else chunk.astype(arr.dtype)
+    out[...] = chunk
+    return out
+
+
+def _pointwise(name):
+    stage = POINTWISE[name]
+
+    def kernel(arr, **params):
+        return run_stages(arr, [(stage, params)])
+
+    kernel.__name__ = name
+    return kernel
+
+
+invert = _pointwise("invert")
+
+
+def saturation(arr, saturation=100, linear=False):
+    if linear:
+        return run_stages(arr, [(saturation_stage, {"saturation": saturation, "linear": True})])
+    luma = derivatives.of(arr).luma()
+    return run_stages(arr, [(saturation_stage, {"saturation": saturation, "luma": luma})])
+
+
+colorize = _pointwise("colorize")
+noise = _pointwise("noise")
+scanlines = _pointwise("scanlines")
+
+
+BAYER = np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5]
+]) / 16 * 255
+
+
+def _dither_levels(y0, y1, x0, w, seed):
+    # Random thresholds for rows y0..y1 and columns x0..x0+w of the full
+    # image, a pure function of the position and the seed
+    seed_mix = np.uint32((seed * 0x9E3779B9) & 0xFFFFFFFF)
+    rows = hash32(np.arange(y0, y1, dtype=np.uint32)[:, None] + seed_mix)
+    return hash32(rows ^ np.arange(x0, x0 + w, dtype=np.uint32)[None, :]) & np.uint32(255)
+
+
+def dither(arr, method="Threshold", threshold=50, seed=0, origin=(0, 0)):
+    # Error diffusion walks the rows in order, so this always runs on the
+    # host, in one pass. The other modes decide every pixel on its own and
+    # run in row bands; their patterns sit on the full image's grid, origin
+    # being where arr starts in it.
+    xp = xp_of(arr)
+    src = to_host(arr)
+    luma = to_host(derivatives.of(arr).luma())
+    cutoff = int(255 * threshold / 100)
+    H, W = luma.shape
+    out = np.empty_like(src)
+
+    if method == "Floyd-Steinberg":
+        gray = luma.astype(np.int16)
+        # Apply threshold as a "contrast cutoff": pixels below threshold are forced black
+        below_thresh_mask = gray < cutoff
+        gray_above = gray.copy()
+        gray_above[below_thresh_mask] = cutoff
+        dithered = np.zeros_like(gray)
+        err = np.zeros_like(gray, dtype=np.int16)
+        for y in range(H):
+            old_row = gray_above[y] + err[y]
+            new_row = np.where(old_row < cutoff, 0, 255)
+            dithered[y] = new_row
+            quant_error = old_row - new_row
+            if y + 1 < H:
+                err[y + 1, :-1] += (quant_error[1:] * 3) // 16
+                err[y + 1] += (quant_error * 5) // 16
+                err[y + 1, 1:] += (quant_error[:-1] * 1) // 16
+            if W > 1:
+                err[y, 1:] += (quant_error[:-1] * 7) // 16
+        dithered[below_thresh_mask] = 0
+        out[...] = src
+        out[..., :3] = dithered[..., None]
+        return to_device(out, xp)
+
+    ox, oy = origin
+
+    def band(y0, y1):
+        gray = luma[y0:y1].astype(np.int16)
+        # Apply threshold as a "contrast cutoff": pixels below threshold are forced black
+        below_thresh_mask = gray < cutoff
+        gray_above = np.maximum(gray, cutoff)
+        if method == "Threshold":
+            dithered = np.where(below_thresh_mask, 0, 255)
+        elif method == "Bayer/Ordered":
+            levels = BAYER[np.arange(oy + y0, oy + y1)[:, None] % 4, np.arange(ox, ox + W)[None, :] % 4]
+            dithered = np.where(gray_above > levels, 255, 0)
+        elif method == "Random":
+            levels = _dither_levels(oy + y0, oy + y1, ox, W, seed)
+            dithered = np.where(gray_above > levels, 255, 0)
+        else:
+            dithered = gray
+        dithered[below_thresh_mask] = 0
+        out[y0:y1, :, :3] = dithered[..., None]
+        out[y0:y1, :, 3] = src[y0:y1, :, 3]
+
+    run_bands(band, H, band_rows(W))
+    return to_device(out, xp)
+
+
+def halftone(arr, dot_size=6, origin=(0, 0)):
+    # Antialiased dots on black, one per full dot_size block, radius and grey
+    # level from the block's mean brightness. Blocks sit on the full image's
+    # grid, origin being where arr starts in it.
+    xp = xp_of(arr)
+    H, W = arr.shape[:2]
+    out = xp.zeros_like(arr)
+    out[..., 3] = 255
+    if dot_size <= 0:
+        return out
+    sy, sx = -origin[1] % dot_size, -origin[0] % dot_size
+    bh, bw = (H - sy) // dot_size, (W - sx) // dot_size
+    if bh <= 0 or bw <= 0:
+        return out
+    ey, ex = sy + bh * dot_size, sx + bw * dot_size
+
+    gray_vals = derivatives.of(arr).block_means(dot_size, sy, sx, bh, bw)
+    radius = (gray_vals / 255.0 * (dot_size // 2)).astype(xp.int32)
+
+    half = dot_size // 2
+    local = xp.arange(dot_size, dtype=xp.float32) + 0.5 - half
+    dist = xp.sqrt(local[:, None] ** 2 + local[None, :] ** 2)
+    coverage = xp.clip(radius[:, None, :, None] - dist[None, :, None, :] + 0.5, 0.0, 1.0)
+    level = xp.floor(gray_vals)[:, None, :, None] * coverage
+    level = level.reshape(bh * dot_size, bw * dot_size)
+    if arr.dtype == xp.uint8:
+        level = xp.rint(level).astype(xp.uint8)
+    out[sy:ey, sx:ex, :3] = level[..., None]
+    return out
+
+
+def pixelate(arr, blocksize=8, shape="square", stat="mean", origin=(0, 0)):
+    out = arr.copy()
+    out[..., :3] = _pixelate(arr[..., :3], blocksize, shape=shape, stat=stat, xp=xp_of(arr), origin=origin)
+    return out
+
+
+def _sort_cutoff(threshold):
+    # Pixels at or below this brightness are left out of the sort
+    cutoff = int(255 * threshold / 100)
+    return -1 if cutoff == 0 else cutoff
+
+
+def pixelsort(arr, direction=0, threshold=0, offset=0):
+    out = fused.pixelsort(arr, direction >= 2, direction in (1, 3), offset, 3 * _sort_cutoff(threshold))
+    if out is None:
+        out = pixelsort_reference(arr, direction, threshold, offset)
+    return out
+
+
+def pixelsort_reference(arr, direction=0, threshold=0, offset=0):
+    # Stable, so pixels of equal brightness keep their order
+    xp = xp_of(arr)
+    cutoff = _sort_cutoff(threshold)
+    rgb = arr[..., :3]
+    H, W = rgb.shape[:2]
+    brightness = derivatives.of(arr).brightness()
+
+    if direction in [0, 1]:  # horizontal
+        mask = (xp.arange(W)[None, :] >= offset) & (brightness > cutoff)
+        indices = xp.argsort(xp.where(mask, brightness, -xp.inf), axis=1, kind="stable")
+        sorted_arr = xp.take_along_axis(rgb, indices[:, :, None], axis=1)
+        if direction == 1:  # right
+            sorted_arr = sorted_arr[:, ::-1, :]
+    else:  # vertical
+        mask = (xp.arange(H)[:, None] >= offset) & (brightness > cutoff)
+        indices = xp.argsort(xp.where(mask, brightness, -xp.inf), axis=0, kind="stable")
+        sorted_arr = xp.take_along_axis(rgb, indices[:, :, None], axis=0)
+        if direction == 3:  # bottom
+            sorted_arr = sorted_arr[::-1, :, :]
+
+    out = arr.copy()
+    out[..., :3] = sorted_arr
+    return out
+
+
+def displace(arr, strength=50):
+    out = fused.displace(arr, strength ** 1.5)
+    if out is None:
+        out = displace_reference(arr, strength)
+    return out
+
+
+def displace_reference(arr, strength=50):
+    xp = xp_of(arr)
+    scale = strength ** 1.5
+    rgb = arr[..., :3].astype(xp.float32)
+    H, W = rgb.shape[:2]
+
+    # Normalize [0,255] -> [-1,1]
+    norm = (rgb / 127.5) - 1.0
+    dx = norm[..., 0] * scale
+    dy = norm[..., 1] * scale
+
+    x, y = xp.meshgrid(xp.arange(W), xp.arange(H))
+    x2 = xp.clip((x + dx).astype(xp.int32), 0, W - 1)
+    y2 = xp.clip((y + dy).astype(xp.int32), 0, H - 1)
+
+    out = arr.copy()
+    out[..., :3] = arr[..., :3][y2, x2, :]
+    return out
+
+
+def compression(arr, quality=10, subsampling="4:2:0", generations=1):
+    # Simulated JPEG round trips (see jpeg.py). The first generation starts
+    # from the source's cached coefficients.
+    coefficients = derivatives.of(arr).dct(subsampling)
+    return jpeg.compress(arr, quality, subsampling, generations, coefficients)
+
+
+EFFECTS = {
+    "invert": invert,
+    "saturation": saturation,
+    "colorize": colorize,
+    "noise": noise,
+    "scanlines": scanlines,
+    "dither": dither,
+    "halftone": halftone,
+    "pixelate": pixelate,
+    "pixelsort": pixelsort,
+    "displace": displace,
+    "compression": compression,
+}
+
+
+# Margin that makes a region run crop the whole image
+FULL_FRAME = 1 << 62
+
+# Effects whose output depends on where a crop sits in the image take an
+# origin=(x, y) argument
+POSITIONAL = {"dither", "halftone", "pixelate"}
+
+
+def region_margin(name, params):
+    # (margin, align) for applying an effect to part of an image: how many
+    # pixels around a selection it reads, and the grid the crop has to be
+    # snapped to for the result inside the selection to match a full-frame
+    # run.
+    if name == "pixelate":
+        size = params.get("blocksize", 8)
+        shape = params.get("shape", "square")
+        if shape == "voronoi":
+            # A Voronoi cell can reach into the grid cells around its seed's
+            return size * 3, 1
+        if shape != "square":
+            size *= 2
+        return size, 1
+    if name == "halftone":
+        return params.get("dot_size", 6), 1
+    if name == "dither" and params.get("method") == "Floyd-Steinberg":
+        # Error diffusion carries from every pixel before it, so only a
+        # full-frame run gives the same result
+        return FULL_FRAME, 1
+    if name == "displace":
+        return int(np.ceil(params.get("strength", 50) ** 1.5)) + 1, 1
+    if name == "compression":
+        # Whole MCUs: 8x8 DCT blocks on subsampled chroma
+        fy, fx = jpeg.FACTORS[params.get("subsampling", "4:2:0")]
+        return 0, 8 * max(fy, fx)
+    return 0, 1
+
+
+# Parameters measured in image pixels, with the smallest value each takes,
+# for renders from a reduced copy of the image (see previews.Progressive)
+PIXEL_PARAMS = {
+    "halftone": {"dot_size": 2},
+    "pixelate": {"blocksize": 2},
+    "scanlines": {"thickness": 1},
+    "pixelsort": {"offset": 0},
+}
+
+
+def reduced_params(name, params, step):
+    # params for an image sampled at every step-th pixel, so the result
+    # looks like the full-size one scaled down
+    params = dict(params)
+    for key, smallest in PIXEL_PARAMS.get(name, {}).items():
+        if key in params:
+            params[key] = max(smallest, int(round(params[key] / step)))
+    if name == "displace":
+        # Pixels moved go with strength ** 1.5
+        params["strength"] = params.get("strength", 50) / step ** (2 / 3)
+    return params
+
+
+def apply(name, arr, origin=(0, 0), **params):
+    if name in POSITIONAL:
+        params["origin"] = origin
+    return EFFECTS[name](arr, **params)
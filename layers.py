@@ -0,0 +1,428 @@
+import numpy as np
+from PyQt5.QtWidgets import (
+    QWidget, QVBoxLayout, QHBoxLayout, QListWidget, QLabel, QSlider, QComboBox, QCheckBox, QPushButton
+)
+from PyQt5.QtCore import Qt, QTimer
+
+import fused
+import kernels
+from backend import xp_of
+from bands import run_bands, band_rows
+
+# Effect layers. A stack starts from the image on the canvas (its base);
+# every layer is an effect of that base, kept as its rendered output, and
+# blended over the layers under it with an opacity, a blend mode and an
+# optional mask. Changing how a layer is blended never re-runs its effect.
+#
+# The composite is only redone where it can have changed: the rect of the
+# layers that differ from the last composite. It is folded in row bands on
+# the band pool, starting from a cached composite of the layers below the
+# one being edited, so dragging a slider only blends that layer and the
+# ones above it.
+
+MAX_HISTORY = 20
+
+
+def _soft_light(a, b, xp):
+    # W3C soft light on 0..1 values
+    a = a / 255.0
+    b = b / 255.0
+    d = xp.where(a <= 0.25, ((16.0 * a - 12.0) * a + 4.0) * a, xp.sqrt(a))
+    return 255.0 * xp.where(b <= 0.5, a - (1.0 - 2.0 * b) * a * (1.0 - a), a + (2.0 * b - 1.0) * (d - a))
+
+
+# Blend of the layer (b) over what is under it (a), both RGB on 0..255
+BLEND_MODES = {
+    "normal": lambda a, b, xp: b,
+    "multiply": lambda a, b, xp: a * b / 255.0,
+    "screen": lambda a, b, xp: a + b - a * b / 255.0,
+    "overlay": lambda a, b, xp: xp.where(a <= 127.5, 2.0 * a * b / 255.0,
+                                         255.0 - 2.0 * (255.0 - a) * (255.0 - b) / 255.0),
+    "soft light": _soft_light,
+    "darken": lambda a, b, xp: xp.minimum(a, b),
+    "lighten": lambda a, b, xp: xp.maximum(a, b),
+    "difference": lambda a, b, xp: xp.abs(a - b),
+    "add": lambda a, b, xp: xp.minimum(a + b, 255.0),
+    "subtract": lambda a, b, xp: xp.maximum(a - b, 0.0),
+}
+# Modes by number, for the compiled kernel in fused.py
+MODE_INDEX = {mode: i for i, mode in enumerate(BLEND_MODES)}
+
+
+def render(base, name, params, selection=None):
+    # (output, x, y): the effect on the base, for the whole frame or just
+    # the selection's rect
+    if selection is None:
+        return kernels.apply(name, base, **params), 0, 0
+    return selection.effect(base, name, params), selection.rect.x(), selection.rect.y()
+
+
+def _settle(acc, dtype):
+    # Each layer's result is held to the working depth before the next is
+    # blended, as effects are, so a composite kept at that depth can be
+    # blended onto later and come out the same as a fold from the base
+    xp = xp_of(acc)
+    xp.clip(acc, 0, 255, out=acc)
+    if dtype == xp.uint8:
+        xp.rint(acc, out=acc)
+    elif dtype != xp.float32:
+        acc[...] = acc.astype(dtype)
+
+
+def _intersect(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    return (x0, y0, x1, y1) if x0 < x1 and y0 < y1 else None
+
+
+def _union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+class Layer:
+    # An effect's output placed at (x, y) and how it is blended. Layers are
+    # not edited in place; replace() makes a new one sharing the output, so
+    # a history state is just a list of layers.
+    def __init__(self, name, params, output, x=0, y=0, opacity=1.0, mode="normal", mask=None, visible=True):
+        self.name = name
+        self.params = params
+        self.output = output
+        self.x = x
+        self.y = y
+        self.opacity = opacity
+        self.mode = mode
+        # A Selection limiting where the layer shows, None for everywhere
+        self.mask = mask
+        self.visible = visible
+
+    def replace(self, **changes):
+        layer = Layer(self.name, self.params, self.output, self.x, self.y,
+                      self.opacity, self.mode, self.mask, self.visible)
+        layer.__dict__.update(changes)
+        return layer
+
+    def extent(self):
+        # (x0, y0, x1, y1) of the pixels the layer can change
+        h, w = self.output.shape[:2]
+        rect = (self.x, self.y, self.x + w, self.y + h)
+        if self.mask is not None:
+            r = self.mask.rect
+            rect = _intersect(rect, (r.x(), r.y(), r.x() + r.width(), r.y() + r.height()))
+        return rect
+
+    def shows(self):
+        return self.visible and self.opacity > 0 and self.extent() is not None
+
+    def blend_into(self, acc, x0, y0, dtype):
+        # Blends the layer into acc, a float32 block of the composite whose
+        # top left pixel is (x0, y0), held to the working dtype
+        h, w = acc.shape[:2]
+        rect = _intersect(self.extent(), (x0, y0, x0 + w, y0 + h))
+        if rect is None:
+            return
+        xp = xp_of(acc)
+        ix0, iy0, ix1, iy1 = rect
+        under = acc[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+        top = self.output[iy0 - self.y:iy1 - self.y, ix0 - self.x:ix1 - self.x]
+        cover = None
+        if self.mask is not None and self.mask.mask is not None:
+            mx, my = self.mask.rect.x(), self.mask.rect.y()
+            cover = self.mask.mask[iy0 - my:iy1 - my, ix0 - mx:ix1 - mx]
+        if fused.blend(under, top, cover, self.opacity, MODE_INDEX[self.mode], dtype):
+            return
+        top = top.astype(xp.float32)
+        if cover is None:
+            t = xp.float32(self.opacity)
+        else:
+            t = (xp.asarray(cover) * xp.float32(self.opacity))[..., None]
+        # All four channels at once on contiguous data: the mode blends
+        # colour, alpha is mixed as in normal
+        if self.mode != "normal":
+            alpha = top[..., 3].copy()
+            top = BLEND_MODES[self.mode](under, top, xp)
+            top[..., 3] = alpha
+        top -= under
+        top *= t
+        under += top
+        _settle(under, dtype)
+
+    def describe(self):
+        hidden = "" if self.visible else " (hidden)"
+        masked = " [mask]" if self.mask is not None else ""
+        return f"{self.name} - {self.mode} {round(self.opacity * 100)}%{masked}{hidden}"
+
+
+class LayerStack:
+    def __init__(self, base, pixmap):
+        # base is the working array the layers are rendered from, pixmap
+        # the base as shown, which effect dialogs read while the stack is up
+        self.base = base
+        self.pixmap = pixmap
+        self.layers = []
+        self.history = []
+        self.future = []
+        self._last_edit = None
+        # Layers the composite was made from, and the composite of the
+        # layers under the last edited one
+        self._shown = []
+        self._composite = None
+        self._below = ((), base)
+
+    def full_rect(self):
+        H, W = self.base.shape[:2]
+        return 0, 0, W, H
+
+    def _set(self, layers, edit=None):
+        # Slider drags on one layer's setting make a single history step
+        if edit is None or edit != self._last_edit:
+            self.history.append(self.layers)
+            del self.history[:-MAX_HISTORY]
+        self.future.clear()
+        self._last_edit = edit
+        self.layers = layers
+
+    def add(self, layer):
+        self._set(self.layers + [layer])
+
+    def replace(self, index, layer):
+        layers = list(self.layers)
+        layers[index] = layer
+        self._set(layers)
+
+    def update(self, index, **changes):
+        layers = list(self.layers)
+        layers[index] = layers[index].replace(**changes)
+        self._set(layers, (index, tuple(sorted(changes))))
+
+    def remove(self, index):
+        self._set(self.layers[:index] + self.layers[index + 1:])
+
+    def move(self, index, step):
+        other = index + step
+        if not 0 <= other < len(self.layers):
+            return False
+        layers = list(self.layers)
+        layers[index], layers[other] = layers[other], layers[index]
+        self._set(layers)
+        return True
+
+    def undo(self):
+        if not self.history:
+            return False
+        self.future.append(self.layers)
+        self.layers = self.history.pop()
+        self._last_edit = None
+        return True
+
+    def redo(self):
+        if not self.future:
+            return False
+        self.history.append(self.layers)
+        self.layers = self.future.pop()
+        self._last_edit = None
+        return True
+
+    def _dirty(self, old, new):
+        # Rect where the composites of the two lists can differ: the extents
+        # of layers in only one of them, or of those that changed order
+        old_ids = [id(layer) for layer in old]
+        new_ids = [id(layer) for layer in new]
+        changed = set(old_ids) ^ set(new_ids)
+        kept_old = [i for i in old_ids if i not in changed]
+        kept_new = [i for i in new_ids if i not in changed]
+        for a, b in zip(kept_old, kept_new):
+            if a != b:
+                changed.update((a, b))
+        rect = None
+        for layer in old + new:
+            if id(layer) in changed and layer.extent() is not None:
+                rect = _union(rect, layer.extent())
+        return rect
+
+    def _fold(self, src, layers, rect, out):
+        # Writes src with layers blended over it into out, inside rect
+        xp = xp_of(src)
+        x0, y0, x1, y1 = rect
+        active = [layer for layer in layers if layer.shows() and _intersect(layer.extent(), rect)]
+        if not active:
+            out[y0:y1, x0:x1] = src[y0:y1, x0:x1]
+            return
+
+        def band(a, b):
+            acc = src[y0 + a:y0 + b, x0:x1].astype(xp.float32)
+            for layer in active:
+                layer.blend_into(acc, x0, y0 + a, out.dtype)
+            out[y0 + a:y0 + b, x0:x1] = acc
+
+        if xp is np:
+            run_bands(band, y1 - y0, band_rows(x1 - x0))
+        else:
+            band(0, y1 - y0)
+
+    def composite(self):
+        # The stack flattened, a new array whenever anything changed
+        layers = list(self.layers)
+        if self._composite is not None and len(layers) == len(self._shown) and \
+                all(a is b for a, b in zip(layers, self._shown)):
+            return self._composite
+        k = 0
+        while k < min(len(layers), len(self._shown)) and layers[k] is self._shown[k]:
+            k += 1
+        below_layers, below = self._below
+        if tuple(layers[:k]) != below_layers:
+            # The first edit of another layer: the layers under it are
+            # composited once and kept for the edits that follow. A kept
+            # composite of some of them is built on.
+            j = len(below_layers)
+            if tuple(layers[:j]) != below_layers or j > k:
+                j, below = 0, self.base
+            below_layers = tuple(layers[:k])
+            start = below
+            below = start.copy()
+            self._fold(start, below_layers[j:], self.full_rect(), below)
+            self._below = (below_layers, below)
+        if self._composite is None:
+            self._composite = below.copy()
+            self._fold(below, layers[k:], self.full_rect(), self._composite)
+        else:
+            rect = self._dirty(self._shown, layers)
+            if rect is not None:
+                # Outside rect nothing changed. The shown composite is
+                # copied, never edited: its array is registered with it.
+                composite = self._composite.copy()
+                self._fold(below, layers[k:], rect, composite)
+                self._composite = composite
+        self._shown = layers
+        return self._composite
+
+
+class LayersPanel(QWidget):
+    # The current document's layer stack, top layer first. Edits go to the
+    # stack and changed_callback redraws the canvas; editing a layer's
+    # effect, setting its mask and flattening are up to the editor.
+    def __init__(self, changed_callback, edit_callback, mask_callback, flatten_callback, parent=None):
+        super().__init__(parent)
+        self.stack = None
+        self.changed_callback = changed_callback
+        self.edit_callback = edit_callback
+        self.mask_callback = mask_callback
+        self.flatten_callback = flatten_callback
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(4, 4, 4, 4)
+        layout.addWidget(QLabel("<layers>"))
+        self.layer_list = QListWidget()
+        self.layer_list.currentRowChanged.connect(self.on_row_changed)
+        self.layer_list.itemDoubleClicked.connect(lambda _: self.edit_callback(self.current_index()))
+        layout.addWidget(self.layer_list)
+
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItems(list(BLEND_MODES))
+        self.mode_combo.currentTextChanged.connect(lambda mode: self.set_value(mode=mode))
+        layout.addWidget(self.mode_combo)
+
+        self.opacity_label = QLabel("opacity: 100%")
+        self.opacity_slider = QSlider(Qt.Horizontal)
+        self.opacity_slider.setMinimum(0)
+        self.opacity_slider.setMaximum(100)
+        self.opacity_slider.valueChanged.connect(self.on_opacity_changed)
+        layout.addWidget(self.opacity_label)
+        layout.addWidget(self.opacity_slider)
+
+        self.visible_check = QCheckBox("visible")
+        self.visible_check.toggled.connect(lambda on: self.set_value(visible=on))
+        layout.addWidget(self.visible_check)
+
+        row = QHBoxLayout()
+        for label, slot in (("up", lambda: self.move(1)), ("down", lambda: self.move(-1)),
+                            ("delete", self.delete)):
+            button = QPushButton(label)
+            button.clicked.connect(slot)
+            row.addWidget(button)
+        layout.addLayout(row)
+
+        row = QHBoxLayout()
+        for label, slot in (("edit", lambda: self.edit_callback(self.current_index())),
+                            ("mask", lambda: self.mask_callback(self.current_index())),
+                            ("flatten", self.flatten_callback)):
+            button = QPushButton(label)
+            button.clicked.connect(slot)
+            row.addWidget(button)
+        layout.addLayout(row)
+        layout.addStretch()
+        self.setLayout(layout)
+
+        # Slider moves are composited at most once per tick
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(30)
+        self.timer.timeout.connect(self.changed_callback)
+
+    def current_index(self):
+        row = self.layer_list.currentRow()
+        if self.stack is None or row < 0:
+            return None
+        return len(self.stack.layers) - 1 - row
+
+    def set_stack(self, stack, index=None):
+        # Relists the stack, keeping the selected layer unless index is given
+        self.stack = stack
+        if index is None:
+            index = self.current_index()
+        self.layer_list.blockSignals(True)
+        self.layer_list.clear()
+        if stack is not None:
+            for layer in reversed(stack.layers):
+                self.layer_list.addItem(layer.describe())
+            if stack.layers:
+                index = len(stack.layers) - 1 if index is None else min(index, len(stack.layers) - 1)
+                self.layer_list.setCurrentRow(len(stack.layers) - 1 - index)
+        self.layer_list.blockSignals(False)
+        self.on_row_changed(self.layer_list.currentRow())
+
+    def on_row_changed(self, row):
+        index = self.current_index()
+        layer = self.stack.layers[index] if index is not None else None
+        for widget in (self.mode_combo, self.opacity_slider, self.visible_check):
+            widget.blockSignals(True)
+            widget.setEnabled(layer is not None)
+        if layer is not None:
+            self.mode_combo.setCurrentText(layer.mode)
+            self.opacity_slider.setValue(round(layer.opacity * 100))
+            self.opacity_label.setText(f"opacity: {round(layer.opacity * 100)}%")
+            self.visible_check.setChecked(layer.visible)
+        for widget in (self.mode_combo, self.opacity_slider, self.visible_check):
+            widget.blockSignals(False)
+
+    def on_opacity_changed(self, value):
+        self.opacity_label.setText(f"opacity: {value}%")
+        self.set_value(delay=True, opacity=value / 100.0)
+
+    def set_value(self, delay=False, **changes):
+        index = self.current_index()
+        if index is None:
+            return
+        self.stack.update(index, **changes)
+        row = self.layer_list.currentRow()
+        self.layer_list.item(row).setText(self.stack.layers[index].describe())
+        if delay:
+            self.timer.start()
+        else:
+            self.changed_callback()
+
+    def move(self, step):
+        index = self.current_index()
+        if index is not None and self.stack.move(index, step):
+            self.set_stack(self.stack, index + step)
+            self.changed_callback()
+
+    def delete(self):
+        index = self.current_index()
+        if index is not None:
+            self.stack.remove(index)
+            self.set_stack(self.stack, max(0, index - 1))
+            self.changed_callback()
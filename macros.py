@@ -0,0 +1,428 @@
+import os
+import re
+import sys
+import json
+import zlib
+import base64
+import ctypes
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PyQt5.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QListWidget,
+    QAbstractItemView, QDialogButtonBox, QFileDialog
+)
+from PyQt5.QtCore import QRect, QStandardPaths, QThread, pyqtSignal
+
+import bands
+import colorspace
+from backend import get_xp, xp_of, to_device, to_host
+from buffers import WORKING_DEPTHS, image_to_array, array_to_image, quantize
+from pipeline import Pipeline
+from selection import Selection
+
+# Recorded effect chains. A step is {"effect": name, "params": {...}}, plus
+# "rect": [x, y, w, h] when the effect was limited to a selection. Lasso and
+# mask selections also keep "mask", their 8-bit coverage over the rect,
+# zlib-compressed and base64-encoded. Macros are JSON files in
+# the library folder and a preset is simply a macro with one step. The
+# library also keeps the last parameters accepted for each effect, which
+# the dialogs open with.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+MAX_PREFIX_BYTES = 512 * 1024 * 1024
+UNSAFE_NAME_CHARS = re.compile(r"[^\w\- ]+")
+
+DWMWA_CAPTION_COLOR = 35
+
+
+def library_dir():
+    # Same place main.py keeps its app data
+    return os.path.join(
+        QStandardPaths.writableLocation(QStandardPaths.AppDataLocation),
+        "CachedWhale",
+        "macros"
+    )
+
+
+def make_step(name, params, selection=None):
+    # Round trip through JSON so a recorded step equals its saved copy
+    step = {"effect": name, "params": json.loads(json.dumps(params))}
+    if selection is not None:
+        r = selection.rect
+        step["rect"] = [r.x(), r.y(), r.width(), r.height()]
+        if selection.mask is not None:
+            coverage = np.rint(selection.mask * 255.0).astype(np.uint8)
+            step["mask"] = base64.b64encode(zlib.compress(coverage.tobytes(), 9)).decode("ascii")
+    return step
+
+
+def _step_selection(step, width, height):
+    # The recorded selection clipped to a width x height image, None if
+    # nothing of it is left
+    x, y, w, h = step["rect"]
+    rect = QRect(x, y, w, h).intersected(QRect(0, 0, width, height))
+    if rect.isEmpty():
+        return None
+    if "mask" not in step:
+        return Selection(rect)
+    coverage = np.frombuffer(zlib.decompress(base64.b64decode(step["mask"])), np.uint8).reshape(h, w)
+    top, left = rect.y() - y, rect.x() - x
+    coverage = coverage[top:top + rect.height(), left:left + rect.width()]
+    return Selection(rect, coverage.astype(np.float32) / 255.0)
+
+
+def step_key(step):
+    return json.dumps(step, sort_keys=True)
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+class MacroLibrary:
+    def __init__(self, folder):
+        self.folder = folder
+        # _path never gives a name starting with a dot, so no macro can
+        # overwrite this
+        self.defaults_path = os.path.join(folder, ".defaults.json")
+        os.makedirs(folder, exist_ok=True)
+        self._move_old_defaults()
+        self._defaults = {}
+        try:
+            with open(self.defaults_path, "r") as f:
+                data = json.load(f)
+                if isinstance(data, dict):
+                    self._defaults = data
+        except Exception:
+            pass
+
+    def _move_old_defaults(self):
+        # Defaults used to be kept in defaults.json, which is also where a
+        # macro called "defaults" is saved
+        old = os.path.join(self.folder, "defaults.json")
+        if os.path.exists(self.defaults_path) or not os.path.exists(old):
+            return
+        try:
+            with open(old, "r") as f:
+                data = json.load(f)
+            if isinstance(data, dict) and "steps" not in data:
+                os.replace(old, self.defaults_path)
+        except Exception:
+            pass
+
+    def _path(self, name):
+        safe = UNSAFE_NAME_CHARS.sub("_", name).strip() or "macro"
+        return os.path.join(self.folder, f"{safe}.json")
+
+    def names(self):
+        names = []
+        for entry in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, entry)
+            if entry.endswith(".json") and path != self.defaults_path:
+                names.append(entry[:-5])
+        return names
+
+    def load(self, name):
+        with open(self._path(name), "r") as f:
+            data = json.load(f)
+        return data.get("steps", [])
+
+    def save(self, name, steps):
+        _write_json(self._path(name), {"name": name, "steps": steps})
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    def defaults(self, effect):
+        return self._defaults.get(effect)
+
+    def remember(self, step):
+        self._defaults[step["effect"]] = step["params"]
+        try:
+            _write_json(self.defaults_path, self._defaults)
+        except OSError:
+            pass
+
+
+class PrefixCache:
+    # Intermediate results keyed by (source, step prefix), least recently
+    # used dropped first. Cached arrays are shared with callers and must not
+    # be edited in place.
+    def __init__(self, max_bytes=MAX_PREFIX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+    def longest(self, source, keys):
+        # (n, array) for the longest cached prefix of keys, (0, None) if none
+        for n in range(len(keys), 0, -1):
+            key = (source, tuple(keys[:n]))
+            arr = self._entries.get(key)
+            if arr is not None:
+                self._entries.move_to_end(key)
+                return n, arr
+        return 0, None
+
+    def store(self, source, keys, arr):
+        key = (source, tuple(keys))
+        if key in self._entries or arr.nbytes > self.max_bytes:
+            return
+        self._entries[key] = arr
+        self._nbytes += arr.nbytes
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+
+
+def _segments(steps, start, breaks):
+    # [start, end) runs of steps that go through one Pipeline: region steps
+    # stand alone, and a run also ends at every break
+    segments = []
+    s0 = start
+    for i in range(start, len(steps)):
+        if "rect" in steps[i]:
+            if s0 < i:
+                segments.append((s0, i))
+            segments.append((i, i + 1))
+            s0 = i + 1
+        elif i + 1 in breaks:
+            segments.append((s0, i + 1))
+            s0 = i + 1
+    if s0 < len(steps):
+        segments.append((s0, len(steps)))
+    return segments
+
+
+def _run_region(buf, step):
+    H, W = buf.shape[:2]
+    selection = _step_selection(step, W, H)
+    if selection is None:
+        return buf
+    return selection.frame(buf, step["effect"], dict(step["params"]))
+
+
+def run_steps(arr, steps, xp=None, cache=None, source=None, breaks=()):
+    # Applies steps in order. Whole-image steps between region steps go
+    # through one Pipeline, so adjacent pointwise effects fuse. With a cache
+    # the longest already computed prefix is picked up, and the result at
+    # the end of each run is stored for later replays sharing that prefix.
+    if xp is None:
+        xp = get_xp()
+    keys = [step_key(s) for s in steps]
+    start, buf = (0, None) if cache is None else cache.longest(source, keys)
+    buf = to_device(arr if buf is None else buf, xp)
+    for s0, s1 in _segments(steps, start, set(breaks)):
+        if "rect" in steps[s0]:
+            buf = _run_region(buf, steps[s0])
+        else:
+            pipeline = Pipeline([(s["effect"], s["params"]) for s in steps[s0:s1]])
+            buf = pipeline.run(buf, xp=xp_of(buf), keep_on_device=True)
+        if cache is not None:
+            cache.store(source, keys[:s1], buf)
+    return to_host(buf)
+
+
+def shared_prefixes(step_lists):
+    # For each list, the step counts at which it parts from another list;
+    # the intermediate there is worth keeping for the other one
+    keys = [[step_key(s) for s in steps] for steps in step_lists]
+    breaks = []
+    for i, a in enumerate(keys):
+        points = set()
+        for j, b in enumerate(keys):
+            if i == j:
+                continue
+            n = 0
+            while n < min(len(a), len(b)) and a[n] == b[n]:
+                n += 1
+            if n:
+                points.add(n)
+        breaks.append(points)
+    return breaks
+
+
+def list_images(folder):
+    return sorted(
+        os.path.join(folder, name) for name in os.listdir(folder)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def _batch_one(path, macros, out_dir, breaks, dtype=np.uint8):
+    # One image through every macro at the given working dtype; shared
+    # prefixes are computed once
+    image = colorspace.load(path)
+    if image.isNull():
+        raise ValueError(f"could not read {path}")
+    arr = image_to_array(image).astype(dtype, copy=False)
+    cache = PrefixCache()
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for (name, steps), points in zip(macros, breaks):
+        out = run_steps(arr, steps, cache=cache, source=path, breaks=points)
+        folder = os.path.join(out_dir, name) if len(macros) > 1 else out_dir
+        os.makedirs(folder, exist_ok=True)
+        array_to_image(quantize(out)).save(os.path.join(folder, f"{stem}.png"), "PNG")
+    return path
+
+
+def _batch_init():
+    # One image per process at a time, each on one core
+    bands.set_workers(1)
+
+
+def run_batch(paths, macros, out_dir, workers=None, progress=None, dtype=np.uint8):
+    # macros is [(name, steps)]; with several, each gets a subfolder of
+    # out_dir. Images are spread over spawned worker processes. Returns the
+    # list of (path, error) for images that failed.
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    breaks = shared_prefixes([steps for _, steps in macros])
+    errors = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_batch_init) as pool:
+        futures = {pool.submit(_batch_one, path, macros, out_dir, breaks, dtype): path for path in paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append((futures[future], str(e)))
+            if progress is not None:
+                progress(done, len(paths))
+    return errors
+
+
+class MacroThread(QThread):
+    # Replays steps on one image off the GUI thread
+    replayed = pyqtSignal(object)
+
+    def __init__(self, arr, steps, cache=None, source=None, parent=None):
+        super().__init__(parent)
+        self.arr = arr
+        self.steps = steps
+        self.cache = cache
+        self.source = source
+
+    def run(self):
+        self.replayed.emit(run_steps(self.arr, self.steps, cache=self.cache, source=self.source))
+
+
+class BatchThread(QThread):
+    progressed = pyqtSignal(int, int)
+    finished_batch = pyqtSignal(list)
+
+    def __init__(self, paths, macros, out_dir, dtype=np.uint8, parent=None):
+        super().__init__(parent)
+        self.paths = paths
+        self.macros = macros
+        self.out_dir = out_dir
+        self.dtype = dtype
+
+    def run(self):
+        errors = run_batch(self.paths, self.macros, self.out_dir, progress=self.progressed.emit, dtype=self.dtype)
+        self.finished_batch.emit(errors)
+
+
+class BatchDialog(QDialog):
+    def __init__(self, parent, names):
+        super().__init__(parent)
+        self.setWindowTitle("Batch Run Macros")
+        self.resize(360, 360)
+        self.set_titlebar_color(0x010101)
+        self.input_dir = ""
+        self.output_dir = ""
+
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("Macros (shared first steps run once):"))
+        self.macro_list = QListWidget()
+        self.macro_list.addItems(names)
+        self.macro_list.setSelectionMode(QAbstractItemView.MultiSelection)
+        layout.addWidget(self.macro_list)
+
+        input_row = QHBoxLayout()
+        input_btn = QPushButton("> input folder")
+        input_btn.clicked.connect(self.choose_input)
+        self.input_label = QLabel("none")
+        input_row.addWidget(input_btn)
+        input_row.addWidget(self.input_label, 1)
+        layout.addLayout(input_row)
+
+        output_row = QHBoxLayout()
+        output_btn = QPushButton("> output folder")
+        output_btn.clicked.connect(self.choose_output)
+        self.output_label = QLabel("none")
+        output_row.addWidget(output_btn)
+        output_row.addWidget(self.output_label, 1)
+        layout.addLayout(output_row)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+        self.setLayout(layout)
+
+    def choose_input(self):
+        folder = QFileDialog.getExistingDirectory(self, "Input Folder", self.input_dir)
+        if folder:
+            self.input_dir = folder
+            self.input_label.setText(folder)
+
+    def choose_output(self):
+        folder = QFileDialog.getExistingDirectory(self, "Output Folder", self.output_dir)
+        if folder:
+            self.output_dir = folder
+            self.output_label.setText(folder)
+
+    def selected_names(self):
+        return [item.text() for item in self.macro_list.selectedItems()]
+
+    def set_titlebar_color(self, color):
+        hwnd = int(self.winId())
+        color_ref = ctypes.c_uint(color)
+        ctypes.windll.dwmapi.DwmSetWindowAttribute(
+            hwnd,
+            DWMWA_CAPTION_COLOR,
+            ctypes.byref(color_ref),
+            ctypes.sizeof(color_ref)
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run saved macros over a folder of images")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("macros", nargs="+")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--library", default=None, help="macro folder, defaults to the editor's")
+    parser.add_argument("--depth", choices=list(WORKING_DEPTHS), default="8-bit",
+                        help="working precision between steps")
+    args = parser.parse_args(argv)
+
+    library = MacroLibrary(args.library or library_dir())
+    macros = [(name, library.load(name)) for name in args.macros]
+    paths = list_images(args.input)
+
+    def progress(done, total):
+        print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+
+    errors = run_batch(paths, macros, args.output, args.workers, progress, WORKING_DEPTHS[args.depth])
+    print(file=sys.stderr)
+    for path, error in errors:
+        print(f"{path}: {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,37 +1,47 @@
+import startup
+
 import sys
 import os
 import json
 import numpy as np
+from collections import deque
 import ctypes
 
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QPushButton, QFileDialog, QVBoxLayout, QGraphicsView,
     QGraphicsScene, QGraphicsPixmapItem, QHBoxLayout, QLabel, QStackedLayout,
     QMenuBar, QMenu, QAction, QSplitter, QDialog, QFormLayout, QLineEdit,
-    QCheckBox, QDialogButtonBox, QFrame
+    QCheckBox, QDialogButtonBox, QFrame, QComboBox, QTabBar, QSlider, QInputDialog,
+    QActionGroup
 )
 from PyQt5.QtGui import (
-    QPixmap, QImage, QColor, QFontDatabase, QFont, QPainter, QIcon, QBrush
+    QPixmap, QImage, QColor, QFontDatabase, QFont, QPainter, QIcon, QBrush,
+    QImageReader, QPainterPath, QPen
 )
 from PyQt5.QtCore import (
-    Qt, QRectF, pyqtSignal, QStandardPaths
+    Qt, QRectF, QSize, QTimer, pyqtSignal, QStandardPaths
 )
 from style import cmd_theme, hacker_theme
-from effects import (
-    CompressionDialog,
-    DitherDialog,
-    SaturationDialog,
-    ScanlinesDialog,
-    NoiseDialog,
-    HalftoneDialog,
-    PixelateDialog,
-    PixelSortDialog,
-    VectorDisplaceDialog,
-    ColorizeDialog,
-    PreferencesDialog
-)
+from resample import resample, FILTERS
+import buffers
+import kernels
+import colorspace
+import backend
+from backend import get_xp
+from session import Session, DecodeThread, RegionPatch, compact, restore
+from selection import Selection
+from scopes import ScopesPanel
+import frames
+import macros
+import layers
+from layers import LayersPanel
+from thumbcache import ThumbnailCache
+from browser import FolderBrowserDialog
+
+startup.mark("imports")
 
 MAX_RECENT = 5
+MEMORY_BUDGET = 1024 * 1024 * 1024
 
 APPDATA_DIR = os.path.join(
     QStandardPaths.writableLocation(QStandardPaths.AppDataLocation),
@@ -40,6 +50,9 @@ APPDATA_DIR = os.path.join(
 os.makedirs(APPDATA_DIR, exist_ok=True)
 
 RECENT_FILE = os.path.join(APPDATA_DIR, "recents.json")
+SPILL_DIR = os.path.join(APPDATA_DIR, "spill")
+THUMB_DIR = os.path.join(APPDATA_DIR, "thumbs")
+MACRO_DIR = os.path.join(APPDATA_DIR, "macros")
 
 DWMWA_USE_IMMERSIVE_CMD_THEME = 20
 DWMWA_CAPTION_COLOR = 35
@@ -59,7 +72,27 @@ HACKER_THEME = hacker_theme(
 
 theme_name = ""
 
+def resize_qimage(image, w, h, method):
+    # Resample premultiplied so transparent pixels don't bleed colour
+    image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
+    result = np.ascontiguousarray(resample(arr, w, h, method))
+    scaled_image = QImage(result.data, w, h, w * 4, QImage.Format_ARGB32_Premultiplied)
+    return scaled_image.convertToFormat(QImage.Format_ARGB32)
+
+
+def resize_frame(arr, w, h, method):
+    H, W = arr.shape[:2]
+    arr = np.ascontiguousarray(arr)
+    image = QImage(arr.data, W, H, W * 4, QImage.Format_ARGB32)
+    return buffers.image_to_array(resize_qimage(image, w, h, method))
+
+
 class CanvasView(QGraphicsView):
+    selection_changed = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.setRenderHints(self.renderHints() | QPainter.SmoothPixmapTransform)
@@ -74,8 +107,15 @@ class CanvasView(QGraphicsView):
         self.shift_pressed = False
 
         self.current_color = None
+        self.current_hsv = None
         self.show_color = False
 
+        # "pick" samples colours, "rect" and "lasso" drag out a selection
+        self.tool = "pick"
+        self.selection = None
+        self.drag_origin = None
+        self.drag_path = None
+
         self.setSceneRect(-16384, -16384, 32768, 32768)
 
         tile_size = 64
@@ -91,6 +131,52 @@ class CanvasView(QGraphicsView):
         painter.fillRect(rect, self.checkerboard_brush)
         super().drawBackground(painter, rect)
 
+    def drawForeground(self, painter: QPainter, rect: QRectF):
+        # Marching-ants outline, drawn over the scene so it survives the
+        # scene being rebuilt for every preview
+        path = self.drag_path
+        if path is None and self.selection is not None:
+            path = self.selection.outline
+        if path is None:
+            return
+        for color, offset in ((Qt.black, 0), (Qt.white, 4)):
+            pen = QPen(color, 0, Qt.DashLine)
+            pen.setCosmetic(True)
+            pen.setDashOffset(offset)
+            painter.setPen(pen)
+            painter.setBrush(Qt.NoBrush)
+            painter.drawPath(path)
+
+    def set_tool(self, tool):
+        self.tool = tool
+        self.setCursor(Qt.ArrowCursor if tool == "pick" else Qt.CrossCursor)
+
+    def set_selection(self, selection):
+        self.selection = selection
+        self.drag_path = None
+        self.viewport().update()
+        self.selection_changed.emit()
+
+    def clear_selection(self):
+        if self.selection is not None or self.drag_path is not None:
+            self.set_selection(None)
+
+    def select_all(self):
+        if self.image_item_exists():
+            size = self.image_item.pixmap().size()
+            path = QPainterPath()
+            path.addRect(QRectF(0, 0, size.width(), size.height()))
+            self.set_selection(Selection.from_path(path, size.width(), size.height()))
+
+    def finish_selection(self):
+        path, self.drag_path = self.drag_path, None
+        size = self.image_item.pixmap().size()
+        if path.boundingRect().width() < 1 or path.boundingRect().height() < 1:
+            # A click without a drag drops the selection
+            self.set_selection(None)
+        else:
+            self.set_selection(Selection.from_path(path, size.width(), size.height()))
+
     def wheelEvent(self, event):
         if event.angleDelta().y() > 0:
             self.scale(self.zoom_factor, self.zoom_factor)
@@ -106,7 +192,11 @@ class CanvasView(QGraphicsView):
             self.left_mouse_pressed = True
             self.last_mouse_pos = event.pos()
 
-            if self.image_item_exists():
+            if self.tool != "pick" and not self.shift_pressed:
+                if self.image_item_exists():
+                    self.drag_origin = self.mapToScene(event.pos())
+                    self.drag_path = QPainterPath(self.drag_origin)
+            elif self.image_item_exists():
                 scene_pos = self.mapToScene(event.pos())
                 self.pick_color_at(scene_pos)
                 self.show_color = True
@@ -133,6 +223,14 @@ class CanvasView(QGraphicsView):
 
             self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() - delta.x())
             self.verticalScrollBar().setValue(self.verticalScrollBar().value() - delta.y())
+        elif self.left_mouse_pressed and self.drag_path is not None:
+            scene_pos = self.mapToScene(event.pos())
+            if self.tool == "rect":
+                self.drag_path = QPainterPath()
+                self.drag_path.addRect(QRectF(QRectF(self.drag_origin, scene_pos).normalized().toRect()))
+            else:
+                self.drag_path.lineTo(scene_pos)
+            self.viewport().update()
         elif self.left_mouse_pressed and self.image_item_exists():
             scene_pos = self.mapToScene(event.pos())
             self.pick_color_at(scene_pos)
@@ -149,8 +247,12 @@ class CanvasView(QGraphicsView):
         elif event.button() == Qt.LeftButton:
             self.left_mouse_pressed = False
             self.show_color = False
+            if self.drag_path is not None:
+                if self.tool == "lasso":
+                    self.drag_path.closeSubpath()
+                self.finish_selection()
             self.viewport().update()
-            self.setCursor(Qt.ArrowCursor)
+            self.setCursor(Qt.ArrowCursor if self.tool == "pick" else Qt.CrossCursor)
         else:
             super().mouseReleaseEvent(event)
     
@@ -169,11 +271,18 @@ class CanvasView(QGraphicsView):
         return False
 
     def pick_color_at(self, scene_pos):
+        # Reads one pixel of the resident array instead of converting the
+        # whole pixmap on every mouse move; only that pixel goes to HSV
         if self.image_item:
-            img = self.image_item.pixmap().toImage()
+            pixmap = self.image_item.pixmap()
             x, y = int(scene_pos.x()), int(scene_pos.y())
-            if 0 <= x < img.width() and 0 <= y < img.height():
-                self.current_color = QColor(img.pixel(x, y))
+            if 0 <= x < pixmap.width() and 0 <= y < pixmap.height():
+                derived = buffers.derived(pixmap)
+                b, g, r, a = (int(v) for v in derived.arr[y, x])
+                self.current_color = QColor(r, g, b, a)
+                h, s, v, _ = self.current_color.getHsvF()
+                # Qt gives -1 for the hue of greys
+                self.current_hsv = (max(h, 0.0) * 360.0, s, v)
     
     def paintEvent(self, event):
         super().paintEvent(event)
@@ -181,7 +290,7 @@ class CanvasView(QGraphicsView):
             painter = QPainter(self.viewport())
             try:
                 # Background box
-                box_width, box_height = 150, 60
+                box_width, box_height = 170, 76
                 rect = QRectF(10, 10, box_width, box_height)
                 painter.setBrush(QColor(0, 0, 0, 180))  # translucent dark bg
                 painter.setPen(Qt.NoPen)
@@ -204,6 +313,9 @@ class CanvasView(QGraphicsView):
                 painter.setPen(Qt.white)
                 painter.drawText(int(rect.x()) + 60, int(rect.y()) + 25, hex_text)
                 painter.drawText(int(rect.x()) + 60, int(rect.y()) + 45, rgba_text)
+                if self.current_hsv is not None:
+                    h, s, v = self.current_hsv
+                    painter.drawText(int(rect.x()) + 60, int(rect.y()) + 65, f"hsv({h:.0f}, {s * 100:.0f}%, {v * 100:.0f}%)")
 
             finally:
                 painter.end()
@@ -211,8 +323,9 @@ class CanvasView(QGraphicsView):
 
 
 class StartPage(QWidget):
-    def __init__(self, recent_images, import_callback, recent_callback):
+    def __init__(self, recent_images, import_callback, recent_callback, thumbnail_callback=None):
         super().__init__()
+        self.thumbnail_callback = thumbnail_callback
         layout = QVBoxLayout()
         layout.setAlignment(Qt.AlignLeft | Qt.AlignTop)
         title_layout = QHBoxLayout()
@@ -242,21 +355,28 @@ class StartPage(QWidget):
         layout.addWidget(recent_label, alignment=Qt.AlignLeft)
         self.recent_buttons = []
         for path in recent_images:
-            btn = QPushButton(path)
-            btn.setStyleSheet("text-align: left; min-width: 320px; margin-bottom: 4px; padding: 8px;")
-            btn.clicked.connect(lambda _, p=path: recent_callback(p))
+            btn = self.make_recent_button(path, recent_callback)
             layout.addWidget(btn, alignment=Qt.AlignLeft)
             self.recent_buttons.append(btn)
         self.setLayout(layout)
 
+    def make_recent_button(self, path, recent_callback):
+        btn = QPushButton(path)
+        btn.setStyleSheet("text-align: left; min-width: 320px; margin-bottom: 4px; padding: 8px;")
+        btn.clicked.connect(lambda _, p=path: recent_callback(p))
+        if self.thumbnail_callback:
+            thumb = self.thumbnail_callback(path)
+            if thumb is not None:
+                btn.setIcon(QIcon(thumb))
+                btn.setIconSize(QSize(48, 48))
+        return btn
+
     def update_recents(self, recent_images, recent_callback):
         for btn in self.recent_buttons:
             btn.setParent(None)
         self.recent_buttons.clear()
         for path in recent_images:
-            btn = QPushButton(path)
-            btn.setStyleSheet("text-align: left; min-width: 320px; margin-bottom: 4px; padding: 8px;")
-            btn.clicked.connect(lambda _, p=path: recent_callback(p))
+            btn = self.make_recent_button(path, recent_callback)
             self.layout().addWidget(btn, alignment=Qt.AlignLeft)
             self.recent_buttons.append(btn)
 
@@ -266,7 +386,7 @@ class ResizeDialog(QDialog):
         super().__init__()
 
         self.setWindowTitle("resize image")
-        self.setFixedSize(260, 120)
+        self.setFixedSize(260, 160)
         self.setStyleSheet(CMD_THEME)
 
         self.orig_w = orig_w
@@ -278,8 +398,11 @@ class ResizeDialog(QDialog):
         self.height_edit = QLineEdit(str(orig_h))
         self.lock_aspect = QCheckBox("lock aspect ratio")
         self.lock_aspect.setChecked(True)
+        self.filter_combo = QComboBox()
+        self.filter_combo.addItems(FILTERS)
         layout.addRow("width >", self.width_edit)
         layout.addRow("height >", self.height_edit)
+        layout.addRow("filter >", self.filter_combo)
         layout.addRow(self.lock_aspect)
         buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         layout.addRow(buttons)
@@ -316,21 +439,22 @@ class ResizeDialog(QDialog):
         try:
             w = int(self.width_edit.text())
             h = int(self.height_edit.text())
-            return w, h
+            if w > 0 and h > 0:
+                return w, h
         except Exception:
-            return self.orig_w, self.orig_h
+            pass
+        return self.orig_w, self.orig_h
+
+    def get_filter(self):
+        return self.filter_combo.currentText()
 
 class ImageEditor(QWidget):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Cached Whale")
         self.resize(900, 600)
-        font_path = os.path.join(os.path.dirname(__file__), "fonts", "lcd.TTF")
-        if os.path.exists(font_path):
-            font_id = QFontDatabase.addApplicationFont(font_path)
-            families = QFontDatabase.applicationFontFamilies(font_id)
-            if families:
-                self.setFont(QFont(families[0], 12))
+        # Only the Minecraft face is needed for the first frame, the themes
+        # use it; the LCD face is registered once the window is up
         font_path = os.path.join(os.path.dirname(__file__), "fonts", "minecraft.ttf")
         if os.path.exists(font_path):
             font_id = QFontDatabase.addApplicationFont(font_path)
@@ -338,6 +462,7 @@ class ImageEditor(QWidget):
             if families:
                 self.setFont(QFont(families[0], 12))
         self.setStyleSheet(CMD_THEME)
+        startup.mark("fonts + theme")
 
         self.set_titlebar_color(0x010101)
 
@@ -350,14 +475,25 @@ class ImageEditor(QWidget):
         self.current_image_path = None
         self.inverted_pixmap = None
 
-        self.undo_stack = []
-        self.redo_stack = []
+        self.session = Session(SPILL_DIR, MEMORY_BUDGET)
+        self.thumb_cache = ThumbnailCache(THUMB_DIR)
+        self.warm_up_thread = None
+
+        # Every accepted effect is recorded as a step; recordings are saved
+        # as macros, and replays share intermediates through prefix_cache
+        self.macros = macros.MacroLibrary(MACRO_DIR)
+        self.recording = []
+        self.prefix_cache = macros.PrefixCache()
+        self.macro_thread = None
+        self.batch_thread = None
+        self.loading_path = None
 
         self.stacked_layout = QStackedLayout()
         self.start_page = StartPage(
             self.recent_images,
             self.load_image_dialog,
-            self.load_recent_image
+            self.load_recent_image,
+            self.recent_thumbnail
         )
 
         self.sidebar = QWidget()
@@ -423,14 +559,51 @@ class ImageEditor(QWidget):
         self.save_image_btn.setEnabled(False)
         sidebar_layout.addWidget(self.save_image_btn)
 
+        self.scopes = ScopesPanel()
+
+        # Shown while the current document has a layer stack. editing_layer
+        # is the layer whose effect dialog was reopened from the panel.
+        self.editing_layer = None
+        self.layers_panel = LayersPanel(self.draw_layers, self.edit_layer, self.mask_layer, self.flatten_layers)
+        self.layers_panel.hide()
+
         self.splitter = QSplitter(Qt.Horizontal)
         self.splitter.addWidget(self.canvas)
         self.splitter.addWidget(self.sidebar)
-        self.splitter.setSizes([700, 100])
+        self.splitter.addWidget(self.scopes)
+        self.splitter.addWidget(self.layers_panel)
+        self.splitter.setSizes([600, 100, 220, 180])
+
+        self.tab_bar = QTabBar()
+        self.tab_bar.setTabsClosable(True)
+        self.tab_bar.setExpanding(False)
+        self.tab_bar.setDocumentMode(True)
+        self.tab_bar.currentChanged.connect(self.on_tab_changed)
+        self.tab_bar.tabCloseRequested.connect(self.on_tab_close_requested)
+
         canvas_page = QWidget()
-        canvas_layout = QHBoxLayout()
+        canvas_layout = QVBoxLayout()
         canvas_layout.setContentsMargins(0, 0, 0, 0)
+        canvas_layout.addWidget(self.tab_bar)
         canvas_layout.addWidget(self.splitter)
+
+        # Frame picker for animations and image sequences
+        self.frame_index = 0
+        self.sequence_thread = None
+        self.frame_jobs = deque()
+        self.export_thread = None
+        self.frame_bar = QWidget()
+        frame_layout = QHBoxLayout()
+        frame_layout.setContentsMargins(6, 0, 6, 4)
+        self.frame_slider = QSlider(Qt.Horizontal)
+        self.frame_slider.setMinimum(0)
+        self.frame_slider.valueChanged.connect(self.show_frame)
+        self.frame_label = QLabel("")
+        frame_layout.addWidget(self.frame_slider)
+        frame_layout.addWidget(self.frame_label)
+        self.frame_bar.setLayout(frame_layout)
+        self.frame_bar.hide()
+        canvas_layout.addWidget(self.frame_bar)
         canvas_page.setLayout(canvas_layout)
 
         self.stacked_layout.addWidget(self.start_page)
@@ -445,6 +618,29 @@ class ImageEditor(QWidget):
         open_action.triggered.connect(self.load_image_dialog)
         file_menu.addAction(open_action)
 
+        sequence_action = QAction("Open Frame &Sequence...", self)
+        sequence_action.triggered.connect(self.load_sequence_dialog)
+        file_menu.addAction(sequence_action)
+
+        export_action = QAction("&Export Animation...", self)
+        export_action.triggered.connect(self.export_animation_dialog)
+        file_menu.addAction(export_action)
+
+        browse_action = QAction("&Browse Folder...", self)
+        browse_action.setShortcut("Ctrl+Shift+O")
+        browse_action.triggered.connect(self.browse_folder_dialog)
+        file_menu.addAction(browse_action)
+
+        next_tab_action = QAction("Next Image", self)
+        next_tab_action.setShortcut("Ctrl+Tab")
+        next_tab_action.triggered.connect(lambda: self.cycle_document(1))
+        self.addAction(next_tab_action)
+
+        prev_tab_action = QAction("Previous Image", self)
+        prev_tab_action.setShortcut("Ctrl+Shift+Tab")
+        prev_tab_action.triggered.connect(lambda: self.cycle_document(-1))
+        self.addAction(prev_tab_action)
+
         close_action = QAction("&Close Image", self)
         close_action.setShortcut("Ctrl+W")
         close_action.triggered.connect(self.close_image)
@@ -482,6 +678,16 @@ class ImageEditor(QWidget):
         edit_menu.addAction(resize_action)
         self.menu_bar.addMenu(edit_menu)
 
+        depth_menu = QMenu("Working &Depth", self)
+        depth_group = QActionGroup(self)
+        for name in buffers.WORKING_DEPTHS:
+            depth_action = QAction(name, self, checkable=True)
+            depth_action.setChecked(buffers.WORKING_DEPTHS[name] is buffers.working_dtype())
+            depth_action.triggered.connect(lambda checked, n=name: buffers.set_working_depth(n))
+            depth_group.addAction(depth_action)
+            depth_menu.addAction(depth_action)
+        edit_menu.addMenu(depth_menu)
+
         edit_menu.addSeparator()
 
         preferences_menu = QAction("&Preferences", self)
@@ -490,6 +696,79 @@ class ImageEditor(QWidget):
         edit_menu.addAction(preferences_menu)
         self.menu_bar.addMenu(edit_menu)
 
+        select_menu = QMenu("&Select", self)
+
+        pick_action = QAction("Colour &Picker", self)
+        pick_action.setShortcut("I")
+        pick_action.triggered.connect(lambda: self.canvas.set_tool("pick"))
+        select_menu.addAction(pick_action)
+
+        rect_action = QAction("&Rectangle", self)
+        rect_action.setShortcut("M")
+        rect_action.triggered.connect(lambda: self.canvas.set_tool("rect"))
+        select_menu.addAction(rect_action)
+
+        lasso_action = QAction("&Lasso", self)
+        lasso_action.setShortcut("L")
+        lasso_action.triggered.connect(lambda: self.canvas.set_tool("lasso"))
+        select_menu.addAction(lasso_action)
+
+        mask_action = QAction("Load &Mask...", self)
+        mask_action.triggered.connect(self.load_mask_dialog)
+        select_menu.addAction(mask_action)
+
+        select_menu.addSeparator()
+
+        select_all_action = QAction("Select &All", self)
+        select_all_action.setShortcut("Ctrl+A")
+        select_all_action.triggered.connect(self.canvas.select_all)
+        select_menu.addAction(select_all_action)
+
+        deselect_action = QAction("&Deselect", self)
+        deselect_action.setShortcut("Ctrl+D")
+        deselect_action.triggered.connect(self.canvas.clear_selection)
+        select_menu.addAction(deselect_action)
+
+        self.menu_bar.addMenu(select_menu)
+
+        view_menu = QMenu("&View", self)
+        scopes_action = QAction("&Scopes", self)
+        scopes_action.setCheckable(True)
+        scopes_action.setChecked(True)
+        scopes_action.setShortcut("Ctrl+Shift+H")
+        scopes_action.toggled.connect(self.scopes.setVisible)
+        view_menu.addAction(scopes_action)
+        self.menu_bar.addMenu(view_menu)
+
+        macro_menu = QMenu("&Macros", self)
+        save_macro_action = QAction("&Save Recording as Macro...", self)
+        save_macro_action.triggered.connect(self.save_macro_dialog)
+        macro_menu.addAction(save_macro_action)
+        save_preset_action = QAction("Save Last Step as &Preset...", self)
+        save_preset_action.triggered.connect(self.save_preset_dialog)
+        macro_menu.addAction(save_preset_action)
+        clear_recording_action = QAction("&Clear Recording", self)
+        clear_recording_action.triggered.connect(self.recording.clear)
+        macro_menu.addAction(clear_recording_action)
+        macro_menu.addSeparator()
+        self.run_macro_menu = QMenu("&Run Macro", self)
+        self.run_macro_menu.aboutToShow.connect(self.update_macro_menu)
+        macro_menu.addMenu(self.run_macro_menu)
+        batch_action = QAction("&Batch Run on Folder...", self)
+        batch_action.triggered.connect(self.batch_macro_dialog)
+        macro_menu.addAction(batch_action)
+        self.menu_bar.addMenu(macro_menu)
+
+        layers_menu = QMenu("&Layers", self)
+        start_layers_action = QAction("&Start Layer Stack", self)
+        start_layers_action.setShortcut("Ctrl+Shift+L")
+        start_layers_action.triggered.connect(self.start_layers)
+        layers_menu.addAction(start_layers_action)
+        flatten_action = QAction("&Flatten Layers", self)
+        flatten_action.triggered.connect(self.flatten_layers)
+        layers_menu.addAction(flatten_action)
+        self.menu_bar.addMenu(layers_menu)
+
         self.shortcut_zoom = QAction(self)
         self.shortcut_zoom.setShortcut("Z")
         self.shortcut_zoom.triggered.connect(self.zoom_100)
@@ -504,16 +783,83 @@ class ImageEditor(QWidget):
 
         self.setLayout(main_layout)
 
+    @property
+    def undo_stack(self):
+        doc = self.session.current
+        return doc.undo_stack if doc else []
+
+    @property
+    def redo_stack(self):
+        doc = self.session.current
+        return doc.redo_stack if doc else []
+
     def close_image(self):
+        doc = self.session.current
+        if doc is None:
+            self.show_start_page()
+            return
+        index = self.session.documents.index(doc)
+        self.drop_layers(doc)
+        self.session.close(doc)
+        self.tab_bar.blockSignals(True)
+        self.tab_bar.removeTab(index)
+        self.tab_bar.blockSignals(False)
+        if self.session.current is not None:
+            self.show_document(self.session.current)
+            return
         self.scene.clear()
         self.image_item = None
         self.current_image_path = None
         self.inverted_pixmap = None
         self.save_image_btn.setEnabled(False)
-        self.undo_stack.clear()
-        self.redo_stack.clear()
+        self.scopes.clear()
+        self.layers_panel.hide()
         self.show_start_page()
 
+    def show_document(self, doc):
+        self.loading_path = None
+        self.session.activate(doc)
+        self.tab_bar.blockSignals(True)
+        self.tab_bar.setCurrentIndex(self.session.documents.index(doc))
+        self.tab_bar.blockSignals(False)
+        self.current_image_path = doc.path
+        self.inverted_pixmap = None
+        self.canvas.clear_selection()
+        self.editing_layer = None
+        if doc.layers is None:
+            self.set_canvas_pixmap(doc.current_pixmap(), push=False)
+        self.show_layers()
+        self.update_frame_bar()
+        self.show_canvas()
+
+    def on_tab_changed(self, index):
+        if 0 <= index < len(self.session.documents):
+            self.show_document(self.session.documents[index])
+
+    def on_tab_close_requested(self, index):
+        doc = self.session.documents[index]
+        if doc is not self.session.current:
+            self.drop_layers(doc)
+            self.session.close(doc)
+            self.tab_bar.blockSignals(True)
+            self.tab_bar.removeTab(index)
+            self.tab_bar.setCurrentIndex(self.session.documents.index(self.session.current))
+            self.tab_bar.blockSignals(False)
+        else:
+            self.close_image()
+
+    def cycle_document(self, step):
+        count = self.tab_bar.count()
+        if count > 1:
+            self.tab_bar.setCurrentIndex((self.tab_bar.currentIndex() + step) % count)
+
+    def refresh_tab(self, doc=None):
+        if doc is None:
+            doc = self.session.current
+        if doc is not None:
+            index = self.session.documents.index(doc)
+            self.tab_bar.setTabIcon(index, QIcon(self.session.thumbnail(doc)))
+
     def clear_recents(self):
         self.recent_images = []
         self.save_recent_images()
@@ -553,38 +899,140 @@ class ImageEditor(QWidget):
         if file_path:
             self.load_image(file_path)
 
+    def browse_folder_dialog(self):
+        folder = os.path.dirname(self.current_image_path) if self.current_image_path else None
+        dlg = FolderBrowserDialog(self, self.thumb_cache, self.load_image, folder=folder)
+        dlg.finished.connect(dlg.deleteLater)
+        dlg.show()
+        if folder is None:
+            dlg.choose_folder()
+
     def load_recent_image(self, path):
         self.load_image(path)
 
+    def recent_thumbnail(self, path):
+        image = self.thumb_cache.thumbnail(path)
+        return QPixmap.fromImage(image) if image is not None else None
+
     def load_image(self, file_path):
-        pixmap = QPixmap(file_path)
-        if not pixmap.isNull():
+        # Already open images are switched to instead of reloaded from disk
+        doc = self.session.find(file_path)
+        if doc is None:
+            pixmap = self.session.lookup(file_path)
+            if pixmap is None:
+                preview = self.thumb_cache.preview(file_path)
+                if preview is not None:
+                    self.show_preview(file_path, preview)
+                    return
+                pixmap = QPixmap.fromImage(colorspace.load(file_path))
+                if pixmap.isNull():
+                    return
+                self.session.remember(file_path, pixmap)
+                self.thumb_cache.store_async(file_path, pixmap.toImage())
+            doc = self.session.open(file_path, pixmap)
+            if file_path.lower().endswith(".gif") and frames.frame_count(file_path) > 1:
+                sequence = frames.load_sequence(file_path)
+                if sequence is not None:
+                    doc.sequences.append(sequence)
+            self.tab_bar.blockSignals(True)
+            self.tab_bar.addTab(doc.title)
+            self.tab_bar.setTabToolTip(self.tab_bar.count() - 1, file_path)
+            self.tab_bar.blockSignals(False)
+        self.add_to_recent(file_path)
+        self.show_document(doc)
+
+    def show_preview(self, file_path, preview):
+        # Cached downscaled preview, stretched to the full image size, while
+        # the full decode runs in the background. Effects stay disabled
+        # until it is in (image_item is None).
+        full_size = QImageReader(file_path).size()
+        self.scene.clear()
+        self.image_item = None
+        item = QGraphicsPixmapItem(QPixmap.fromImage(preview))
+        item.setTransformationMode(Qt.SmoothTransformation)
+        if full_size.isValid():
+            item.setScale(full_size.width() / preview.width())
+        self.scene.addItem(item)
+        self.scene.setSceneRect(item.sceneBoundingRect())
+        self.canvas.fitInView(item, Qt.KeepAspectRatio)
+        self.canvas.centerOn(item)
+        self.show_canvas()
+
+        self.loading_path = file_path
+        thread = DecodeThread(file_path, self)
+        thread.decoded.connect(self.on_image_decoded)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+
+    def on_image_decoded(self, path, image):
+        if not image.isNull():
+            self.session.remember(path, QPixmap.fromImage(image))
+        if path != self.loading_path:
+            return
+        self.loading_path = None
+        if not image.isNull():
+            self.load_image(path)
+        elif self.session.current is not None:
+            self.show_document(self.session.current)
+        else:
             self.scene.clear()
-            self.image_item = QGraphicsPixmapItem(pixmap)
-            self.scene.addItem(self.image_item)
-            self.scene.setSceneRect(self.image_item.boundingRect())
-            self.canvas.fitInView(self.image_item, Qt.KeepAspectRatio)
-            self.canvas.centerOn(self.image_item)
-            self.add_to_recent(file_path)
-            self.current_image_path = file_path
-            self.inverted_pixmap = None
-            self.save_image_btn.setEnabled(True)
-            self.undo_stack.clear()
-            self.redo_stack.clear()
+            self.show_start_page()
+
+    def push_undo(self, pixmap, sequence=None, doc=None):
+        # The state being covered is kept as a compact snapshot. doc is the
+        # tab on screen unless given.
+        if doc is None:
+            doc = self.session.current
+        if doc is None:
+            return
+        doc.resume()
+        undo_stack = doc.undo_stack
+        if undo_stack:
+            undo_stack[-1] = compact(undo_stack[-1])
+        undo_stack.append(pixmap.copy())
+        if doc.sequences:
+            doc.sequences.append(sequence or doc.sequences[-1])
+            doc.sequence_redo.clear()
+        if len(undo_stack) > 20:
+            undo_stack.pop(0)
+            if doc.sequences:
+                doc.sequences.pop(0)
+        doc.redo_stack.clear()
+        # The history just grew, so inactive documents may have to be
+        # compressed or spilled now rather than on the next tab switch
+        self.session.enforce_budget()
+
+    def push_region(self, pixmap, rect):
+        # Edit confined to rect: the state it replaces only keeps that region.
+        # The top of the stack is always a full pixmap, states below it may be
+        # patches against the state above.
+        if not self.undo_stack:
             self.push_undo(pixmap)
-            self.show_canvas()
-
-    def push_undo(self, pixmap):
-        self.undo_stack.append(pixmap.copy())
-        if len(self.undo_stack) > 20:
-            self.undo_stack.pop(0)
-        self.redo_stack.clear()
+            return
+        self.undo_stack[-1] = RegionPatch.cut(self.undo_stack[-1], rect)
+        self.push_undo(pixmap)
 
     def undo(self):
+        stack = self.layer_stack
+        if stack is not None:
+            if stack.undo():
+                self.show_layers()
+            return
         if len(self.undo_stack) > 1:
             current = self.undo_stack.pop()
-            self.redo_stack.append(current)
             pixmap = self.undo_stack[-1]
+            if isinstance(pixmap, RegionPatch):
+                self.redo_stack.append(RegionPatch.cut(current, pixmap.rect))
+                pixmap = pixmap.apply(current)
+                self.undo_stack[-1] = pixmap
+            else:
+                pixmap = restore(pixmap)
+                self.undo_stack[-1] = pixmap
+                self.redo_stack.append(compact(current))
+            doc = self.session.current
+            if doc.sequences:
+                doc.sequence_redo.append(doc.sequences.pop())
+            self.scopes.show_image(pixmap)
             self.scene.clear()
             self.image_item = QGraphicsPixmapItem(pixmap)
             self.scene.addItem(self.image_item)
@@ -592,11 +1040,33 @@ class ImageEditor(QWidget):
             self.canvas.fitInView(self.image_item, Qt.KeepAspectRatio)
             self.canvas.centerOn(self.image_item)
             self.save_image_btn.setEnabled(True)
+            self.refresh_tab()
+            self.update_frame_bar()
 
     def redo(self):
-        if self.redo_stack:
+        stack = self.layer_stack
+        if stack is not None:
+            if stack.redo():
+                self.show_layers()
+            return
+        if self.redo_stack and self.undo_stack:
             pixmap = self.redo_stack.pop()
-            self.push_undo(pixmap)
+            if isinstance(pixmap, RegionPatch):
+                current = self.undo_stack[-1]
+                self.undo_stack[-1] = RegionPatch.cut(current, pixmap.rect)
+                pixmap = pixmap.apply(current)
+            else:
+                pixmap = restore(pixmap)
+                self.undo_stack[-1] = compact(self.undo_stack[-1])
+            self.undo_stack.append(pixmap)
+            doc = self.session.current
+            if doc.sequence_redo:
+                doc.sequences.append(doc.sequence_redo.pop())
+            if len(self.undo_stack) > 20:
+                self.undo_stack.pop(0)
+                if doc.sequences:
+                    doc.sequences.pop(0)
+            self.scopes.show_image(pixmap)
             self.scene.clear()
             self.image_item = QGraphicsPixmapItem(pixmap)
             self.scene.addItem(self.image_item)
@@ -604,24 +1074,375 @@ class ImageEditor(QWidget):
             self.canvas.fitInView(self.image_item, Qt.KeepAspectRatio)
             self.canvas.centerOn(self.image_item)
             self.save_image_btn.setEnabled(True)
+            self.refresh_tab()
+            self.update_frame_bar()
 
     def invert_image(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            image = original_image.toImage().convertToFormat(QImage.Format_ARGB32)
-            ptr = image.bits()
-            ptr.setsize(image.byteCount())
-            arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), image.width(), 4))
-            arr[..., 0:3] = 255 - arr[..., 0:3]
-            new_pixmap = QPixmap.fromImage(image)
-            self.scene.clear()
-            self.image_item = QGraphicsPixmapItem(new_pixmap)
-            self.scene.addItem(self.image_item)
-            self.scene.setSceneRect(self.image_item.boundingRect())
-            self.canvas.fitInView(self.image_item, Qt.KeepAspectRatio)
-            self.canvas.centerOn(self.image_item)
-            self.save_image_btn.setEnabled(True)
-            self.push_undo(new_pixmap)
+            xp = get_xp()
+            original_image = self.effect_source()
+            src = buffers.working_array(original_image, xp)
+            selection = self.canvas.selection
+            if selection is None:
+                new_pixmap = buffers.show_array(kernels.invert(src))
+            else:
+                new_pixmap = selection.apply(original_image, src, "invert", {})
+            self.set_canvas_pixmap(new_pixmap, push=False, region=selection.rect if selection else None)
+            self.commit_effect(new_pixmap, selection, ("invert", {}))
+
+    def commit_effect(self, pixmap, selection, effect=None):
+        # In sequence mode the accepted effect is re-run on every frame in
+        # the background and the result pushed once it's done
+        if effect is not None:
+            step = macros.make_step(effect[0], effect[1], selection)
+            self.recording.append(step)
+            self.macros.remember(step)
+        if self.sequence is not None and effect is not None:
+            name, params = effect
+            self.run_on_frames(frames.effect_fn(name, params, selection))
+            return
+        if self.layer_stack is not None and effect is not None:
+            self.add_layer(pixmap, selection, effect)
+            return
+        if selection is None:
+            self.push_undo(pixmap)
+        else:
+            self.push_region(pixmap, selection.rect)
+        self.refresh_tab()
+
+    @property
+    def sequence(self):
+        doc = self.session.current
+        return doc.sequences[-1] if doc is not None and doc.sequences else None
+
+    def run_on_frames(self, fn):
+        # Effects accepted while frames are still being processed wait their
+        # turn; each job runs on the frames the one before it produced
+        self.frame_jobs.append((self.session.current, fn))
+        self.start_frame_job()
+
+    def start_frame_job(self):
+        while self.sequence_thread is None and self.frame_jobs:
+            doc, fn = self.frame_jobs.popleft()
+            if doc not in self.session.documents or not doc.sequences:
+                continue
+            self.sequence_thread = frames.SequenceThread(doc.sequences[-1], fn, self)
+            self.sequence_thread.applied.connect(lambda seq, d=doc: self.on_frames_applied(d, seq))
+            self.sequence_thread.failed.connect(lambda error, d=doc: self.on_frames_failed(d, error))
+            self.sequence_thread.finished.connect(self.sequence_thread.deleteLater)
+            self.frame_bar.setEnabled(False)
+            self.sequence_thread.start()
+
+    def on_frames_applied(self, doc, sequence):
+        # The result goes onto the history of the document it was started
+        # from, whether or not that tab is still on screen
+        self.sequence_thread = None
+        self.frame_bar.setEnabled(True)
+        if doc in self.session.documents:
+            index = min(self.frame_index, len(sequence) - 1)
+            self.push_undo(sequence.pixmap(index), sequence, doc)
+            if doc is self.session.current:
+                self.update_frame_bar()
+            self.refresh_tab(doc)
+        self.start_frame_job()
+
+    def on_frames_failed(self, doc, error):
+        # The history is left as it was; the canvas goes back from the
+        # accepted preview to the frame actually stored
+        self.sequence_thread = None
+        self.frame_bar.setEnabled(True)
+        if doc is self.session.current:
+            self.show_frame(self.frame_index)
+        self.setWindowTitle(f"Cached Whale - frames failed: {error}")
+        self.start_frame_job()
+
+    def update_frame_bar(self):
+        sequence = self.sequence
+        if sequence is None:
+            self.frame_bar.hide()
+            return
+        self.frame_slider.blockSignals(True)
+        self.frame_slider.setMaximum(len(sequence) - 1)
+        self.frame_index = min(self.frame_index, len(sequence) - 1)
+        self.frame_slider.setValue(self.frame_index)
+        self.frame_slider.blockSignals(False)
+        self.frame_bar.show()
+        self.show_frame(self.frame_index)
+
+    def show_frame(self, index):
+        # The top of the undo stack always holds the frame on screen
+        sequence = self.sequence
+        if sequence is None or not self.undo_stack:
+            return
+        self.frame_index = index
+        self.frame_label.setText(f"frame {index + 1}/{len(sequence)}")
+        pixmap = sequence.pixmap(index)
+        self.undo_stack[-1] = pixmap
+        self.set_canvas_pixmap(pixmap, push=False)
+
+    def load_sequence_dialog(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Open Frame Sequence", "",
+                                                   "Animations and Numbered Frames (*.gif *.png)")
+        if not file_path:
+            return
+        sequence = frames.load_sequence(file_path)
+        if sequence is None:
+            return
+        self.frame_index = 0
+        doc = self.session.open(file_path, sequence.pixmap(0))
+        doc.sequences.append(sequence)
+        self.tab_bar.blockSignals(True)
+        self.tab_bar.addTab(f"{doc.title} [{len(sequence)}]")
+        self.tab_bar.setTabToolTip(self.tab_bar.count() - 1, file_path)
+        self.tab_bar.blockSignals(False)
+        self.show_document(doc)
+
+    def export_animation_dialog(self):
+        sequence = self.sequence
+        if sequence is None or self.export_thread is not None:
+            return
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Animation", "",
+                                                   "GIF Animation (*.gif);;Animated PNG (*.png)")
+        if file_path:
+            self.export_thread = frames.ExportThread(file_path, sequence, self)
+            self.export_thread.exported.connect(self.on_animation_exported)
+            self.export_thread.finished.connect(self.export_thread.deleteLater)
+            self.export_thread.start()
+
+    def on_animation_exported(self, path, error):
+        self.export_thread = None
+        if error:
+            self.setWindowTitle(f"Cached Whale - export failed: {error}")
+        else:
+            self.setWindowTitle("Cached Whale")
+
+    def hold_source(self, dlg, pixmap):
+        # The source array and its device copy stay resident while the
+        # dialog previews from them
+        buffers.hold(pixmap)
+        dlg.finished.connect(lambda: buffers.release(pixmap))
+
+    def restore_params(self, dlg):
+        # Dialogs open with the parameters last accepted for their effect,
+        # or with the layer's when it was reopened from the layers panel
+        stack = self.layer_stack
+        if self.editing_layer is not None and stack is not None:
+            params = stack.layers[self.editing_layer].params
+        else:
+            params = self.macros.defaults(dlg.effect_name)
+        if params:
+            dlg.set_params(params)
+
+    def effect_source(self):
+        # What effect dialogs read: the stack's base while layers are up
+        stack = self.layer_stack
+        return stack.pixmap if stack is not None else self.image_item.pixmap()
+
+    def cancel_effect(self, original_image):
+        if self.layer_stack is not None:
+            self.editing_layer = None
+            self.draw_layers()
+        else:
+            self.set_canvas_pixmap(original_image, push=False)
+
+    @property
+    def layer_stack(self):
+        doc = self.session.current
+        return doc.layers if doc is not None else None
+
+    def start_layers(self):
+        # Effects accepted from here on become layers over the current image
+        doc = self.session.current
+        if not self.image_item or doc is None or doc.layers is not None or doc.sequences:
+            return
+        pixmap = self.image_item.pixmap()
+        buffers.hold(pixmap)
+        doc.layers = layers.LayerStack(buffers.working_array(pixmap, get_xp()), pixmap)
+        self.show_layers()
+
+    def show_layers(self):
+        stack = self.layer_stack
+        self.layers_panel.set_stack(stack)
+        self.layers_panel.setVisible(stack is not None)
+        self.draw_layers()
+
+    def draw_layers(self):
+        stack = self.layer_stack
+        if stack is not None:
+            self.set_canvas_pixmap(buffers.show_array(stack.composite()), push=False)
+
+    def add_layer(self, pixmap, selection, effect):
+        # An accepted effect becomes a layer. One reopened from the panel
+        # replaces the layer it was opened for, keeping how it is blended.
+        stack = self.layer_stack
+        name, params = effect
+        if selection is None:
+            # The accepted preview already is the effect of the base
+            output, x, y = buffers.working_array(pixmap, backend.xp_of(stack.base)), 0, 0
+        else:
+            output, x, y = layers.render(stack.base, name, params, selection)
+        index = self.editing_layer
+        self.editing_layer = None
+        if index is not None and index < len(stack.layers):
+            layer = stack.layers[index].replace(name=name, params=params, output=output, x=x, y=y, mask=selection)
+            stack.replace(index, layer)
+        else:
+            index = len(stack.layers)
+            stack.add(layers.Layer(name, params, output, x, y, mask=selection))
+        self.layers_panel.set_stack(stack, index)
+        self.draw_layers()
+
+    def effect_launcher(self, name):
+        return {
+            "compression": self.compression_dialog,
+            "dither": self.dither_dialog,
+            "saturation": self.saturation_dialog,
+            "pixelate": self.pixelate_dialog,
+            "scanlines": self.scanlines_dialog,
+            "noise": self.noise_dialog,
+            "halftone": self.halftone_dialog,
+            "pixelsort": self.pixelsort_dialog,
+            "displace": self.vectordisplace_dialog,
+            "colorize": self.colorize_dialog,
+        }.get(name)
+
+    def edit_layer(self, index):
+        # Reopens the layer's effect dialog with its parameters
+        stack = self.layer_stack
+        if stack is None or index is None:
+            return
+        launcher = self.effect_launcher(stack.layers[index].name)
+        if launcher is not None:
+            self.editing_layer = index
+            launcher()
+
+    def mask_layer(self, index):
+        # The current selection becomes the layer's mask, no selection
+        # removes it
+        stack = self.layer_stack
+        if stack is None or index is None:
+            return
+        stack.update(index, mask=self.canvas.selection)
+        self.layers_panel.set_stack(stack, index)
+        self.draw_layers()
+
+    def flatten_layers(self):
+        # The composite becomes an ordinary edit in the undo history
+        doc = self.session.current
+        stack = self.layer_stack
+        if stack is None:
+            return
+        composite = stack.composite()
+        self.drop_layers(doc)
+        self.layers_panel.set_stack(None)
+        self.layers_panel.hide()
+        self.set_canvas_pixmap(buffers.show_array(composite), push=stack.layers != [])
+
+    def drop_layers(self, doc):
+        if doc.layers is not None:
+            buffers.release(doc.layers.pixmap)
+            doc.layers = None
+
+    def save_macro_dialog(self):
+        if not self.recording:
+            return
+        name, ok = QInputDialog.getText(self, "Save Macro", "macro name >")
+        if ok and name.strip():
+            self.macros.save(name.strip(), list(self.recording))
+            self.recording.clear()
+
+    def save_preset_dialog(self):
+        if not self.recording:
+            return
+        step = self.recording[-1]
+        name, ok = QInputDialog.getText(self, "Save Preset", "preset name >", text=step["effect"])
+        if ok and name.strip():
+            self.macros.save(name.strip(), [step])
+
+    def update_macro_menu(self):
+        self.run_macro_menu.clear()
+        names = self.macros.names()
+        for name in names:
+            action = QAction(name, self)
+            action.triggered.connect(lambda _, n=name: self.run_macro(n))
+            self.run_macro_menu.addAction(action)
+        if not names:
+            none_action = QAction("No Macros", self)
+            none_action.setEnabled(False)
+            self.run_macro_menu.addAction(none_action)
+
+    def run_macro(self, name):
+        if not self.image_item or self.macro_thread is not None:
+            return
+        self.flatten_layers()
+        steps = self.macros.load(name)
+        if not steps:
+            return
+        self.recording.extend(steps)
+        if self.sequence is not None:
+            self.run_on_frames(lambda frame: macros.run_steps(frame, steps, xp=np))
+            return
+        pixmap = self.image_item.pixmap()
+        doc = self.session.current
+        src = buffers.working_array(pixmap)
+        source = (pixmap.cacheKey(), src.dtype.name)
+        self.macro_thread = macros.MacroThread(src, steps, self.prefix_cache, source, self)
+        self.macro_thread.replayed.connect(lambda arr: self.on_macro_replayed(doc, arr))
+        self.macro_thread.finished.connect(self.macro_thread.deleteLater)
+        self.macro_thread.start()
+
+    def on_macro_replayed(self, doc, arr):
+        # Like frame jobs, the result goes onto the history of the document
+        # the macro was run on, whether or not that tab is still on screen
+        self.macro_thread = None
+        if doc not in self.session.documents:
+            return
+        pixmap = buffers.show_array(arr)
+        if doc is self.session.current:
+            self.set_canvas_pixmap(pixmap)
+        else:
+            self.push_undo(pixmap, doc=doc)
+            self.refresh_tab(doc)
+
+    def batch_macro_dialog(self):
+        if self.batch_thread is not None:
+            return
+        dlg = macros.BatchDialog(self, self.macros.names())
+        if dlg.exec_() != QDialog.Accepted:
+            return
+        names = dlg.selected_names()
+        if not names or not dlg.input_dir or not dlg.output_dir:
+            return
+        paths = macros.list_images(dlg.input_dir)
+        batch = [(name, self.macros.load(name)) for name in names]
+        self.batch_thread = macros.BatchThread(paths, batch, dlg.output_dir, buffers.working_dtype(), self)
+        self.batch_thread.progressed.connect(
+            lambda done, total: self.setWindowTitle(f"Cached Whale - batch {done}/{total}")
+        )
+        self.batch_thread.finished_batch.connect(self.on_batch_finished)
+        self.batch_thread.start()
+
+    def on_batch_finished(self, errors):
+        self.batch_thread.wait()
+        self.batch_thread = None
+        if errors:
+            self.setWindowTitle(f"Cached Whale - batch done, {len(errors)} failed")
+        else:
+            self.setWindowTitle("Cached Whale")
+
+    def preview_pixmap(self, pixmap, scale=1):
+        # scale is the step of a coarse progressive preview
+        selection = self.canvas.selection
+        self.set_canvas_pixmap(pixmap, push=False, region=selection.rect if selection else None, scale=scale)
+
+    def load_mask_dialog(self):
+        if self.image_item:
+            file_path, _ = QFileDialog.getOpenFileName(self, "Load Selection Mask", "", "Images (*.png *.jpg *.jpeg *.bmp)")
+            if file_path:
+                size = self.image_item.pixmap().size()
+                mask = QImage(file_path)
+                if not mask.isNull():
+                    self.canvas.set_selection(Selection.from_mask_image(mask, size.width(), size.height()))
 
     def save_image_as(self):
         if self.image_item:
@@ -636,16 +1457,19 @@ class ImageEditor(QWidget):
             orig_w = img.width()
             orig_h = img.height()
             dlg = ResizeDialog(orig_w, orig_h)
-            if dlg.show() == QDialog.Accepted:
+            if dlg.exec_() == QDialog.Accepted:
                 w, h = dlg.get_size()
-                self.resize_image(w, h)
+                self.resize_image(w, h, dlg.get_filter())
 
     def open_preferences_menu(self):
         # pass current stylesheet info (track current theme in a variable)
-        dlg = PreferencesDialog(current_theme=getattr(self, "current_theme", "cmd"), parent=self)
+        from effects import PreferencesDialog
+        dlg = PreferencesDialog(current_theme=getattr(self, "current_theme", "cmd"),
+                                gpu_limit_mb=backend.device_limit() >> 20, parent=self)
         if dlg.exec_() == QDialog.Accepted:
             new_theme = dlg.select_theme()
             self.apply_theme(new_theme)
+            backend.set_device_limit(dlg.gpu_limit_mb() << 20)
 
     def apply_theme(self, theme_name):
         if theme_name == "cmd":
@@ -659,18 +1483,15 @@ class ImageEditor(QWidget):
         self.current_theme = theme_name
 
 
-    def resize_image(self, w, h):
+    def resize_image(self, w, h, method="lanczos3"):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            scaled = original_image.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.scene.clear()
-            self.image_item = QGraphicsPixmapItem(scaled)
-            self.scene.addItem(self.image_item)
-            self.scene.setSceneRect(self.image_item.boundingRect())
-            self.canvas.fitInView(self.image_item, Qt.KeepAspectRatio)
-            self.canvas.centerOn(self.image_item)
-            self.save_image_btn.setEnabled(True)
-            # self.push_undo(scaled)
+            if self.sequence is not None:
+                self.canvas.clear_selection()
+                self.run_on_frames(lambda frame: resize_frame(frame, w, h, method))
+                return
+            self.flatten_layers()
+            image = self.image_item.pixmap().toImage()
+            self.set_canvas_pixmap(QPixmap.fromImage(resize_qimage(image, w, h, method)))
 
     def zoom_100(self):
         if self.image_item:
@@ -680,104 +1501,156 @@ class ImageEditor(QWidget):
 
     def compression_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = CompressionDialog(self, original_image, self.set_canvas_pixmap, default_quality=10)
-
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import CompressionDialog
+            dlg = CompressionDialog(self, original_image, self.preview_pixmap, default_quality=10, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def dither_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = DitherDialog(self, original_image, self.set_canvas_pixmap, default_threshold=128)
-
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import DitherDialog
+            dlg = DitherDialog(self, original_image, self.preview_pixmap, default_threshold=128, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def saturation_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = SaturationDialog(self, original_image, self.set_canvas_pixmap, default_saturation=100)
-
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import SaturationDialog
+            dlg = SaturationDialog(self, original_image, self.preview_pixmap, default_saturation=100, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def pixelate_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = PixelateDialog(self, original_image, self.set_canvas_pixmap, default_blocksize=8)
-
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import PixelateDialog
+            dlg = PixelateDialog(self, original_image, self.preview_pixmap, default_blocksize=8, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def scanlines_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = ScanlinesDialog(self, original_image, self.set_canvas_pixmap)
-
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import ScanlinesDialog
+            dlg = ScanlinesDialog(self, original_image, self.preview_pixmap, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def noise_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = NoiseDialog(self, original_image, self.set_canvas_pixmap)
-
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import NoiseDialog
+            dlg = NoiseDialog(self, original_image, self.preview_pixmap, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def halftone_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = HalftoneDialog(self, original_image, self.set_canvas_pixmap)
-            
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import HalftoneDialog
+            dlg = HalftoneDialog(self, original_image, self.preview_pixmap, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def pixelsort_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = PixelSortDialog(self, original_image, self.set_canvas_pixmap)
-            
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import PixelSortDialog
+            dlg = PixelSortDialog(self, original_image, self.preview_pixmap, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def vectordisplace_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = VectorDisplaceDialog(self, original_image, self.set_canvas_pixmap)
-            
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import VectorDisplaceDialog
+            dlg = VectorDisplaceDialog(self, original_image, self.preview_pixmap, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
     def colorize_dialog(self):
         if self.image_item:
-            original_image = self.image_item.pixmap()
-            dlg = ColorizeDialog(self, original_image, self.set_canvas_pixmap)
-            
-            dlg.accepted.connect(lambda: self.push_undo(dlg.get_pixmap()))
-            dlg.rejected.connect(lambda: self.set_canvas_pixmap(original_image, push=False))
+            original_image = self.effect_source()
+            selection = self.canvas.selection
+            from effects import ColorizeDialog
+            dlg = ColorizeDialog(self, original_image, self.preview_pixmap, selection=selection)
+            self.restore_params(dlg)
+            self.hold_source(dlg, original_image)
+
+            dlg.accepted.connect(lambda: self.commit_effect(dlg.get_pixmap(), selection, (dlg.effect_name, dlg.get_params())))
+            dlg.rejected.connect(lambda: self.cancel_effect(original_image))
             dlg.show()
 
-    def set_canvas_pixmap(self, pixmap, push=True):
+    def set_canvas_pixmap(self, pixmap, push=True, region=None, scale=1):
+        # region is set when pixmap only differs from the top of the undo
+        # stack inside that rect, so the scopes can update incrementally.
+        # A reduced preview (scale > 1) is stretched over the image's area.
+        if scale != 1:
+            region = None
+        base = self.undo_stack[-1] if region is not None and self.undo_stack else None
+        self.scopes.show_image(pixmap, base, region)
+        selection = self.canvas.selection
+        if selection is not None and not selection.fits(pixmap.width() * scale, pixmap.height() * scale):
+            self.canvas.clear_selection()
         self.scene.clear()
         self.image_item = QGraphicsPixmapItem(pixmap)
+        self.image_item.setScale(scale)
         self.scene.addItem(self.image_item)
-        self.scene.setSceneRect(self.image_item.boundingRect())
+        self.scene.setSceneRect(self.image_item.sceneBoundingRect())
         self.canvas.fitInView(self.image_item, Qt.KeepAspectRatio)
         self.canvas.centerOn(self.image_item)
         self.save_image_btn.setEnabled(True)
         if push:
             self.push_undo(pixmap)
+        self.refresh_tab()
 
     def load_recent_images(self):
         if os.path.exists(RECENT_FILE):
@@ -797,6 +1670,28 @@ class ImageEditor(QWidget):
         except Exception:
             pass
 
+    def after_first_show(self, print_timing=False):
+        # Runs from the event loop once the window is up: the rest of the
+        # fonts, then effect modules and the GPU in the background
+        startup.mark("first event loop pass")
+        font_path = os.path.join(os.path.dirname(__file__), "fonts", "lcd.TTF")
+        if os.path.exists(font_path):
+            QFontDatabase.addApplicationFont(font_path)
+        startup.mark("deferred fonts")
+        self.warm_up_thread = startup.WarmUpThread(self)
+        if print_timing:
+            self.warm_up_thread.warmed.connect(lambda _: print(startup.report(), file=sys.stderr))
+        self.warm_up_thread.start()
+
+    def closeEvent(self, event):
+        # Drop spilled documents from disk
+        self.session.close_all()
+        self.scopes.shutdown()
+        for thread in (self.warm_up_thread, self.macro_thread, self.batch_thread):
+            if thread is not None:
+                thread.wait()
+        super().closeEvent(event)
+
     def set_titlebar_color(self, color):
         hwnd = int(self.winId())
         color_ref = ctypes.c_uint(color)
@@ -809,11 +1704,14 @@ class ImageEditor(QWidget):
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    startup.mark("QApplication")
 
     icon_path = os.path.join(os.path.dirname(__file__), "assets", "icon.ico")
     app.setWindowIcon(QIcon(icon_path))
 
     editor = ImageEditor()
+    startup.mark("main window")
     editor.show()
     editor.setFocus(Qt.NoFocusReason)
+    QTimer.singleShot(0, lambda: editor.after_first_show("--startup-timing" in sys.argv))
     sys.exit(app.exec_())
\ No newline at end of file
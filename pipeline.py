@@ -0,0 +1,43 @@
+from backend import get_xp, to_device, to_host
+from kernels import EFFECTS, POINTWISE, run_stages
+
+
+class Pipeline:
+    # An ordered list of (effect, params) steps. The working buffer is moved
+    # to the device once and stays there between steps; runs of adjacent
+    # pointwise effects are fused into a single pass over the image, run in
+    # parallel row bands on the CPU.
+    def __init__(self, steps=None):
+        self.steps = [(name, dict(params)) for name, params in (steps or [])]
+
+    def add(self, name, **params):
+        if name not in EFFECTS:
+            raise KeyError(f"unknown effect: {name}")
+        self.steps.append((name, params))
+        return self
+
+    def groups(self):
+        groups = []
+        for name, params in self.steps:
+            if name in POINTWISE:
+                stage = (POINTWISE[name], dict(params))
+                if groups and groups[-1][0] == "fused":
+                    groups[-1][1].append(stage)
+                else:
+                    groups.append(("fused", [stage]))
+            else:
+                groups.append(("single", (name, params)))
+        return groups
+
+    def run(self, arr, xp=None, keep_on_device=False):
+        if xp is None:
+            xp = get_xp()
+        buf = to_device(arr, xp)
+        for kind, payload in self.groups():
+            if kind == "fused":
+                buf = run_stages(buf, payload)
+            else:
+                name, params = payload
+                buf = EFFECTS[name](buf, **params)
+        return buf if keep_on_device else to_host(buf)
+
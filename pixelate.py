@@ -0,0 +1,197 @@
+import numpy as np
+
+from backend import get_xp, xp_of, to_device, to_host, hash32
+
+CELL_SHAPES = ["square", "rect 2:1", "rect 1:2", "hex", "voronoi"]
+CELL_STATS = ["mean", "median"]
+
+
+def pixelate(arr, blocksize, shape="square", stat="mean", seed=0, xp=None, origin=(0, 0)):
+    # arr is (H, W, C) uint8, or float on the same 0..255 scale; the result
+    # has the same shape and dtype.
+    # Every mode costs the same per pixel whatever the block size is.
+    # origin is where arr sits in the full image, cells are laid out on the
+    # full image's grid so a crop pixelates exactly like the whole frame.
+    if xp is None:
+        xp = get_xp()
+    blocksize = max(1, int(blocksize))
+    src = to_device(arr, xp)
+
+    if shape in ("square", "rect 2:1", "rect 1:2"):
+        cw, ch = blocksize, blocksize
+        if shape == "rect 2:1":
+            cw = blocksize * 2
+        elif shape == "rect 1:2":
+            ch = blocksize * 2
+        if stat == "mean":
+            result = _rect_means(src, cw, ch, origin, xp)
+        else:
+            result = _label_median(src, _rect_labels(src.shape, cw, ch, origin, xp), xp)
+    else:
+        if shape == "hex":
+            labels = _hex_labels(src.shape, blocksize, origin, xp)
+        else:
+            labels = _voronoi_labels(src.shape, blocksize, seed, origin, xp)
+        if stat == "mean":
+            result = _label_mean(src, labels, xp)
+        else:
+            result = _label_median(src, labels, xp)
+
+    if xp_of(arr) is np:
+        return to_host(result)
+    return result
+
+
+def _cast_like(values, src, xp):
+    # Cell statistics back to the source's dtype, rounded for 8-bit sources
+    if src.dtype == xp.uint8:
+        return xp.rint(values).astype(xp.uint8)
+    return values.astype(src.dtype)
+
+
+def _cell_ends(n, size, offset, xp):
+    first = size - offset % size
+    return xp.minimum(xp.arange(first, n + size, size), n) - 1
+
+
+def _cell_index(n, size, offset, xp):
+    return (xp.arange(n) + offset % size) // size
+
+
+def _rect_means(src, cw, ch, origin, xp):
+    # Separable integral image: cumulative sums sampled at the cell edges and
+    # differenced give exact per-cell sums, including the ragged last row and
+    # column, without padding the frame.
+    H, W = src.shape[:2]
+    ox, oy = origin
+    row_ends = _cell_ends(H, ch, oy, xp)
+    col_ends = _cell_ends(W, cw, ox, xp)
+
+    acc = xp.uint32 if src.dtype == xp.uint8 else xp.float64
+    sums = xp.cumsum(src, axis=0, dtype=acc)[row_ends]
+    sums = xp.diff(sums, axis=0, prepend=0)
+    sums = xp.cumsum(sums, axis=1, dtype=acc)[:, col_ends]
+    sums = xp.diff(sums, axis=1, prepend=0)
+
+    heights = xp.diff(row_ends, prepend=-1)
+    widths = xp.diff(col_ends, prepend=-1)
+    counts = (heights[:, None] * widths[None, :])[..., None]
+    means = _cast_like(sums / counts, src, xp)
+
+    means = xp.take(means, _cell_index(H, ch, oy, xp), axis=0)
+    return xp.take(means, _cell_index(W, cw, ox, xp), axis=1)
+
+
+def _rect_labels(shape, cw, ch, origin, xp):
+    H, W = shape[:2]
+    ox, oy = origin
+    xs = _cell_index(W, cw, ox, xp)[None, :]
+    ys = _cell_index(H, ch, oy, xp)[:, None]
+    return ys * (int(xs.max()) + 1) + xs
+
+
+def _hex_labels(shape, size, origin, xp):
+    # Pointy-top hexagons whose width matches the block size, assigned by
+    # cube rounding of each pixel centre's axial coordinates.
+    H, W = shape[:2]
+    radius = size / np.sqrt(3.0)
+    ox, oy = origin
+    ys, xs = xp.meshgrid(
+        xp.arange(oy, oy + H, dtype=xp.float32) + 0.5,
+        xp.arange(ox, ox + W, dtype=xp.float32) + 0.5,
+        indexing="ij"
+    )
+    q = (np.sqrt(3.0) / 3.0 * xs - ys / 3.0) / radius
+    r = (2.0 / 3.0 * ys) / radius
+    del xs, ys
+
+    x, z = q, r
+    y = -x - z
+    rx, ry, rz = xp.rint(x), xp.rint(y), xp.rint(z)
+    dx, dy, dz = xp.abs(rx - x), xp.abs(ry - y), xp.abs(rz - z)
+    fix_x = (dx > dy) & (dx > dz)
+    fix_z = ~fix_x & (dz >= dy)
+    rx = xp.where(fix_x, -ry - rz, rx)
+    rz = xp.where(fix_z, -rx - ry, rz)
+
+    qi = rx.astype(xp.int64)
+    ri = rz.astype(xp.int64)
+    qi -= qi.min()
+    ri -= ri.min()
+    return ri * (int(qi.max()) + 1) + qi
+
+
+def _jitter(gy, gx, seed, salt, xp):
+    # Position of a cell's seed inside the cell, a pure function of the
+    # cell's grid coordinates so it is the same however the image is cropped
+    key = (gy.astype(xp.uint32) * np.uint32(0x9E3779B1)) ^ gx.astype(xp.uint32)
+    key ^= np.uint32((seed * 0x85EBCA77 + salt) & 0xFFFFFFFF)
+    return hash32(key).astype(xp.float64) / 2.0 ** 32
+
+
+def _voronoi_labels(shape, size, seed, origin, xp):
+    # One jittered seed per grid cell; a pixel can only belong to a seed in
+    # its own or one of the eight neighbouring grid cells.
+    H, W = shape[:2]
+    ox, oy = origin
+    g0y, g0x = oy // size - 1, ox // size - 1
+    gh = (oy + H - 1) // size + 2 - g0y
+    gw = (ox + W - 1) // size + 2 - g0x
+    cy = xp.arange(g0y, g0y + gh)[:, None] + xp.zeros((1, gw), dtype=xp.int64)
+    cx = xp.arange(g0x, g0x + gw)[None, :] + xp.zeros((gh, 1), dtype=xp.int64)
+    seed_y = ((cy + _jitter(cy, cx, seed, 0, xp)) * size - oy).astype(xp.float32)
+    seed_x = ((cx + _jitter(cy, cx, seed, 1, xp)) * size - ox).astype(xp.float32)
+
+    py = (xp.arange(H, dtype=xp.float32) + 0.5)[:, None]
+    px = (xp.arange(W, dtype=xp.float32) + 0.5)[None, :]
+    gy = ((xp.arange(oy, oy + H) // size) - g0y)[:, None]
+    gx = ((xp.arange(ox, ox + W) // size) - g0x)[None, :]
+
+    best = xp.full((H, W), xp.inf, dtype=xp.float32)
+    labels = xp.zeros((H, W), dtype=xp.int64)
+    for dy in (-1, 0, 1):
+        ny = xp.clip(gy + dy, 0, gh - 1)
+        for dx in (-1, 0, 1):
+            nx = xp.clip(gx + dx, 0, gw - 1)
+            dist = (seed_y[ny, nx] - py) ** 2 + (seed_x[ny, nx] - px) ** 2
+            closer = dist < best
+            best = xp.where(closer, dist, best)
+            labels = xp.where(closer, ny * gw + nx, labels)
+    return labels
+
+
+def _label_mean(src, labels, xp):
+    flat = labels.ravel()
+    n = int(flat.max()) + 1
+    counts = xp.maximum(xp.bincount(flat, minlength=n), 1)
+    result = xp.empty_like(src)
+    for c in range(src.shape[2]):
+        sums = xp.bincount(flat, weights=src[..., c].ravel(), minlength=n)
+        means = _cast_like(sums / counts, src, xp)
+        result[..., c] = means[labels]
+    return result
+
+
+def _label_median(src, labels, xp):
+    # Sorting label * 256 + value groups each cell's values in order, so the
+    # median is read at a fixed offset into every group. Float sources are
+    # ranked on their rounded 8-bit values.
+    flat = labels.ravel().astype(xp.int64)
+    n = int(flat.max()) + 1
+    counts = xp.bincount(flat, minlength=n)
+    starts = xp.cumsum(counts) - counts
+    lo = starts + (xp.maximum(counts, 1) - 1) // 2
+    hi = starts + counts // 2
+    lo = xp.minimum(lo, flat.size - 1)
+    hi = xp.minimum(hi, flat.size - 1)
+
+    result = xp.empty_like(src)
+    for c in range(src.shape[2]):
+        channel = src[..., c].ravel()
+        if src.dtype != xp.uint8:
+            channel = xp.clip(xp.rint(channel), 0, 255).astype(xp.int64)
+        keys = xp.sort(flat * 256 + channel)
+        values = keys & 255
+        medians = ((values[lo] + values[hi] + 1) // 2).astype(src.dtype)
+        result[..., c] = medians[labels]
+    return result
@@ -0,0 +1,273 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtGui import QPixmap, QImage
+from PyQt5.QtCore import QObject, pyqtSignal
+
+import buffers
+import kernels
+from backend import get_xp
+
+# Finished previews keyed on (source pixmap, effect, params, selection), so
+# dragging a slider back over values already seen is instant. Bounded by
+# the bytes of the cached images, least recently used first out. At the
+# float working depths the unrounded result is kept alongside the image, so
+# a cached preview that gets applied carries its full precision onward.
+MAX_PREVIEW_BYTES = 256 * 1024 * 1024
+# How long the user has to leave a slider alone before neighbouring values
+# are computed in the background, and how many on each side
+PREFETCH_DELAY = 250
+PREFETCH_RADIUS = 3
+# Progressive previews: slow effects on large images are first rendered on
+# the GUI thread from every COARSE_STEP-th pixel, or a wider step that keeps
+# that render under COARSE_PIXELS, then at FINE_STEPS and full size in the
+# background
+COARSE_STEP = 4
+COARSE_PIXELS = 1 << 19
+FINE_STEPS = (2,)
+PROGRESSIVE_PIXELS = 1 << 20
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+_generation = 0
+_pool = None
+_stage_pool = None
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def preview_key(pixmap, name, params, selection=None):
+    return (pixmap.cacheKey(), name, _freeze(params), selection.key if selection is not None else None,
+            np.dtype(buffers.working_dtype()).name)
+
+
+def _nbytes(entry):
+    image, precise = entry
+    return image.width() * image.height() * 4 + (precise.nbytes if precise is not None else 0)
+
+
+def lookup(key):
+    # Entries computed in the background are stored as QImage, which is safe
+    # off the GUI thread; they become pixmaps the first time they are shown.
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        _cache.move_to_end(key)
+    image, precise = entry
+    if isinstance(image, QImage):
+        image = QPixmap.fromImage(image)
+        with _lock:
+            if key in _cache:
+                _cache[key] = (image, precise)
+    if precise is not None:
+        buffers.remember(image, precise)
+    return image
+
+
+def store(key, image, precise=None):
+    # image is a QPixmap or QImage; a pixmap's unrounded array is picked up
+    # from the resident buffers when not given
+    global _cache_bytes
+    if precise is None and isinstance(image, QPixmap):
+        precise = buffers.precise_array(image)
+    entry = (image, precise)
+    nbytes = _nbytes(entry)
+    if nbytes > MAX_PREVIEW_BYTES:
+        return
+    with _lock:
+        old = _cache.pop(key, None)
+        if old is not None:
+            _cache_bytes -= _nbytes(old)
+        _cache[key] = entry
+        _cache_bytes += nbytes
+        while _cache_bytes > MAX_PREVIEW_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= _nbytes(evicted)
+
+
+def render(pixmap, src, name, params, selection=None):
+    if selection is None:
+        return buffers.show_array(kernels.apply(name, src, **params))
+    return selection.apply(pixmap, src, name, params)
+
+
+def neighbours(params, key, slider, radius=PREFETCH_RADIUS):
+    # Copies of params with key moved up to radius slider steps either way,
+    # nearest first
+    value = params[key]
+    result = []
+    for step in range(1, radius + 1):
+        for v in (value + step, value - step):
+            if slider.minimum() <= v <= slider.maximum():
+                result.append(dict(params, **{key: v}))
+    return result
+
+
+def cancel():
+    global _generation
+    with _lock:
+        _generation += 1
+
+
+def prefetch(pixmap, name, params_list, selection=None):
+    # Computes the given parameter sets on a background thread, newest
+    # request wins. Sources are read here on the GUI thread; the worker
+    # only touches numpy arrays and QImages.
+    global _pool, _generation
+    keys = [preview_key(pixmap, name, p, selection) for p in params_list]
+    with _lock:
+        _generation += 1
+        generation = _generation
+        todo = [(k, p) for k, p in zip(keys, params_list) if k not in _cache]
+    if not todo:
+        return
+    src = buffers.working_array(pixmap, np)
+    base = pixmap.toImage() if selection is not None else None
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=1)
+    _pool.submit(_prefetch, generation, src, base, name, todo, selection)
+
+
+def _render_image(src, base, name, params, selection):
+    # (QImage, unrounded result or None) off the GUI thread. base is the
+    # source as a QImage, needed for an 8-bit selection.
+    if selection is None:
+        result = kernels.apply(name, src, **dict(params))
+    elif src.dtype == np.uint8 and base is not None:
+        result = selection.apply(base, src, name, dict(params))
+    else:
+        result = selection.frame(src, name, dict(params))
+    if isinstance(result, QImage):
+        return result, None
+    precise = result if result.dtype != np.uint8 else None
+    return buffers.array_to_image(buffers.quantize(result)), precise
+
+
+def _prefetch(generation, src, base, name, todo, selection):
+    # Runs on the host so it doesn't compete with the GUI thread for the GPU
+    for key, params in todo:
+        if generation != _generation:
+            return
+        image, precise = _render_image(src, base, name, params, selection)
+        if generation != _generation:
+            return
+        store(key, image, precise)
+
+
+class Progressive(QObject):
+    # Coarse-to-fine previews for one dialog. request() shows a render of
+    # the reduced image at once and queues the finer ones; show_callback
+    # gets (pixmap, step) for each, step 1 being the full-size result, which
+    # is cached like any other preview. A new request or cancel() drops the
+    # stages of the last one that haven't started. On the GPU, or when the
+    # area rendered is small, the full-size render is done straight away.
+    rendered = pyqtSignal(int, int, object, object)
+
+    def __init__(self, pixmap, name, selection, show_callback, parent=None):
+        super().__init__(parent)
+        self.pixmap = pixmap
+        self.name = name
+        self.selection = selection
+        self.show_callback = show_callback
+        self.generation = 0
+        self.params = None
+        self.pending = False
+        # Stage renders are handed back to the GUI thread through the signal
+        self.rendered.connect(self.on_rendered)
+
+    def area(self):
+        rect = self.selection.rect if self.selection is not None else self.pixmap.rect()
+        return rect.width() * rect.height()
+
+    def coarse_step(self):
+        step = COARSE_STEP
+        while self.area() > COARSE_PIXELS * step * step:
+            step *= 2
+        return step
+
+    def request(self, params):
+        global _stage_pool
+        self.generation += 1
+        self.params = params
+        self.pending = False
+        key = preview_key(self.pixmap, self.name, params, self.selection)
+        pixmap = lookup(key)
+        if pixmap is None and (get_xp() is not np or self.area() < PROGRESSIVE_PIXELS):
+            pixmap = self.render(key)
+        if pixmap is not None:
+            self.show_callback(pixmap, 1)
+            return
+
+        self.pending = True
+        step = self.coarse_step()
+        image, _ = self._render_step(buffers.reduced_array(self.pixmap, step), step, params)
+        self.show_callback(QPixmap.fromImage(image), step)
+        steps = [s for s in FINE_STEPS if s < step] + [1]
+        src = buffers.working_array(self.pixmap, np)
+        base = self.pixmap.toImage() if self.selection is not None else None
+        if _stage_pool is None:
+            _stage_pool = ThreadPoolExecutor(max_workers=1)
+        _stage_pool.submit(self._stages, self.generation, params, src, base, steps)
+
+    def _render_step(self, src, step, params, base=None):
+        if step == 1:
+            return _render_image(src, base, self.name, params, self.selection)
+        selection = self.selection.reduced(step) if self.selection is not None else None
+        return _render_image(src, None, self.name, kernels.reduced_params(self.name, params, step), selection)
+
+    def _stages(self, generation, params, src, base, steps):
+        # Background thread. The generation is checked between stages; the
+        # one running when a new request comes in is finished and dropped.
+        for step in steps:
+            if generation != self.generation:
+                return
+            reduced = np.ascontiguousarray(src[::step, ::step]) if step > 1 else src
+            image, precise = self._render_step(reduced, step, params, base)
+            if generation != self.generation:
+                return
+            self.rendered.emit(generation, step, image, precise)
+
+    def on_rendered(self, generation, step, image, precise):
+        if generation != self.generation:
+            return
+        if step == 1:
+            key = preview_key(self.pixmap, self.name, self.params, self.selection)
+            store(key, image, precise)
+            pixmap = lookup(key)
+            self.pending = False
+        else:
+            pixmap = QPixmap.fromImage(image)
+        self.show_callback(pixmap, step)
+
+    def render(self, key):
+        src = buffers.working_array(self.pixmap, get_xp())
+        pixmap = render(self.pixmap, src, self.name, self.params, self.selection)
+        store(key, pixmap)
+        return pixmap
+
+    def finish(self):
+        # Shows the full-size result of the last request, rendering it here
+        # if the background hasn't delivered it yet
+        if not self.pending:
+            return
+        self.generation += 1
+        self.pending = False
+        key = preview_key(self.pixmap, self.name, self.params, self.selection)
+        pixmap = lookup(key)
+        if pixmap is None:
+            pixmap = self.render(key)
+        self.show_callback(pixmap, 1)
+
+    def cancel(self):
+        self.generation += 1
+        self.pending = False
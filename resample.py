@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+FILTERS = ["lanczos3", "bicubic", "box", "nearest"]
+
+# Output rows per dense weight block in the separable passes
+MATMUL_ROWS = 8
+
+WORKERS = os.cpu_count() or 4
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=WORKERS)
+    return _pool
+
+
+def _lanczos3(x):
+    x = np.abs(x)
+    out = np.sinc(x) * np.sinc(x / 3.0)
+    out[x >= 3.0] = 0.0
+    return out
+
+
+def _bicubic(x):
+    # Catmull-Rom (a = -0.5)
+    a = -0.5
+    x = np.abs(x)
+    x2 = x * x
+    x3 = x2 * x
+    return np.where(
+        x < 1.0, (a + 2) * x3 - (a + 3) * x2 + 1,
+        np.where(x < 2.0, a * x3 - 5 * a * x2 + 8 * a * x - 4 * a, 0.0)
+    )
+
+
+def _box(x):
+    return ((x >= -0.5) & (x < 0.5)).astype(np.float64)
+
+
+_KERNELS = {
+    "lanczos3": (_lanczos3, 3.0),
+    "bicubic": (_bicubic, 2.0),
+    "box": (_box, 0.5),
+}
+
+
+def _weights(in_n, out_n, method):
+    # Per output index: a fixed number of source taps and their normalised
+    # weights. Taps falling outside the image are dropped and renormalised.
+    kernel, support = _KERNELS[method]
+    scale = in_n / out_n
+    filterscale = max(scale, 1.0)
+    support = support * filterscale
+    centers = (np.arange(out_n) + 0.5) * scale
+    starts = np.floor(centers - support + 0.5).astype(np.int64)
+    taps = int(np.ceil(support)) * 2 + 1
+    idx = starts[:, None] + np.arange(taps)[None, :]
+    w = kernel((idx + 0.5 - centers[:, None]) / filterscale)
+    w[(idx < 0) | (idx >= in_n)] = 0.0
+    total = w.sum(axis=1, keepdims=True)
+    total[total == 0] = 1.0
+    w /= total
+
+    # Trim taps that are zero for every output
+    used = np.nonzero(np.any(w != 0, axis=0))[0]
+    if used.size:
+        idx = idx[:, used[0]:used[-1] + 1]
+        w = w[:, used[0]:used[-1] + 1]
+    return np.clip(idx, 0, in_n - 1), w.astype(np.float32)
+
+
+def _nearest_index(in_n, out_n):
+    centers = (np.arange(out_n) + 0.5) * (in_n / out_n)
+    return np.clip(centers.astype(np.int64), 0, in_n - 1)
+
+
+def _bands(n, workers):
+    step = max(16, -(-n // (workers * 4)))
+    return [(s, min(s + step, n)) for s in range(0, n, step)]
+
+
+def _run_bands(fn, n):
+    list(_get_pool().map(lambda band: fn(*band), _bands(n, WORKERS)))
+
+
+def _resample_rows(src, out_n, method):
+    # Filters along axis 0. A few output rows at a time only touch a short
+    # contiguous span of input rows, so that slice of the weight table is
+    # expanded into a small dense matrix and applied with one matmul.
+    idx, w = _weights(src.shape[0], out_n, method)
+    flat = src.reshape(src.shape[0], -1)
+    out = np.empty((out_n, flat.shape[1]), dtype=np.float32)
+    taps = idx.shape[1]
+
+    def work(start, stop):
+        lo = int(idx[start:stop].min())
+        hi = int(idx[start:stop].max()) + 1
+        block = flat[lo:hi].astype(np.float32, copy=False)
+        for s in range(start, stop, MATMUL_ROWS):
+            e = min(s + MATMUL_ROWS, stop)
+            sub_lo = int(idx[s:e].min())
+            sub_hi = int(idx[s:e].max()) + 1
+            mat = np.zeros((e - s, sub_hi - sub_lo), dtype=np.float32)
+            rows = np.repeat(np.arange(e - s), taps)
+            np.add.at(mat, (rows, (idx[s:e] - sub_lo).ravel()), w[s:e].ravel())
+            np.matmul(mat, block[sub_lo - lo:sub_hi - lo], out=out[s:e])
+
+    _run_bands(work, out_n)
+    return out.reshape((out_n,) + src.shape[1:])
+
+
+def resample(arr, out_w, out_h, method="lanczos3"):
+    # arr is (H, W) or (H, W, C) uint8; returns uint8 of size (out_h, out_w).
+    # Filtering is separable: one horizontal and one vertical pass, each with
+    # a precomputed weight table, split across row bands on a thread pool.
+    out_w = max(1, int(out_w))
+    out_h = max(1, int(out_h))
+    H, W = arr.shape[:2]
+
+    if method == "nearest":
+        ys = _nearest_index(H, out_h)
+        xs = _nearest_index(W, out_w)
+        return arr[ys][:, xs]
+
+    src = arr
+    # Vertical pass first, then the horizontal pass runs as another row pass
+    # on the transposed (already shorter) intermediate.
+    if src.shape[0] != out_h:
+        src = _resample_rows(src, out_h, method)
+    if src.shape[1] != out_w:
+        src = np.ascontiguousarray(np.swapaxes(src, 0, 1))
+        src = np.swapaxes(_resample_rows(src, out_w, method), 0, 1)
+
+    result = np.empty(src.shape, dtype=np.uint8)
+
+    def finish(start, stop):
+        np.clip(np.rint(src[start:stop]), 0, 255, out=result[start:stop], casting="unsafe")
+
+    _run_bands(finish, out_h)
+    return result
@@ -0,0 +1,196 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QComboBox
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import pyqtSignal
+
+import buffers
+from buffers import pixmap_to_array
+from derivatives import LUMA_B, LUMA_G, LUMA_R
+
+SCOPE_MODES = ["histogram", "rgb parade", "waveform"]
+# Scopes look at pixels on a regular grid, about this many of them
+MAX_SAMPLES = 1 << 18
+# Horizontal resolution of the parade and waveform
+COLUMNS = 256
+SCOPE_HEIGHT = 128
+MAX_STATS = 8
+
+
+def sample_step(width, height):
+    return max(1, int(np.ceil(np.sqrt(width * height / MAX_SAMPLES))))
+
+
+def image_stats(arr, step, width, y0=0, x0=0):
+    # Counts for the pixels of arr, a block of a width-wide image placed at
+    # (y0, x0), that lie on the image's sampling grid. Using the global grid
+    # makes the counts additive, so a region can be swapped out of the
+    # totals by subtracting its old counts and adding its new ones.
+    sample = arr[-y0 % step::step, -x0 % step::step]
+    cols = (x0 + (-x0 % step) + np.arange(sample.shape[1]) * step) * COLUMNS // width
+    cols = np.broadcast_to(cols[None, :], sample.shape[:2]).ravel()
+
+    b = sample[..., 0].ravel()
+    g = sample[..., 1].ravel()
+    r = sample[..., 2].ravel()
+    luma = np.rint(LUMA_R * r + LUMA_G * g + LUMA_B * b).astype(np.int64)
+
+    planes = [r, g, b, luma]
+    hist = np.stack([np.bincount(p, minlength=256) for p in planes])
+    binned = np.stack([
+        np.bincount(p.astype(np.int64) * COLUMNS + cols, minlength=256 * COLUMNS).reshape(256, COLUMNS)
+        for p in planes
+    ])
+    return {"hist": hist, "binned": binned}
+
+
+def combine(base, minus, plus):
+    return {k: base[k] - minus[k] + plus[k] for k in base}
+
+
+def _log_intensity(counts):
+    peak = counts.max()
+    if peak == 0:
+        return np.zeros(counts.shape, np.float32)
+    return (np.log1p(counts) / np.log1p(peak)).astype(np.float32)
+
+
+def render(stats, mode):
+    # Scope image as a BGRA array
+    if mode == "histogram":
+        hist = stats["hist"][:3].astype(np.float64)
+        peak = hist.max() or 1.0
+        heights = np.sqrt(hist / peak) * SCOPE_HEIGHT
+        rows = (SCOPE_HEIGHT - np.arange(SCOPE_HEIGHT))[:, None]
+        out = np.zeros((SCOPE_HEIGHT, 256, 4), np.uint8)
+        for c, channel in enumerate((2, 1, 0)):
+            out[..., channel] = np.where(rows <= heights[c][None, :], 220, 0)
+    elif mode == "rgb parade":
+        panels = []
+        for c, channel in enumerate((2, 1, 0)):
+            level = _log_intensity(stats["binned"][c])[::-1]
+            panel = np.zeros((256, COLUMNS, 4), np.uint8)
+            panel[..., channel] = np.rint(level * 255)
+            panels.append(panel)
+        out = np.concatenate(panels, axis=1)
+    else:
+        level = np.rint(_log_intensity(stats["binned"][3])[::-1] * 255).astype(np.uint8)
+        out = np.zeros((256, COLUMNS, 4), np.uint8)
+        out[..., 0] = out[..., 2] = level // 3
+        out[..., 1] = level
+    out[..., 3] = 255
+    return out
+
+
+class ScopesPanel(QWidget):
+    # Histogram, RGB parade and waveform of whatever the canvas shows.
+    # Counting runs on a worker thread, newest request first, so previews
+    # never wait on it. Edits confined to a rect reuse the counts of the
+    # image they were made on and only recount that rect.
+    _computed = pyqtSignal(int, object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.stats = OrderedDict()
+        self.current_key = None
+        self.pending = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._computed.connect(self._on_computed)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(4, 4, 4, 4)
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItems(SCOPE_MODES)
+        self.mode_combo.currentIndexChanged.connect(lambda _: self.redraw())
+        layout.addWidget(self.mode_combo)
+        self.scope_label = QLabel()
+        self.scope_label.setMinimumSize(200, 120)
+        self.scope_label.setScaledContents(True)
+        layout.addWidget(self.scope_label)
+        layout.addStretch()
+        self.setLayout(layout)
+
+    def show_image(self, pixmap, base=None, rect=None):
+        if pixmap is None or pixmap.isNull():
+            return
+        key = pixmap.cacheKey()
+        self.current_key = key
+        if key in self.stats:
+            self.stats.move_to_end(key)
+            self.redraw()
+            return
+        if not self.isVisible():
+            # Counted when the panel is shown again
+            self.pending = (pixmap, base, rect)
+            return
+        self.pending = None
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+
+        W, H = pixmap.width(), pixmap.height()
+        step = sample_step(W, H)
+        # Arrays are gathered here on the GUI thread, the worker only counts
+        if base is not None and rect is not None and base.size() == pixmap.size():
+            base_key = base.cacheKey()
+            base_stats = self.stats.get(base_key)
+            base_arr = None if base_stats is not None else buffers.peek_array(base)
+            old = pixmap_to_array(base.copy(rect))
+            new = pixmap_to_array(pixmap.copy(rect))
+            job = (self._region_stats, base_key, base_stats, base_arr, old, new, rect.y(), rect.x(), step, W)
+        else:
+            job = (image_stats, buffers.peek_array(pixmap), step, W)
+        self._pool.submit(self._run, generation, key, job)
+
+    def _region_stats(self, base_key, base_stats, base_arr, old, new, y0, x0, step, width):
+        if base_stats is None:
+            base_stats = image_stats(base_arr, step, width)
+            self._computed.emit(-1, base_key, base_stats)
+        return combine(
+            base_stats,
+            image_stats(old, step, width, y0, x0),
+            image_stats(new, step, width, y0, x0)
+        )
+
+    def _run(self, generation, key, job):
+        if generation != self._generation:
+            return
+        fn, args = job[0], job[1:]
+        self._computed.emit(generation, key, fn(*args))
+
+    def _on_computed(self, generation, key, stats):
+        self.stats[key] = stats
+        self.stats.move_to_end(key)
+        while len(self.stats) > MAX_STATS:
+            self.stats.popitem(last=False)
+        if key == self.current_key:
+            self.redraw()
+
+    def redraw(self):
+        stats = self.stats.get(self.current_key)
+        if stats is None:
+            return
+        arr = np.ascontiguousarray(render(stats, self.mode_combo.currentText()))
+        H, W = arr.shape[:2]
+        image = QImage(arr.data, W, H, W * 4, QImage.Format_ARGB32).copy()
+        self.scope_label.setPixmap(QPixmap.fromImage(image))
+
+    def clear(self):
+        self.current_key = None
+        self.pending = None
+        self.scope_label.clear()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.pending is not None:
+            self.show_image(*self.pending)
+        else:
+            self.redraw()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
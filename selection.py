@@ -0,0 +1,153 @@
+import hashlib
+
+import numpy as np
+from PyQt5.QtGui import QImage, QPainter, QPainterPath
+from PyQt5.QtCore import Qt, QRect, QRectF
+
+import kernels
+from backend import xp_of
+import buffers
+from buffers import array_to_image
+
+
+class Selection:
+    # Part of an image that effects are limited to: a bounding rect in image
+    # pixels and, unless the selection is a plain rectangle, a float coverage
+    # mask the size of that rect. Effects run on the rect plus whatever margin
+    # they need and are blended back through the mask.
+    def __init__(self, rect, mask=None, outline=None):
+        self.rect = rect
+        self.mask = mask
+        digest = hashlib.sha1(mask.tobytes()).hexdigest() if mask is not None else None
+        self.key = (rect.x(), rect.y(), rect.width(), rect.height(), digest)
+        if outline is None:
+            outline = QPainterPath()
+            outline.addRect(QRectF(rect))
+        self.outline = outline
+
+    @classmethod
+    def from_path(cls, path, width, height):
+        bounds = QRect(0, 0, width, height)
+        rect = path.boundingRect().toAlignedRect().intersected(bounds)
+        if rect.isEmpty():
+            return None
+        image = QImage(rect.width(), rect.height(), QImage.Format_Grayscale8)
+        image.fill(0)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing, True)
+        painter.translate(-rect.x(), -rect.y())
+        painter.fillPath(path, Qt.white)
+        painter.end()
+        mask = _gray_array(image)
+        if not mask.any():
+            return None
+        if mask.all():
+            return cls(rect, None, path)
+        return cls(rect, mask.astype(np.float32) / 255.0, path)
+
+    @classmethod
+    def from_mask_image(cls, image, width, height):
+        # White selects, black leaves alone; the mask is stretched to the image
+        image = image.convertToFormat(QImage.Format_Grayscale8)
+        if image.width() != width or image.height() != height:
+            image = image.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        gray = _gray_array(image)
+        rows = np.flatnonzero(gray.any(axis=1))
+        cols = np.flatnonzero(gray.any(axis=0))
+        if rows.size == 0:
+            return None
+        rect = QRect(int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+        mask = gray[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        if (mask == 255).all():
+            return cls(rect)
+        return cls(rect, mask.astype(np.float32) / 255.0)
+
+    def fits(self, width, height):
+        return QRect(0, 0, width, height).contains(self.rect)
+
+    def reduced(self, step):
+        # The selection on the image sampled at every step-th pixel
+        r = self.rect
+        x0, y0 = r.x() // step, r.y() // step
+        x1 = -(-(r.x() + r.width()) // step)
+        y1 = -(-(r.y() + r.height()) // step)
+        mask = None
+        if self.mask is not None:
+            rows = np.clip(np.arange(y0, y1) * step - r.y(), 0, r.height() - 1)
+            cols = np.clip(np.arange(x0, x1) * step - r.x(), 0, r.width() - 1)
+            mask = self.mask[rows[:, None], cols]
+        return Selection(QRect(x0, y0, x1 - x0, y1 - y0), mask)
+
+    def crop_rect(self, margin, align, width, height):
+        # The selection grown by margin and snapped outwards to align, clamped
+        # to the image, as (x0, y0, x1, y1)
+        r = self.rect
+        x0 = max(0, r.x() - margin) // align * align
+        y0 = max(0, r.y() - margin) // align * align
+        x1 = min(width, -(-(r.x() + r.width() + margin) // align) * align)
+        y1 = min(height, -(-(r.y() + r.height() + margin) // align) * align)
+        return x0, y0, x1, y1
+
+    def effect(self, src, name, params):
+        # Effect result for the selection's rect, before the mask. src is
+        # the full frame on either backend.
+        H, W = src.shape[:2]
+        margin, align = kernels.region_margin(name, params)
+        x0, y0, x1, y1 = self.crop_rect(margin, align, W, H)
+        result = kernels.apply(name, src[y0:y1, x0:x1], origin=(x0, y0), **params)
+
+        r = self.rect
+        top, left = r.y() - y0, r.x() - x0
+        return result[top:top + r.height(), left:left + r.width()]
+
+    def patch(self, src, name, params):
+        # Effect result for the selection's rect, blended with the source
+        # through the mask
+        result = self.effect(src, name, params)
+        r = self.rect
+        base = src[r.y():r.y() + r.height(), r.x():r.x() + r.width()]
+        if self.mask is None:
+            return result
+        xp = xp_of(src)
+        mask = xp.asarray(self.mask)[..., None]
+        blended = base + (result.astype(xp.float32) - base) * mask
+        if src.dtype == xp.uint8:
+            return xp.rint(blended).astype(xp.uint8)
+        return blended.astype(src.dtype)
+
+    def apply(self, pixmap, src, name, params):
+        # Copy of pixmap with the effect applied inside the selection
+        patch = self.patch(src, name, params)
+        if patch.dtype == np.uint8:
+            return paste(pixmap, self.rect.topLeft(), array_to_image(patch))
+        # Higher working depths keep the whole unrounded frame, so the patch
+        # goes into a copy of the source rather than onto the pixmap
+        return buffers.show_array(self._into(src, patch))
+
+    def frame(self, src, name, params):
+        # Copy of the full source array with the effect applied inside the
+        # selection
+        return self._into(src, self.patch(src, name, params))
+
+    def _into(self, src, patch):
+        r = self.rect
+        full = src.copy()
+        full[r.y():r.y() + r.height(), r.x():r.x() + r.width()] = patch
+        return full
+
+
+def paste(pixmap, pos, image):
+    result = pixmap.copy()
+    painter = QPainter(result)
+    painter.setCompositionMode(QPainter.CompositionMode_Source)
+    painter.drawImage(pos, image)
+    painter.end()
+    return result
+
+
+def _gray_array(image):
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    stride = image.bytesPerLine()
+    arr = np.frombuffer(ptr, np.uint8).reshape((image.height(), stride))
+    return arr[:, :image.width()].copy()
@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+import socketserver
+from collections import deque
+from urllib.parse import parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QBuffer, QIODevice, QByteArray
+
+import bands
+import backend
+import colorspace
+import fused
+from buffers import image_to_array, array_to_image
+from kernels import EFFECTS
+from pipeline import Pipeline
+
+# Headless effects for other tools on the same machine. Requests are plain
+# HTTP, on localhost or on a Unix socket:
+#
+#   POST /apply?format=png
+#   X-Pipeline: [["pixelsort", {"direction": 0}], ["halftone", {"dot_size": 8}]]
+#   <encoded image bytes>
+#
+# returns the encoded result with the request's timings in X-Metrics.
+# GET /effects lists effect names, GET /metrics the server's counters.
+#
+# Work runs in a pool of worker processes that each load the effect modules
+# and warm up the GPU once. Requests past the workers plus a bounded queue
+# are turned away with 503 rather than piling up.
+
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE = 16
+MAX_BODY_BYTES = 256 * 1024 * 1024
+LATENCY_WINDOW = 1000
+FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG", "bmp": "BMP"}
+
+
+def parse_pipeline(text):
+    # [[name, {params}], ...] -> Pipeline, KeyError/ValueError on bad input
+    steps = json.loads(text)
+    if not isinstance(steps, list):
+        raise ValueError("pipeline must be a list of [effect, params] pairs")
+    pipeline = Pipeline()
+    for step in steps:
+        if isinstance(step, str):
+            name, params = step, {}
+        else:
+            name, params = step[0], (step[1] if len(step) > 1 else {})
+        if not isinstance(params, dict):
+            raise ValueError(f"params for {name} must be an object")
+        pipeline.add(name, **params)
+    return pipeline
+
+
+def _worker_init():
+    # One process per core already, so effects don't fan out into bands
+    bands.set_workers(1)
+    backend.warm_up()
+    fused.warm_up()
+
+
+def process(data, steps, fmt):
+    # Runs in a worker: decode, apply, encode, each step timed
+    timings = {}
+    t = time.perf_counter()
+    image = colorspace.to_working(QImage.fromData(QByteArray(data)))
+    if image.isNull():
+        raise ValueError("could not decode image")
+    arr = image_to_array(image)
+    timings["decode_ms"] = (time.perf_counter() - t) * 1000
+
+    t = time.perf_counter()
+    out = Pipeline(steps).run(arr)
+    timings["effects_ms"] = (time.perf_counter() - t) * 1000
+
+    t = time.perf_counter()
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    array_to_image(out).save(buffer, fmt)
+    encoded = bytes(buffer.data())
+    timings["encode_ms"] = (time.perf_counter() - t) * 1000
+    timings["width"], timings["height"] = arr.shape[1], arr.shape[0]
+    timings["pid"] = os.getpid()
+    return encoded, timings
+
+
+class Metrics:
+    # Counters and a window of recent latencies, shared by handler threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            snap = {
+                "uptime_s": round(time.time() - self.started, 1),
+                "requests": self.requests,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "in_flight": self.in_flight,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+        if latencies:
+            snap["latency_ms"] = {
+                "mean": round(sum(latencies) / len(latencies), 2),
+                "p50": round(latencies[len(latencies) // 2], 2),
+                "p95": round(latencies[int(len(latencies) * 0.95)], 2),
+                "max": round(latencies[-1], 2),
+            }
+        return snap
+
+
+class EffectServer:
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        # Spawned workers never inherit Qt state; each warms up once
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_worker_init
+        )
+        self.slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self.metrics = Metrics()
+
+    def start(self):
+        # Starts every worker now so the first requests don't pay for it
+        for future in [self.pool.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def apply(self, data, pipeline, fmt):
+        # -> (status, body, metrics); status 503 when the queue is full
+        metrics = self.metrics
+        with metrics.lock:
+            metrics.requests += 1
+            metrics.bytes_in += len(data)
+        if not self.slots.acquire(blocking=False):
+            with metrics.lock:
+                metrics.rejected += 1
+            return 503, b"queue full", {}
+        start = time.perf_counter()
+        with metrics.lock:
+            metrics.in_flight += 1
+        try:
+            future = self.pool.submit(process, data, pipeline.steps, fmt)
+            body, timings = future.result()
+        except (ValueError, TypeError) as e:
+            # Undecodable images and bad effect parameters
+            with metrics.lock:
+                metrics.failed += 1
+            return 400, str(e).encode("utf-8"), {}
+        except Exception as e:
+            with metrics.lock:
+                metrics.failed += 1
+            return 500, f"{type(e).__name__}: {e}".encode("utf-8"), {}
+        finally:
+            self.slots.release()
+            with metrics.lock:
+                metrics.in_flight -= 1
+        total = (time.perf_counter() - start) * 1000
+        work = timings["decode_ms"] + timings["effects_ms"] + timings["encode_ms"]
+        timings["total_ms"] = total
+        # Time spent waiting for a worker plus moving bytes between processes
+        timings["queue_ms"] = max(0.0, total - work)
+        with metrics.lock:
+            metrics.completed += 1
+            metrics.bytes_out += len(body)
+            metrics.latencies.append(total)
+        return 200, body, {k: round(v, 2) if isinstance(v, float) else v for k, v in timings.items()}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+class EffectRequestHandler(BaseHTTPRequestHandler):
+    server_version = "CachedWhale"
+
+    def _send(self, status, body, content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj):
+        self._send(200, json.dumps(obj).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/effects":
+            self._send_json(sorted(EFFECTS))
+        elif path == "/metrics":
+            self._send_json(self.server.effects.metrics.snapshot())
+        else:
+            self._send(404, b"not found")
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        if path != "/apply":
+            self._send(404, b"not found")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > MAX_BODY_BYTES:
+            self._send(413 if length > 0 else 400, b"image body required")
+            return
+        data = self.rfile.read(length)
+
+        fmt = FORMATS.get(parse_qs(query).get("format", ["png"])[0].lower())
+        if fmt is None:
+            self._send(400, b"unsupported format")
+            return
+        try:
+            pipeline = parse_pipeline(self.headers.get("X-Pipeline") or "[]")
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            self._send(400, f"bad pipeline: {e}".encode("utf-8"))
+            return
+
+        status, body, metrics = self.server.effects.apply(data, pipeline, fmt)
+        if status == 200:
+            self._send(200, body, f"image/{fmt.lower()}", {"X-Metrics": json.dumps(metrics)})
+        else:
+            self._send(status, body, headers={"Retry-After": "1"} if status == 503 else None)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # HTTP over a Unix socket, same handler as the TCP server
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def make_server(effects, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, verbose=False):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = UnixHTTPServer(socket_path, EffectRequestHandler)
+    else:
+        httpd = ThreadingHTTPServer((host, port), EffectRequestHandler)
+        httpd.daemon_threads = True
+    httpd.effects = effects
+    httpd.verbose = verbose
+    return httpd
+
+
+def _terminate(signum, frame):
+    # SIGTERM shuts down like Ctrl+C, so the socket file and workers are
+    # cleaned up
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve Cached Whale effects over local HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--queue", type=int, default=DEFAULT_QUEUE,
+                        help="requests allowed to wait for a worker")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    effects = EffectServer(args.workers, args.queue)
+    effects.start()
+    httpd = make_server(effects, args.host, args.port, args.socket, args.verbose)
+    where = args.socket or f"http://{args.host}:{args.port}"
+    print(f"serving effects on {where} with {effects.workers} workers", file=sys.stderr)
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        effects.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
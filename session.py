@@ -0,0 +1,303 @@
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+from PyQt5.QtGui import QPixmap, QImage, QImageReader, QPainter
+from PyQt5.QtCore import Qt, QRect, QThread, pyqtSignal
+
+import colorspace
+from snapshots import Snapshot, pack_image, packed_nbytes
+
+THUMBNAIL_SIZE = 48
+MAX_THUMBNAILS = 64
+
+
+def pixmap_nbytes(pixmap):
+    if isinstance(pixmap, RegionPatch):
+        pixmap = pixmap.snapshot
+    if isinstance(pixmap, Snapshot):
+        return pixmap.nbytes()
+    return pixmap.width() * pixmap.height() * 4
+
+
+# History stacks keep a full pixmap on top, the image on screen. States
+# below it, and redo states, are Snapshots (see snapshots.py) or
+# RegionPatches; compact() and restore() convert between the two forms.
+def compact(entry):
+    return Snapshot.of(entry) if isinstance(entry, QPixmap) else entry
+
+
+def restore(entry):
+    return entry.pixmap() if isinstance(entry, Snapshot) else entry
+
+
+class RegionPatch:
+    # A history state kept as the only region where it differs from the
+    # state next to it in the stack; the rest of the pixels are borrowed
+    # from that neighbour when the state is restored.
+    def __init__(self, x, y, snapshot):
+        self.x = x
+        self.y = y
+        self.snapshot = snapshot
+
+    @classmethod
+    def cut(cls, pixmap, rect):
+        return cls(rect.x(), rect.y(), Snapshot.of(pixmap.copy(rect)))
+
+    @property
+    def rect(self):
+        return QRect(self.x, self.y, self.snapshot.width, self.snapshot.height)
+
+    def apply(self, pixmap):
+        result = pixmap.copy()
+        painter = QPainter(result)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawPixmap(self.x, self.y, self.snapshot.pixmap())
+        painter.end()
+        return result
+
+
+def pack_entry(entry):
+    if isinstance(entry, RegionPatch):
+        return ("patch", entry.x, entry.y, entry.snapshot.packed())
+    if isinstance(entry, Snapshot):
+        return entry.packed()
+    return pack_image(entry.toImage())
+
+
+def unpack_entry(packed):
+    # Entries come back as snapshots, only the top of the undo stack is
+    # turned back into a pixmap
+    if packed[0] == "patch":
+        _, x, y, data = packed
+        return RegionPatch(x, y, Snapshot(packed=data))
+    return Snapshot(packed=packed)
+
+
+def packed_entry_nbytes(packed):
+    if packed[0] == "patch":
+        packed = packed[3]
+    return packed_nbytes(packed)
+
+
+class DecodeThread(QThread):
+    # Full decode of an image file off the GUI thread
+    decoded = pyqtSignal(str, QImage)
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.path = path
+
+    def run(self):
+        reader = QImageReader(self.path)
+        reader.setAutoTransform(True)
+        self.decoded.emit(self.path, colorspace.to_working(reader.read()))
+
+
+class Document:
+    # One open image with its own history. While inactive the history can be
+    # compressed in memory, and then spilled to disk.
+    def __init__(self, path, pixmap):
+        self.path = path
+        self.undo_stack = [pixmap.copy()]
+        self.redo_stack = []
+        # Frame sequences (GIFs, numbered PNGs) keep one FrameSequence per
+        # undo entry; unchanged entries share the same object. These stay in
+        # memory when the document is compressed or spilled.
+        self.sequences = []
+        self.sequence_redo = []
+        # Effect layers over the image while a stack is up (layers.LayerStack),
+        # also kept in memory
+        self.layers = None
+        self._packed = None
+        self._spill_path = None
+
+    @property
+    def title(self):
+        return os.path.basename(self.path) if self.path else "untitled"
+
+    def current_pixmap(self):
+        self.resume()
+        return self.undo_stack[-1]
+
+    def is_resident(self):
+        return self._packed is None and self._spill_path is None
+
+    def nbytes(self):
+        if self._spill_path is not None:
+            return 0
+        if self._packed is not None:
+            undo, redo = self._packed
+            return sum(packed_entry_nbytes(p) for p in undo + redo)
+        return sum(pixmap_nbytes(p) for p in self.undo_stack + self.redo_stack)
+
+    def compress(self):
+        if not self.is_resident():
+            return
+        self._packed = (
+            [pack_entry(p) for p in self.undo_stack],
+            [pack_entry(p) for p in self.redo_stack]
+        )
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+
+    def spill(self, spill_dir):
+        self.compress()
+        if self._spill_path is not None:
+            return
+        fd, path = tempfile.mkstemp(suffix=".spill", dir=spill_dir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(self._packed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_path = path
+        self._packed = None
+
+    def resume(self):
+        if self._spill_path is not None:
+            with open(self._spill_path, "rb") as f:
+                self._packed = pickle.load(f)
+            self._remove_spill()
+        if self._packed is not None:
+            undo, redo = self._packed
+            # Lists are updated in place, the editor may hold references
+            self.undo_stack[:] = [unpack_entry(p) for p in undo]
+            self.redo_stack[:] = [unpack_entry(p) for p in redo]
+            if self.undo_stack:
+                self.undo_stack[-1] = restore(self.undo_stack[-1])
+            self._packed = None
+
+    def discard(self):
+        self._remove_spill()
+        self._packed = None
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.sequences.clear()
+        self.sequence_redo.clear()
+
+    def _remove_spill(self):
+        if self._spill_path is not None:
+            try:
+                os.remove(self._spill_path)
+            except OSError:
+                pass
+            self._spill_path = None
+
+
+class Session:
+    # Open documents in tab order, plus LRU caches of decoded images and tab
+    # thumbnails. Everything held in memory shares one byte budget; when it
+    # is exceeded decoded images are dropped first, then the least recently
+    # used inactive documents are compressed, then spilled to disk.
+    def __init__(self, spill_dir, memory_budget):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.documents = []
+        self.current = None
+        self._recent = []
+        self.decoded = OrderedDict()
+        self.thumbnails = OrderedDict()
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def find(self, path):
+        for doc in self.documents:
+            if doc.path == path:
+                return doc
+        return None
+
+    def _decoded_key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (path, st.st_mtime_ns, st.st_size)
+
+    def lookup(self, path):
+        key = self._decoded_key(path)
+        pixmap = self.decoded.get(key)
+        if pixmap is not None:
+            self.decoded.move_to_end(key)
+        return pixmap
+
+    def remember(self, path, pixmap):
+        key = self._decoded_key(path)
+        if key is not None and not pixmap.isNull():
+            self.decoded[key] = pixmap
+            self.enforce_budget()
+
+    def decode(self, path):
+        pixmap = self.lookup(path)
+        if pixmap is None:
+            pixmap = QPixmap.fromImage(colorspace.load(path))
+            self.remember(path, pixmap)
+        return pixmap
+
+    def open(self, path, pixmap):
+        doc = Document(path, pixmap)
+        self.documents.append(doc)
+        return doc
+
+    def activate(self, doc):
+        doc.resume()
+        if doc in self._recent:
+            self._recent.remove(doc)
+        self._recent.append(doc)
+        self.current = doc
+        self.enforce_budget()
+
+    def close(self, doc):
+        self.documents.remove(doc)
+        if doc in self._recent:
+            self._recent.remove(doc)
+        self.thumbnails.pop(id(doc), None)
+        doc.discard()
+        if self.current is doc:
+            self.current = self._recent[-1] if self._recent else None
+            if self.current is not None:
+                self.current.resume()
+
+    def close_all(self):
+        for doc in list(self.documents):
+            self.close(doc)
+
+    def nbytes(self):
+        decoded = sum(pixmap_nbytes(p) for p in self.decoded.values())
+        return decoded + sum(doc.nbytes() for doc in self.documents)
+
+    def enforce_budget(self):
+        total = self.nbytes()
+        while total > self.memory_budget and self.decoded:
+            _, pixmap = self.decoded.popitem(last=False)
+            total -= pixmap_nbytes(pixmap)
+
+        inactive = [doc for doc in self._recent if doc is not self.current]
+        for doc in inactive:
+            if total <= self.memory_budget:
+                return
+            if doc.is_resident():
+                before = doc.nbytes()
+                doc.compress()
+                total -= before - doc.nbytes()
+        for doc in inactive:
+            if total <= self.memory_budget:
+                return
+            before = doc.nbytes()
+            doc.spill(self.spill_dir)
+            total -= before
+
+    def thumbnail(self, doc):
+        # Only resident documents can be re-rendered, the rest keep their last
+        # thumbnail until they are activated again.
+        key = id(doc)
+        if doc.is_resident() and doc.undo_stack:
+            pixmap = doc.undo_stack[-1]
+            cached = self.thumbnails.get(key)
+            if cached is None or cached[0] != pixmap.cacheKey():
+                thumb = pixmap.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                self.thumbnails[key] = (pixmap.cacheKey(), thumb)
+        cached = self.thumbnails.get(key)
+        if cached is None:
+            return QPixmap()
+        self.thumbnails.move_to_end(key)
+        while len(self.thumbnails) > MAX_THUMBNAILS:
+            self.thumbnails.popitem(last=False)
+        return cached[1]
@@ -0,0 +1,201 @@
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtGui import QPixmap, QImage
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compact lossless copies of images kept in the history. The pixels are
+# stored in the smallest layout that holds them exactly, then compressed
+# with the fastest codec at hand (lz4, else zstd, else zlib at level 1 if
+# it is worth it):
+#
+#   bits     two colours, one bit per pixel plus the two colours
+#   indexed  up to 256 colours, one byte per pixel plus the palette
+#   gray     R = G = B, one byte per pixel, two with alpha
+#   rgb      opaque, three bytes per pixel
+#   argb     everything else, as is
+#
+# Dithered results come out at 1/32 of their ARGB32 size before
+# compression. Packing runs on a background thread; until it is done a
+# snapshot keeps the image it was made from.
+
+MAX_PALETTE = 256
+# Every PALETTE_SAMPLE-th pixel is looked at first, so images with many
+# colours are ruled out without a pass over all of them
+PALETTE_SAMPLE = 61
+PALETTE_ROWS = 256
+# zlib is slow enough that data is only given to it when a sample of it
+# shrinks to at most ZLIB_WORTH of its size; the rest is stored as is
+ZLIB_SAMPLE = 1 << 20
+ZLIB_WORTH = 0.8
+
+_FORMATS = (QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied)
+_pool = None
+
+
+def codec():
+    if lz4 is not None:
+        return "lz4"
+    if zstandard is not None:
+        return "zstd"
+    return "zlib"
+
+
+def compress(data):
+    name = codec()
+    if name == "lz4":
+        return name, lz4.compress(data)
+    if name == "zstd":
+        return name, zstandard.ZstdCompressor(level=1).compress(data)
+    sample = data[:ZLIB_SAMPLE]
+    if len(zlib.compress(sample, 1)) > ZLIB_WORTH * len(sample):
+        return "raw", data
+    return name, zlib.compress(data, 1)
+
+
+def decompress(name, data):
+    if name == "lz4":
+        return lz4.decompress(data)
+    if name == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if name == "raw":
+        return data
+    return zlib.decompress(data)
+
+
+def _palette(values):
+    # (sorted colours, uint8 index per pixel) for an image of at most
+    # MAX_PALETTE colours, None otherwise. Both passes go in row bands so
+    # the temporaries stay small.
+    colours = np.unique(values.ravel()[::PALETTE_SAMPLE])
+    if len(colours) > MAX_PALETTE:
+        return None
+    H = values.shape[0]
+    for y0 in range(0, H, PALETTE_ROWS):
+        band = values[y0:y0 + PALETTE_ROWS]
+        found = np.minimum(np.searchsorted(colours, band), len(colours) - 1)
+        missing = colours[found] != band
+        if missing.any():
+            # Colours the sample missed
+            colours = np.union1d(colours, band[missing])
+            if len(colours) > MAX_PALETTE:
+                return None
+    index = np.empty(values.shape, np.uint8)
+    for y0 in range(0, H, PALETTE_ROWS):
+        index[y0:y0 + PALETTE_ROWS] = np.searchsorted(colours, values[y0:y0 + PALETTE_ROWS])
+    return colours, index
+
+
+def pack_image(image):
+    # QImage -> (width, height, format, layout, codec, data, palette)
+    if image.format() not in _FORMATS:
+        image = image.convertToFormat(QImage.Format_ARGB32)
+    w, h = image.width(), image.height()
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    arr = np.frombuffer(ptr, np.uint8).reshape(h, w, 4)
+    opaque = image.format() == QImage.Format_RGB32 or bool((arr[..., 3] == 255).all())
+    palette = b""
+
+    found = _palette(arr.view(np.uint32).reshape(h, w))
+    if found is not None:
+        colours, index = found
+        palette = colours.tobytes()
+        if len(colours) <= 2:
+            layout, pixels = "bits", np.packbits(index, axis=1)
+        else:
+            layout, pixels = "indexed", index
+    elif np.array_equal(arr[..., 0], arr[..., 1]) and np.array_equal(arr[..., 0], arr[..., 2]):
+        layout, pixels = ("gray", arr[..., 0]) if opaque else ("gray alpha", arr[..., [0, 3]])
+    elif opaque:
+        layout, pixels = "rgb", arr[..., :3]
+    else:
+        layout, pixels = "argb", arr
+    name, data = compress(np.ascontiguousarray(pixels).tobytes())
+    return (w, h, int(image.format()), layout, name, data, palette)
+
+
+def unpack_image(packed):
+    w, h, fmt, layout, name, data, palette = packed
+    pixels = np.frombuffer(decompress(name, data), np.uint8)
+    if layout in ("bits", "indexed"):
+        colours = np.frombuffer(palette, np.uint32)
+        if layout == "bits":
+            index = np.unpackbits(pixels.reshape(h, -1), axis=1, count=w)
+        else:
+            index = pixels.reshape(h, w)
+        arr = colours[index].view(np.uint8).reshape(h, w, 4)
+    else:
+        arr = np.empty((h, w, 4), np.uint8)
+        if layout == "gray":
+            arr[..., :3] = pixels.reshape(h, w, 1)
+            arr[..., 3] = 255
+        elif layout == "gray alpha":
+            pixels = pixels.reshape(h, w, 2)
+            arr[..., :3] = pixels[..., :1]
+            arr[..., 3] = pixels[..., 1]
+        elif layout == "rgb":
+            arr[..., :3] = pixels.reshape(h, w, 3)
+            arr[..., 3] = 255
+        else:
+            arr[...] = pixels.reshape(h, w, 4)
+    return QImage(arr.data, w, h, w * 4, QImage.Format(fmt)).copy()
+
+
+def packed_nbytes(packed):
+    return len(packed[5]) + len(packed[6])
+
+
+class Snapshot:
+    # A history state that is not on screen. Made on the GUI thread from a
+    # pixmap (toImage shares the pixels, so this is cheap) and packed on
+    # the snapshot thread; pixmap() gives the image back either way.
+    def __init__(self, image=None, packed=None):
+        self._image = image
+        self._packed = packed
+        self._lock = threading.Lock()
+        if packed is None:
+            self.width, self.height = image.width(), image.height()
+        else:
+            self.width, self.height = packed[0], packed[1]
+
+    @classmethod
+    def of(cls, pixmap):
+        global _pool
+        snapshot = cls(image=pixmap.toImage())
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=1)
+        _pool.submit(snapshot.packed)
+        return snapshot
+
+    def packed(self):
+        # Packs now if the snapshot thread hasn't got to it yet
+        with self._lock:
+            if self._packed is None:
+                self._packed = pack_image(self._image)
+                self._image = None
+            return self._packed
+
+    def pixmap(self):
+        # The packed data is set before the image is let go, so one of the
+        # two is always there without waiting on a pack in progress
+        image = self._image
+        if image is None:
+            image = unpack_image(self._packed)
+        return QPixmap.fromImage(image)
+
+    def nbytes(self):
+        packed = self._packed
+        if packed is None:
+            return self.width * self.height * 4
+        return packed_nbytes(packed)
@@ -0,0 +1,63 @@
+import time
+
+# Taken before the imports below, numpy and Qt are part of cold start too
+STARTED = time.perf_counter()
+
+import threading
+
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+import backend
+import fused
+
+# Cold-start profile. main imports this module before anything else, so the
+# marks count from there. Run with --startup-timing to print them once the
+# background warm-up has finished; python -X importtime main.py breaks the
+# import step down by module.
+
+_marks = []
+_last = {}
+
+
+def begin():
+    # Steps on the calling thread are timed from here on
+    _last[threading.get_ident()] = time.perf_counter()
+
+
+def mark(label):
+    # Time since the previous mark on the same thread, and since start
+    now = time.perf_counter()
+    ident = threading.get_ident()
+    _marks.append((label, now - _last.get(ident, STARTED), now - STARTED))
+    _last[ident] = now
+
+
+def report():
+    lines = [f"{'startup':<28}{'step ms':>10}{'at ms':>10}"]
+    for label, step, at in sorted(_marks, key=lambda m: m[2]):
+        lines.append(f"{label:<28}{step * 1000:10.1f}{at * 1000:10.1f}")
+    return "\n".join(lines)
+
+
+class WarmUpThread(QThread):
+    # Loads what the first effect needs while the window is already up: the
+    # dialog and kernel modules, the compiled CPU kernels, then CuPy, the
+    # CUDA context and the elementwise kernels effects compile on first
+    # launch
+    warmed = pyqtSignal(bool)
+
+    def run(self):
+        begin()
+        import effects
+        import kernels
+        mark("warm-up: effect modules")
+        fused.warm_up()
+        mark("warm-up: cpu kernels")
+        gpu = backend.warm_up()
+        mark("warm-up: cupy + context" if gpu else "warm-up: gpu probe")
+        if gpu:
+            kernels.invert(backend.to_device(np.zeros((8, 8, 4), np.uint8), backend.cp))
+            fused.warm_up(backend.cp)
+            mark("warm-up: gpu kernels")
+        self.warmed.emit(gpu)
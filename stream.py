@@ -0,0 +1,272 @@
+import os
+import sys
+import time
+import queue
+import struct
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QBuffer, QIODevice, QByteArray
+
+import colorspace
+from buffers import WORKING_DEPTHS, image_to_array, array_to_image, quantize
+from macros import MacroLibrary, library_dir, make_step, run_steps
+from server import FORMATS, parse_pipeline
+
+# Effects in a shell pipeline, frames in on stdin and out on stdout:
+#
+#   ffmpeg -i in.mp4 -f rawvideo -pix_fmt rgba - |
+#     python stream.py --input rawvideo --size 1920x1080 --pipeline '[["noise", {}]]' |
+#     ffmpeg -f rawvideo -pix_fmt rgba -s 1920x1080 -i - out.mp4
+#
+# Input is a run of PNG/JPEG files back to back ("encoded"), raw RGBA
+# frames each behind a 12 byte header ("raw": b"RGBA", then width and
+# height as little-endian uint32) or headerless RGBA at a fixed --size
+# ("rawvideo", as ffmpeg writes it). Every frame goes through the chain as
+# soon as it is read. At most --queue frames are in flight, so a slow
+# consumer holds the reader back instead of frames piling up in memory.
+
+RAW_MAGIC = b"RGBA"
+RAW_HEADER = struct.Struct("<4sII")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+READ_BLOCK = 1 << 16
+DEFAULT_QUEUE = 4
+
+
+class StreamError(ValueError):
+    pass
+
+
+class Reader:
+    # Buffered reads from a binary stream, with the lookahead the encoded
+    # formats need to find where one file ends
+    def __init__(self, f):
+        # read1 returns what the pipe has instead of waiting for a full
+        # block, so a frame is handled as soon as its last byte is in
+        self.read = getattr(f, "read1", f.read)
+        self.buf = bytearray()
+
+    def fill(self, n):
+        # True once at least n bytes are buffered, False at end of stream
+        while len(self.buf) < n:
+            data = self.read(max(READ_BLOCK, n - len(self.buf)))
+            if not data:
+                return False
+            self.buf += data
+        return True
+
+    def take(self, n):
+        if not self.fill(n):
+            raise StreamError("stream ended inside a frame")
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def at_end(self):
+        return not self.fill(1)
+
+
+def _png_length(reader):
+    # Bytes up to and including the IEND chunk
+    pos = len(PNG_SIGNATURE)
+    while True:
+        if not reader.fill(pos + 8):
+            raise StreamError("stream ended inside a PNG")
+        length, kind = struct.unpack(">I4s", reader.buf[pos:pos + 8])
+        pos += 12 + length
+        if kind == b"IEND":
+            return pos
+
+
+def _jpeg_length(reader):
+    # Bytes up to and including EOI: marker segments are skipped by their
+    # length, entropy-coded data is scanned for the next marker that is not
+    # a stuffed 0xFF00 or a restart marker
+    pos = 2
+    while True:
+        if not reader.fill(pos + 2):
+            raise StreamError("stream ended inside a JPEG")
+        if reader.buf[pos] != 0xFF:
+            raise StreamError("corrupt JPEG marker")
+        marker = reader.buf[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xD9:
+            return pos + 2
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        if not reader.fill(pos + 4):
+            raise StreamError("stream ended inside a JPEG")
+        pos += 2 + struct.unpack(">H", reader.buf[pos + 2:pos + 4])[0]
+        if marker != 0xDA:
+            continue
+        while True:
+            i = reader.buf.find(b"\xff", pos)
+            if i < 0 or i + 1 >= len(reader.buf):
+                # Read on and search again from where this search stopped
+                pos = i if i >= 0 else len(reader.buf)
+                if not reader.fill(len(reader.buf) + 1):
+                    raise StreamError("stream ended inside a JPEG")
+                continue
+            following = reader.buf[i + 1]
+            if following == 0x00 or 0xD0 <= following <= 0xD7:
+                pos = i + 2
+                continue
+            pos = i
+            break
+
+
+def read_encoded(reader):
+    # PNG and JPEG files back to back -> BGRA arrays in working sRGB
+    while not reader.at_end():
+        if not reader.fill(8):
+            raise StreamError("stream ended inside a frame")
+        if reader.buf[:8] == PNG_SIGNATURE:
+            length = _png_length(reader)
+        elif reader.buf[:2] == b"\xff\xd8":
+            length = _jpeg_length(reader)
+        else:
+            raise StreamError("frames must be PNG or JPEG")
+        image = QImage.fromData(QByteArray(reader.take(length)))
+        if image.isNull():
+            raise StreamError("could not decode frame")
+        yield image_to_array(colorspace.to_working(image))
+
+
+def _from_rgba(data, width, height):
+    rgba = np.frombuffer(data, np.uint8).reshape(height, width, 4)
+    return rgba[..., [2, 1, 0, 3]]
+
+
+def read_raw(reader):
+    while not reader.at_end():
+        magic, width, height = RAW_HEADER.unpack(reader.take(RAW_HEADER.size))
+        if magic != RAW_MAGIC:
+            raise StreamError("bad raw frame header")
+        yield _from_rgba(reader.take(width * height * 4), width, height)
+
+
+def read_rawvideo(reader, width, height):
+    while not reader.at_end():
+        yield _from_rgba(reader.take(width * height * 4), width, height)
+
+
+def encode(arr, output):
+    # BGRA working array -> the bytes written for it
+    arr = quantize(arr)
+    if output in ("raw", "rawvideo"):
+        rgba = np.ascontiguousarray(arr[..., [2, 1, 0, 3]])
+        if output == "raw":
+            return RAW_HEADER.pack(RAW_MAGIC, arr.shape[1], arr.shape[0]) + rgba.tobytes()
+        return rgba.tobytes()
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    array_to_image(arr).save(buffer, FORMATS[output])
+    return bytes(buffer.data())
+
+
+def run(frames, steps, out, output, workers=2, queue_size=DEFAULT_QUEUE, dtype=np.uint8):
+    # Frames are processed on a small pool and written in order by a writer
+    # thread. The bounded queue between them is what limits buffering.
+    # Returns the number of frames written.
+    pending = queue.Queue(maxsize=max(1, queue_size))
+    written = [0]
+    failure = []
+
+    def process(arr):
+        return encode(run_steps(arr.astype(dtype, copy=False), steps), output)
+
+    def writer():
+        try:
+            while True:
+                future = pending.get()
+                if future is None:
+                    return
+                out.write(future.result())
+                out.flush()
+                written[0] += 1
+        except BaseException as e:
+            failure.append(e)
+            # Keep draining so the reader never blocks on a dead writer
+            while pending.get() is not None:
+                pass
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        try:
+            for arr in frames:
+                if failure:
+                    break
+                pending.put(pool.submit(process, arr))
+        finally:
+            pending.put(None)
+            thread.join()
+    if failure:
+        raise failure[0]
+    return written[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream frames from stdin through Cached Whale effects to stdout")
+    parser.add_argument("--input", choices=["encoded", "raw", "rawvideo"], default="encoded")
+    parser.add_argument("--output", choices=sorted(FORMATS) + ["raw", "rawvideo"], default=None,
+                        help="defaults to png for encoded input, else the input's raw format")
+    parser.add_argument("--size", help="WIDTHxHEIGHT of rawvideo frames")
+    chain = parser.add_mutually_exclusive_group(required=True)
+    chain.add_argument("--pipeline", help='effect chain as JSON, e.g. [["noise", {"amount": 20}]]')
+    chain.add_argument("--macro", help="name of a saved macro")
+    parser.add_argument("--library", default=None, help="macro folder, defaults to the editor's")
+    parser.add_argument("--depth", choices=list(WORKING_DEPTHS), default="8-bit",
+                        help="working precision between steps")
+    parser.add_argument("--workers", type=int, default=2, help="frames processed at once")
+    parser.add_argument("--queue", type=int, default=DEFAULT_QUEUE, help="frames buffered in flight")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.pipeline is not None:
+        try:
+            pipeline = parse_pipeline(args.pipeline)
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            parser.error(f"bad pipeline: {e}")
+        steps = [make_step(name, params) for name, params in pipeline.steps]
+    else:
+        steps = MacroLibrary(args.library or library_dir()).load(args.macro)
+
+    reader = Reader(sys.stdin.buffer)
+    if args.input == "rawvideo":
+        if not args.size:
+            parser.error("--size is required for rawvideo input")
+        width, height = (int(v) for v in args.size.lower().split("x"))
+        frames = read_rawvideo(reader, width, height)
+    elif args.input == "raw":
+        frames = read_raw(reader)
+    else:
+        frames = read_encoded(reader)
+    output = args.output or ("png" if args.input == "encoded" else args.input)
+
+    start = time.perf_counter()
+    try:
+        count = run(frames, steps, sys.stdout.buffer, output, args.workers, args.queue, WORKING_DEPTHS[args.depth])
+    except BrokenPipeError:
+        # The consumer went away. stdout is pointed at devnull so the flush
+        # at exit doesn't raise again.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    except (ValueError, TypeError, KeyError) as e:
+        # Malformed frames, and effect parameters the kernels reject
+        print(f"stream.py: {e}", file=sys.stderr)
+        return 1
+    if args.verbose:
+        elapsed = time.perf_counter() - start
+        print(f"{count} frames in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.1f} fps)", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
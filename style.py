@@ -94,6 +94,17 @@ def cmd_theme(background_color, text_color, border):
     QFrame[class="divider"] {{
         background-color: {text_color};
     }}
+
+    QTabBar::tab {{
+        padding: 4px 8px;
+        border: 1px solid #555;
+    }}
+
+    QTabBar::tab:selected {{
+        background-color: {text_color};
+        color: {background_color};
+        border: {border};
+    }}
     """
 
 def hacker_theme(background_color, text_color, border):
@@ -192,4 +203,15 @@ def hacker_theme(background_color, text_color, border):
     QFrame[class="divider"] {{
         background-color: {text_color};
     }}
+
+    QTabBar::tab {{
+        padding: 4px 8px;
+        border: 1px solid #555;
+    }}
+
+    QTabBar::tab:selected {{
+        background-color: {text_color};
+        color: {background_color};
+        border: {border};
+    }}
     """
\ No newline at end of file
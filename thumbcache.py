@@ -0,0 +1,172 @@
+import os
+import hashlib
+import threading
+
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import Qt
+
+import colorspace
+
+THUMB_SIZE = 256
+PREVIEW_SIZES = (1024, 2048)
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def cache_key(path):
+    # Content address of a source file: its absolute path, mtime and size.
+    # Editing or replacing the file gives it a new key.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    ident = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+    return hashlib.sha1(ident.encode("utf-8")).hexdigest()
+
+
+def _entry_path(cache_dir, key, level):
+    return os.path.join(cache_dir, key[:2], f"{key}.{level}.png")
+
+
+def _write_atomic(image, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if image.save(tmp, "PNG"):
+        os.replace(tmp, path)
+        return True
+    return False
+
+
+def write_entry(cache_dir, key, image, previews=True):
+    # Writes the thumbnail, and optionally the preview pyramid, for an already
+    # decoded image. Safe to call from worker threads and processes.
+    written = 0
+    levels = [("thumb", THUMB_SIZE)]
+    if previews:
+        levels += [(str(size), size) for size in PREVIEW_SIZES]
+    for level, size in levels:
+        if level != "thumb" and max(image.width(), image.height()) <= size:
+            continue
+        path = _entry_path(cache_dir, key, level)
+        if os.path.exists(path):
+            continue
+        scaled = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        if _write_atomic(scaled, path):
+            written += os.path.getsize(path)
+    return written
+
+
+def build_thumbnail(cache_dir, path):
+    # Decodes straight to thumbnail size; JPEG readers scale while decoding,
+    # so this never holds the full-size image. Returns the bytes written so
+    # the caller can report them to ThumbnailCache.added.
+    key = cache_key(path)
+    if key is None:
+        return 0
+    if os.path.exists(_entry_path(cache_dir, key, "thumb")):
+        return 0
+    reader = QImageReader(path)
+    size = reader.size()
+    if size.isValid() and max(size.width(), size.height()) > THUMB_SIZE:
+        reader.setScaledSize(size.scaled(THUMB_SIZE, THUMB_SIZE, Qt.KeepAspectRatio))
+    image = colorspace.to_working(reader.read())
+    if image.isNull():
+        return 0
+    return write_entry(cache_dir, key, image, previews=False)
+
+
+class ThumbnailCache:
+    # On-disk thumbnails and downscaled previews, shared between runs and
+    # between processes. Files are touched on access and the least recently
+    # used entries are evicted once the cache grows past max_bytes.
+    def __init__(self, cache_dir, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._total = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _read(self, key, level):
+        if key is None:
+            return None
+        path = _entry_path(self.cache_dir, key, level)
+        image = QImage(path)
+        if image.isNull():
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return image
+
+    def has_thumbnail(self, path):
+        # Cheaper than thumbnail() when the image itself isn't needed
+        key = cache_key(path)
+        return key is not None and os.path.exists(_entry_path(self.cache_dir, key, "thumb"))
+
+    def thumbnail(self, path):
+        return self._read(cache_key(path), "thumb")
+
+    def preview(self, path):
+        key = cache_key(path)
+        for size in reversed(PREVIEW_SIZES):
+            image = self._read(key, str(size))
+            if image is not None:
+                return image
+        return None
+
+    def store(self, path, image, previews=True):
+        key = cache_key(path)
+        if key is None or image.isNull():
+            return
+        written = write_entry(self.cache_dir, key, image, previews)
+        self.added(written)
+
+    def store_async(self, path, image, previews=True):
+        # QImage is safe to scale and encode off the GUI thread
+        thread = threading.Thread(target=self.store, args=(path, image, previews), daemon=True)
+        thread.start()
+
+    def added(self, nbytes):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, _, size in self._entries())
+            else:
+                self._total += nbytes
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def _evict(self):
+        # Oldest first, down to 90% so eviction doesn't run on every store
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total = total
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._total = 0